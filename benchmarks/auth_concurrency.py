@@ -0,0 +1,104 @@
+"""
+Concurrency benchmark for the API key lookup behind allow_access.
+
+Runs the same lookup with N requests in flight on one event loop, once with a blocking
+sync Session (how access_dependency used to work) and once with the async engine used
+by services.helpers.load_principal. With a networked MySQL the async numbers should grow
+with N while the sync numbers stay flat.
+
+Usage:
+    python -m benchmarks.auth_concurrency --duration 5 --concurrency 1 4 16 64
+
+DB_URL and ASYNC_DB_URL must point at the same database.
+"""
+import argparse
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.orm import joinedload, sessionmaker
+
+load_dotenv()
+
+from models import Base, Role, RoleEnum, User  # noqa: E402
+from services.helpers import generate_api_key, load_principal  # noqa: E402
+from services.log import AsyncSessionLocal, get_async_engine  # noqa: E402
+
+BENCH_USERNAME = "bench-auth-user"
+BENCH_KEY = generate_api_key()
+
+
+def seed(session_factory):
+    """Make sure there is one user with a known API key id to look up."""
+    with session_factory() as db:
+        role = db.query(Role).filter(Role.name == RoleEnum.STAFF).first()
+        if not role:
+            role = Role(name=RoleEnum.STAFF)
+            db.add(role)
+            db.flush()
+        user = db.query(User).filter(User.username == BENCH_USERNAME).first()
+        if not user:
+            user = User(username=BENCH_USERNAME, role_id=role.id)
+            db.add(user)
+        user.key_id = BENCH_KEY.key_id
+        user.api_key_hash = BENCH_KEY.digest
+        db.commit()
+
+
+async def run_sync_lookup(session_factory):
+    # Blocks the event loop for the whole round trip, like the old get_db dependency
+    with session_factory() as db:
+        user = (
+            db.query(User)
+            .options(joinedload(User.role))
+            .filter_by(key_id=BENCH_KEY.key_id)
+            .first()
+        )
+        return user.role.name
+
+
+async def run_async_lookup(_):
+    async with AsyncSessionLocal() as db:
+        return await load_principal(db, BENCH_KEY.key_id)
+
+
+async def measure(lookup, session_factory, concurrency: int, duration: float) -> float:
+    """Return completed lookups per second with `concurrency` requests in flight."""
+    completed = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal completed
+        while time.perf_counter() < deadline:
+            await lookup(session_factory)
+            completed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return completed / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per measurement")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    engine = create_engine(os.getenv("DB_URL"), pool_size=max(args.concurrency), max_overflow=0)
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine)
+    get_async_engine()
+    seed(session_factory)
+
+    print(f"{'in-flight':>10} {'sync req/s':>12} {'async req/s':>12}")
+    for concurrency in args.concurrency:
+        sync_rate = await measure(run_sync_lookup, session_factory, concurrency, args.duration)
+        async_rate = await measure(run_async_lookup, session_factory, concurrency, args.duration)
+        print(f"{concurrency:>10} {sync_rate:>12.1f} {async_rate:>12.1f}")
+
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+"""
+Startup benchmark for a worker process.
+
+Measures, in fresh interpreters, how long `import main` takes and how long the app takes
+from import to serving (import plus the lifespan startup). Neither touches MySQL or
+Redis, so both can be measured without them running (DB_URL, ASYNC_DB_URL and REDIS_URL
+still need to be set). Nearly all of the time is spent importing FastAPI, SQLAlchemy
+and the routes; the lifespan adds a few milliseconds.
+
+Usage:
+    python -m benchmarks.startup --runs 20
+    python -m benchmarks.startup --runs 20 --lifespan
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_ONLY = """
+import time
+started = time.perf_counter()
+import main
+print(time.perf_counter() - started)
+"""
+
+WITH_LIFESPAN = """
+import asyncio, time
+started = time.perf_counter()
+import main
+
+async def boot():
+    async with main.lifespan(main.app):
+        print(time.perf_counter() - started)
+
+asyncio.run(boot())
+"""
+
+
+def run(script: str) -> float:
+    """Run a script in a fresh interpreter and return the seconds it printed."""
+    output = subprocess.run(
+        [sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters per measurement")
+    parser.add_argument("--lifespan", action="store_true", help="Also time the lifespan startup")
+    args = parser.parse_args()
+
+    measurements = [("import main", IMPORT_ONLY)]
+    if args.lifespan:
+        measurements.append(("import + lifespan", WITH_LIFESPAN))
+
+    print(f"{'phase':>18} {'p50 ms':>8} {'max ms':>8}")
+    for name, script in measurements:
+        timings = [run(script) * 1000 for _ in range(args.runs)]
+        print(f"{name:>18} {statistics.median(timings):>8.1f} {max(timings):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+Benchmark suite that runs main:app in-process against local stand-ins.
+
+By default the database is a fresh SQLite file and Redis is fakeredis, so it runs with no
+servers at all. Pass --db-url/--async-db-url/--redis-url to use a local MySQL and Redis
+instead; they are written to, so point them at scratch instances.
+
+Scenarios:
+    auth    allow_access protected routes (/billing, /metrics, /all)
+    users   GET /users/ pages at several users table sizes
+    logs    POST /logs/time-range over the whole seeded range, as a JSON page and an ndjson export
+    drain   drain_log_batch throughput against the size of the Redis backlog
+
+Results are printed (or written to --output) as JSON so runs can be compared in CI.
+
+Usage:
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --scenarios auth drain --backlogs 1000 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["auth", "users", "logs", "drain"]
+INSERT_CHUNK_SIZE = 5000
+
+
+def configure(args):
+    """Point the app at the stand-ins. Must run before any app module is imported."""
+    if not args.db_url:
+        path = os.path.join(tempfile.mkdtemp(prefix="rbac-bench-"), "bench.db")
+        args.db_url = f"sqlite:///{path}"
+        args.async_db_url = f"sqlite+aiosqlite:///{path}"
+    os.environ["DB_URL"] = args.db_url
+    os.environ["ASYNC_DB_URL"] = args.async_db_url or args.db_url
+    os.environ["REDIS_URL"] = args.redis_url or "redis://localhost"
+    os.environ["LOG_TRANSPORT"] = "list"
+    os.environ["LOG_PARTITIONING"] = "false"
+    os.environ["LOG_ENTRY_FORMAT"] = args.log_entry_format
+    # A few hundred requests from one key would mostly measure 429s
+    os.environ.setdefault("RATE_LIMITING", "false")
+
+    if not args.redis_url:
+        use_fake_redis()
+
+
+def use_fake_redis():
+    """Install an in-memory Redis as the shared client returned by get_redis()."""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("fakeredis is required without --redis-url: pip install -r requirements-dev.txt")
+    import services.redis
+
+    services.redis.redis = fakeredis.FakeAsyncRedis()
+
+
+def summarize(latencies, errors: int, elapsed: float) -> dict:
+    """Throughput and latency percentiles, in milliseconds, for one measurement."""
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+    }
+
+
+async def load(send, requests: int, concurrency: int) -> dict:
+    """Issue `requests` calls of send() with `concurrency` in flight."""
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal errors, remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            response = await send()
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def seed_users(target: int, keys: dict):
+    """Grow the users table to `target` rows; the first rows get the API keys in `keys`."""
+    from sqlalchemy import func, insert, select
+    from db import SessionLocal
+    from models import Role, User
+    from services.helpers import generate_api_keys
+
+    with SessionLocal() as db:
+        role_ids = {role.name.value: role.id for role in db.query(Role)}
+        count = db.execute(select(func.count()).select_from(User)).scalar()
+        for role, key in keys.items():
+            if not db.query(User).filter_by(username=f"bench-{role.lower()}").first():
+                db.add(User(username=f"bench-{role.lower()}", role_id=role_ids[role], key_id=key.key_id, api_key_hash=key.digest))
+                count += 1
+        db.flush()
+        while count < target:
+            chunk = min(INSERT_CHUNK_SIZE, target - count)
+            db.execute(
+                insert(User),
+                [
+                    {"username": f"bench-user-{count + i}", "role_id": role_ids["Staff"], "key_id": key.key_id, "api_key_hash": key.digest}
+                    for i, key in enumerate(generate_api_keys(chunk))
+                ],
+            )
+            count += chunk
+        db.commit()
+
+
+def seed_logs(rows: int, start: datetime, end: datetime):
+    """Insert `rows` access logs spread evenly over [start, end)."""
+    from sqlalchemy import insert
+    from db import SessionLocal
+    from models import AccessLog
+
+    step = (end - start) / max(rows, 1)
+    endpoints = ["/billing", "/metrics", "/all", "/users/", "/roles/"]
+    with SessionLocal() as db:
+        for offset in range(0, rows, INSERT_CHUNK_SIZE):
+            db.execute(
+                insert(AccessLog),
+                [
+                    {
+                        "user_id": i % 1000 or None,
+                        "endpoint": endpoints[i % len(endpoints)],
+                        "action": "GET",
+                        "success": i % 10 != 0,
+                        "message": None,
+                        "timestamp": start + step * i,
+                    }
+                    for i in range(offset, min(offset + INSERT_CHUNK_SIZE, rows))
+                ],
+            )
+        db.commit()
+
+
+def backlog_entries(size: int):
+    """Serialized entries shaped like the ones log_access queues, in LOG_ENTRY_FORMAT."""
+    from services.helpers import access_log_entry
+
+    return [access_log_entry(i % 1000 or None, "/all", "GET", True, "") for i in range(size)]
+
+
+async def bench_auth(client, keys, args) -> dict:
+    routes = {"/billing": "Admin", "/metrics": "Supervisor", "/all": "Staff"}
+    results = {}
+    for path, role in routes.items():
+        headers = {"Authorization": keys[role].api_key}
+        results[path] = {
+            str(concurrency): await load(lambda: client.get(path, headers=headers), args.requests, concurrency)
+            for concurrency in args.concurrency
+        }
+    return results
+
+
+async def bench_users(client, keys, args) -> dict:
+    results = {}
+    for size in args.user_counts:
+        seed_users(size, keys)
+        results[str(size)] = {
+            "first_page": await load(lambda: client.get("/users/", params={"limit": 100}), args.requests, args.concurrency[-1]),
+            # Last page reached through the keyset cursor, which should cost the same as the first
+            "deep_page": await load(
+                lambda: client.get("/users/", params={"limit": 100, "cursor": size - 100}), args.requests, args.concurrency[-1]
+            ),
+        }
+    return results
+
+
+async def bench_logs(client, args) -> dict:
+    end = datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=args.log_days)
+    seed_logs(args.log_rows, start, end)
+    body = {"start_time": start.isoformat(), "end_time": end.isoformat()}
+
+    page = await load(lambda: client.post("/logs/time-range", json={**body, "limit": 1000}), args.requests, args.concurrency[-1])
+
+    # Full export of the range, timed end to end while the body streams in
+    started = time.perf_counter()
+    exported = 0
+    async with client.stream("POST", "/logs/time-range", json={**body, "format": "ndjson"}) as response:
+        async for line in response.aiter_lines():
+            exported += bool(line)
+    elapsed = time.perf_counter() - started
+    return {
+        "rows": args.log_rows,
+        "days": args.log_days,
+        "json_page_1000": page,
+        "ndjson_export": {"rows": exported, "seconds": round(elapsed, 3), "rows_per_s": round(exported / elapsed, 1)},
+    }
+
+
+async def bench_drain(args) -> dict:
+    from services.log import ACCESS_LOGS_KEY, drain_log_batch
+    from services.redis import get_redis
+
+    results = {}
+    for size in args.backlogs:
+        redis = get_redis()
+        await redis.delete(ACCESS_LOGS_KEY)
+        entries = backlog_entries(size)
+        queued_bytes = sum(len(entry) for entry in entries)
+        for offset in range(0, size, INSERT_CHUNK_SIZE):
+            await redis.rpush(ACCESS_LOGS_KEY, *entries[offset:offset + INSERT_CHUNK_SIZE])
+
+        started = time.perf_counter()
+        moved = batches = 0
+        while True:
+            count = await drain_log_batch()
+            if not count:
+                break
+            moved += count
+            batches += 1
+        elapsed = time.perf_counter() - started
+        results[str(size)] = {
+            "moved": moved,
+            "batches": batches,
+            "queued_bytes": queued_bytes,
+            "seconds": round(elapsed, 3),
+            "entries_per_s": round(moved / elapsed, 1),
+        }
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    import httpx
+    import main
+    from db import bootstrap
+    from services.helpers import generate_api_key
+
+    bootstrap()
+    keys = {role: generate_api_key() for role in ("Admin", "Supervisor", "Staff")}
+    seed_users(0, keys)
+
+    results = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            if "auth" in args.scenarios:
+                results["auth"] = await bench_auth(client, keys, args)
+            if "users" in args.scenarios:
+                results["users"] = await bench_users(client, keys, args)
+            if "logs" in args.scenarios:
+                results["logs"] = await bench_logs(client, args)
+    # After the lifespan so the background drain task is not competing for the backlog
+    if "drain" in args.scenarios:
+        # The lifespan closed the shared client
+        if not args.redis_url:
+            use_fake_redis()
+        results["drain"] = await bench_drain(args)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--db-url", help="Sync database URL, a fresh SQLite file by default")
+    parser.add_argument("--async-db-url", help="Async URL for the same database")
+    parser.add_argument("--redis-url", help="Redis URL, fakeredis by default")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per measurement")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--user-counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--log-rows", type=int, default=100000)
+    parser.add_argument("--log-days", type=int, default=30)
+    parser.add_argument("--backlogs", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--log-entry-format", choices=["binary", "json"], default="binary", help="Encoding of queued log entries")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    configure(args)
+    report = {
+        "revision": git_revision(),
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "database": args.db_url.split(":", 1)[0],
+        "redis": "redis" if args.redis_url else "fakeredis",
+        "results": asyncio.run(run(args)),
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
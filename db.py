@@ -1,52 +1,216 @@
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.dialects.mysql import insert
+from fastapi import Depends
+from sqlalchemy import create_engine, func, insert, inspect, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
+import argparse
 import logging
+import secrets
 
-from models import Base, Role
+from models import AccessLog, Base, Permission, PolicyChange, Role, RoleEnum, User, role_parents
+from services.admission import DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUT, sync_admission
+from services.helpers import API_KEY_ID_BYTES, API_KEY_PEPPER, generate_api_key, hash_api_key_secret
+from services.hierarchy import rebuild_closure
+from services.policy import POLICY_READ_PERMISSION, record_key_changes, record_roles_change
+from services.policy_evaluator import split_api_key
+from services.telemetry import TimedQueuePool
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-# Create the engine and session
 connection_string = os.getenv("DB_URL")
-engine = create_engine(
-    connection_string,
-    pool_size=10,  # Maximum number of connections in the pool
-    max_overflow=5,  # Additional connections allowed beyond pool_size
-    pool_timeout=30,  # Seconds to wait before giving up on a connection
-    pool_recycle=3600,  # Recycle connections after 1 hour to avoid stale ones
-    pool_pre_ping=True,  # Checks if connections are alive before using them
-)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-# Create tables in the database (only if they don't exist)
-Base.metadata.create_all(bind=engine)
-
-# Add predefined roles
+engine = None
+
+# Bound to the engine by get_engine(), so importing this module never touches the database
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+# Predefined roles
 roles = [
     {"id": "1", "name": "Staff"},
     {"id": "2", "name": "Supervisor"},
     {"id": "3", "name": "Admin"},
 ]
 
-# Upsert statement
-stmt = insert(Role).values(roles)
-stmt = stmt.on_duplicate_key_update(id=stmt.inserted.id)
+# Default hierarchy: Admin inherits Supervisor, which inherits Staff
+default_parents = [
+    {"role_id": "2", "parent_id": "1"},
+    {"role_id": "3", "parent_id": "2"},
+]
+
+# Permissions checked by the service itself
+builtin_permissions = [POLICY_READ_PERMISSION]
+
+
+def get_engine():
+    """Create the engine on first use. Connections are only opened when a session needs one."""
+    global engine
+    if engine is None:
+        engine = create_engine(
+            connection_string,
+            poolclass=TimedQueuePool,  # Records checkout wait for the telemetry endpoint
+            pool_size=DB_POOL_SIZE,  # Maximum number of connections in the pool
+            max_overflow=DB_MAX_OVERFLOW,  # Additional connections allowed beyond pool_size
+            pool_timeout=DB_POOL_TIMEOUT,  # Seconds to wait before giving up on a connection
+            pool_recycle=3600,  # Recycle connections after 1 hour to avoid stale ones
+            pool_pre_ping=True,  # Checks if connections are alive before using them
+        )
+        SessionLocal.configure(bind=engine)
+    return engine
+
+
+def migrate_legacy_api_keys(connection):
+    """
+    Move a users table from plaintext api_key to key_id and api_key_hash.
+
+    Every legacy key keeps working until it is rotated: its row gets the key id that
+    split_api_key() derives from the key and the digest of the whole key, which is how
+    legacy keys are checked. The plaintext column is then dropped.
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns("users")}
+    if "api_key" not in columns:
+        return
+
+    users = User.__table__
+    types = {name: users.c[name].type.compile(dialect=connection.dialect) for name in ("key_id", "api_key_hash")}
+    for name, column_type in types.items():
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE users ADD COLUMN {name} {column_type} NULL"))
+
+    taken = set(connection.execute(text("SELECT key_id FROM users WHERE key_id IS NOT NULL")).scalars())
+    rows = []
+    for user_id, api_key in connection.execute(text("SELECT id, api_key FROM users WHERE key_id IS NULL")):
+        parsed = split_api_key(api_key, API_KEY_PEPPER)
+        key_id = parsed[0] if parsed and parsed[1] == api_key else None
+        if key_id is None or key_id in taken:
+            # Not a legacy key (wrong length, or reads as "<key id>.<secret>"), or two keys
+            # derive the same id: this key stops working
+            key_id = secrets.token_hex(API_KEY_ID_BYTES)
+            logger.warning("The API key of user %s cannot be migrated and has to be rotated", user_id)
+        taken.add(key_id)
+        rows.append({"user_id": user_id, "key_id": key_id, "api_key_hash": hash_api_key_secret(api_key)})
+    if rows:
+        connection.execute(
+            text("UPDATE users SET key_id = :key_id, api_key_hash = :api_key_hash WHERE id = :user_id"), rows
+        )
+
+    if connection.dialect.name == "mysql":
+        connection.execute(text(
+            f"ALTER TABLE users MODIFY key_id {types['key_id']} NOT NULL, "
+            f"MODIFY api_key_hash {types['api_key_hash']} NOT NULL, "
+            "ADD UNIQUE (key_id), DROP COLUMN api_key"
+        ))
+    else:
+        # SQLite cannot drop a column with a UNIQUE constraint or make one NOT NULL, so the
+        # table is rebuilt. It only backs the benchmark suite, and no table references users.
+        connection.execute(text("ALTER TABLE users RENAME TO users_legacy"))
+        users.create(connection)
+        columns = ", ".join(column.name for column in users.columns)
+        connection.execute(text(f"INSERT INTO users ({columns}) SELECT {columns} FROM users_legacy"))
+        connection.execute(text("DROP TABLE users_legacy"))
+    logger.info("Migrated %d plaintext API keys to key ids and digests", len(rows))
 
-# Execute the statement
-with engine.connect() as connection:
-    connection.execute(stmt)
-    connection.commit()
 
+# Indexes removed from AccessLog that bootstrap() drops from existing tables
+OBSOLETE_ACCESS_LOG_INDEXES = {"ix_access_logs_success_timestamp"}
 
-def get_db():
+
+def bootstrap():
+    """
+    Create missing tables and seed the predefined roles, hierarchy and permissions.
+
+    Run once per deploy with `python db.py`, not from the workers. A named lock makes
+    concurrent runs wait for each other instead of racing on the DDL.
+    """
+    with get_engine().connect() as connection:
+        # SQLite is only used by the benchmark suite and has a single writer anyway
+        mysql = connection.dialect.name == "mysql"
+        if mysql:
+            connection.execute(text("SELECT GET_LOCK('rbac_bootstrap', 60)"))
+        try:
+            # Create tables in the database (only if they don't exist)
+            Base.metadata.create_all(bind=connection)
+            migrate_legacy_api_keys(connection)
+            # create_all skips existing tables, so add indexes introduced since they were created
+            for index in [*AccessLog.__table__.indexes, *PolicyChange.__table__.indexes]:
+                index.create(connection, checkfirst=True)
+            # and drop those that were removed
+            existing = {index["name"] for index in inspect(connection).get_indexes("access_logs")}
+            for name in OBSOLETE_ACCESS_LOG_INDEXES & existing:
+                connection.execute(text(f"DROP INDEX {name} ON access_logs" if mysql else f"DROP INDEX {name}"))
+
+            # Upsert statement
+            if mysql:
+                stmt = mysql_insert(Role).values(roles)
+                stmt = stmt.on_duplicate_key_update(id=stmt.inserted.id)
+            else:
+                stmt = sqlite_insert(Role).values(roles).on_conflict_do_nothing()
+            connection.execute(stmt)
+            # Seed the hierarchy only once so later changes made through the API are kept
+            if not connection.execute(select(func.count()).select_from(role_parents)).scalar():
+                connection.execute(insert(role_parents).values(default_parents))
+            rebuild_closure(connection)
+            seeded = set(connection.execute(select(Permission.name)).scalars())
+            missing = [{"name": name} for name in builtin_permissions if name not in seeded]
+            if missing:
+                connection.execute(insert(Permission).values(missing))
+                # Admin holds every permission, so its grants changed
+                record_roles_change(connection)
+            connection.commit()
+        finally:
+            if mysql:
+                connection.execute(text("SELECT RELEASE_LOCK('rbac_bootstrap')"))
+    logger.info("Database schema and seed data are up to date")
+
+
+async def admit_db():
+    """Hold a sync engine admission slot for the request, or fail fast with a 503."""
+    async with sync_admission.slot():
+        yield
+
+
+def get_db(_=Depends(admit_db)):
     """Dependency that yields a database session."""
+    get_engine()
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+def issue_admin_key(username: str) -> str:
+    """
+    Issue a new API key to an Admin user, creating the user or promoting it to Admin.
+
+    For a first deploy, or to recover when no Admin key works. An existing key is revoked,
+    though caches may accept it for up to SHARED_AUTH_CACHE_TTL.
+    """
+    get_engine()
+    issued = generate_api_key()
+    with SessionLocal() as db:
+        admin = db.query(Role).filter(Role.name == RoleEnum.ADMIN).one()
+        user = db.query(User).filter(User.username == username).first()
+        changed = [issued.key_id]
+        if user is None:
+            db.add(User(username=username, role_id=admin.id, key_id=issued.key_id, api_key_hash=issued.digest))
+        else:
+            changed.append(user.key_id)
+            user.role_id = admin.id
+            user.key_id = issued.key_id
+            user.api_key_hash = issued.digest
+        record_key_changes(db, changed)
+        db.commit()
+    return issued.api_key
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Create or upgrade the schema, or issue an Admin API key.")
+    parser.add_argument("--admin-key", metavar="USERNAME", help="After bootstrapping, print a new API key for this Admin user")
+    args = parser.parse_args()
+    bootstrap()
+    if args.admin_key:
+        print(issue_admin_key(args.admin_key))
@@ -1,4 +1,5 @@
-from asyncio import create_task
+from anyio import to_thread
+from asyncio import create_task, gather, wait_for
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, Request
@@ -8,27 +9,66 @@ from routes.permissions import router as permissions_router
 from routes.roles import router as roles_router
 from routes.users import router as users_router
 from routes.logging import router as logs_router
+from routes.authz import router as authz_router
+from routes.policy import router as policy_router
+from routes.telemetry import router as telemetry_router
+from db import get_engine
 from schemas import ResponseSchema
+from services.admission import THREADPOOL_SIZE
+from services.cache import listen_for_invalidations
 from services.helpers import allow_access
-from services.log import move_logs_to_mysql
-from services.redis import redis
+from services.log import drain_logs, get_async_engine
+from services.log_buffer import log_buffer
+from services.log_spill import log_spill
+from services.partitions import LOG_PARTITIONING, manage_log_partitions
+from services.redis import close_redis
+import asyncio
+import logging
 import os
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Database URL for PostgreSQL
 SQLALCHEMY_DATABASE_URL = os.getenv("DB_URL")
+# How long shutdown waits for the background tasks to unwind
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Test the connection
-    await redis.ping()
-    task = create_task(move_logs_to_mysql())
-    print("Connected to Redis successfully")
+    # Engines and clients are created here rather than at import. The schema is managed
+    # by `python db.py`, so starting a worker never runs DDL.
+    get_engine()
+    get_async_engine()
+    # Sync routes run in this threadpool; sized with the pools in services/admission.py
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Nothing here waits on MySQL or Redis: connections are opened and the permission matrix
+    # is loaded by the first requests, and requests are still served while Redis is down.
+    tasks = [
+        create_task(drain_logs()),
+        create_task(listen_for_invalidations()),
+        create_task(log_buffer.run()),
+    ]
+    if log_spill.enabled:
+        # Replays access logs spilled to disk while Redis was down or slow, including any left by a previous run
+        tasks.append(create_task(log_spill.run()))
+    if LOG_PARTITIONING:
+        tasks.append(create_task(manage_log_partitions()))
     yield
-    task.cancel()
-    await redis.close()
+    for task in tasks:
+        task.cancel()
+    # Wait for the tasks to unwind, so a batch the drain took is requeued before Redis is
+    # closed. Bounded, as a cancellation that lands while the Redis client connects can be lost.
+    try:
+        await wait_for(gather(*tasks, return_exceptions=True), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Background tasks did not stop within %ss", SHUTDOWN_TIMEOUT)
+    # Send whatever requests logged since the last flush
+    await log_buffer.flush()
+    log_spill.close()
+    await close_redis()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -36,6 +76,10 @@ app.include_router(users_router, prefix="/users", tags=["Users"])
 app.include_router(roles_router, prefix="/roles", tags=["Roles"])
 app.include_router(permissions_router, prefix="/permissions", tags=["Permissions"])
 app.include_router(logs_router, prefix="/logs", tags=["Logs"])
+app.include_router(authz_router, prefix="/authz", tags=["Authorization"])
+app.include_router(policy_router, prefix="/policy", tags=["Policy"])
+# Internal Prometheus scrape target, separate from the demo /metrics route
+app.include_router(telemetry_router, prefix="/telemetry", include_in_schema=False)
 
 
 @app.exception_handler(RequestValidationError)
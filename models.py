@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Text
 import uuid
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, ForeignKey, Table, Enum as SQLAlchemyEnum, create_engine
+from sqlalchemy import BINARY, Boolean, Column, DateTime, Index, Integer, String, ForeignKey, Table, UniqueConstraint, Enum as SQLAlchemyEnum, create_engine
 from sqlalchemy.orm import relationship, DeclarativeBase
 from dotenv import load_dotenv
 import os
@@ -30,11 +30,32 @@ role_permission = Table(
 )
 
 
+# Role inheritance: a role holds every role and permission of its parent roles
+role_parents = Table(
+    "role_parents",
+    Base.metadata,
+    Column("role_id", Integer, ForeignKey("roles.id"), primary_key=True),
+    Column("parent_id", Integer, ForeignKey("roles.id"), primary_key=True),
+)
+
+
+# Transitive closure of role_parents, including each role itself at depth 0
+role_closure = Table(
+    "role_closure",
+    Base.metadata,
+    Column("role_id", Integer, ForeignKey("roles.id"), primary_key=True),
+    Column("ancestor_id", Integer, ForeignKey("roles.id"), primary_key=True),
+    Column("depth", Integer, nullable=False),
+)
+
+
 class User(Base):
     __tablename__ = "users"
     username = Column(String(100), unique=True, nullable=False)
     role_id = Column(Integer, ForeignKey("roles.id"))
-    api_key = Column(String(32), unique=True, nullable=False) 
+    # API keys are "<key_id>.<secret>"; only the key id and a SHA-256 digest of the secret are stored
+    key_id = Column(String(12), unique=True, nullable=False)
+    api_key_hash = Column(BINARY(32), nullable=False)
     role = relationship("Role")
 
 
@@ -42,6 +63,12 @@ class Role(Base):
     __tablename__ = "roles"
     name = Column(SQLAlchemyEnum(RoleEnum), unique=True, nullable=False)
     permissions = relationship("Permission", secondary=role_permission, back_populates="roles")
+    parents = relationship(
+        "Role",
+        secondary=role_parents,
+        primaryjoin=lambda: Role.id == role_parents.c.role_id,
+        secondaryjoin=lambda: Role.id == role_parents.c.parent_id,
+    )
 
 
 class Permission(Base):
@@ -52,18 +79,30 @@ class Permission(Base):
 
 class AccessLog(Base):
     __tablename__ = "access_logs"
-    
+    __table_args__ = (
+        # Serves time-range scans and keyset pagination, optionally narrowed by user and endpoint
+        Index("ix_access_logs_timestamp_user_endpoint", "timestamp", "user_id", "endpoint"),
+        # Log searches (routes/logging.py) pin one of these columns and scan a time range of it.
+        # success has no index of its own: two values are too few to narrow a time range, so
+        # like message substrings it is filtered on the rows another index selects
+        Index("ix_access_logs_user_timestamp", "user_id", "timestamp"),
+        Index("ix_access_logs_endpoint_timestamp", "endpoint", "timestamp"),
+        Index("ix_access_logs_action_timestamp", "action", "timestamp"),
+    )
+
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))  # Unique log ID
     user_id = Column(Integer, nullable=True)  # Nullable for anonymous access
     endpoint = Column(String(255), nullable=False)  # The accessed endpoint
     action = Column(String(10), nullable=False)  # HTTP method like GET, POST
     success = Column(Boolean, nullable=False)  # Whether the action succeeded
     message = Column(String(255), nullable=True)  # Any additional log message
-    timestamp = Column(DateTime, default=datetime.now(), nullable=False) 
+    # Part of the primary key so the table can be range-partitioned by day (see services/partitions.py)
+    timestamp = Column(DateTime, default=datetime.now, primary_key=True, nullable=False)
     
     def to_dict(self):
         return {
             "id": self.id,
+            "user_id": self.user_id,
             "endpoint": self.endpoint,
             "action": self.action,
             "success": self.success,
@@ -72,6 +111,44 @@ class AccessLog(Base):
         }
     
 
+class PolicyChange(Base):
+    """A change to what policy snapshots contain. The id is the policy version it produced."""
+
+    __tablename__ = "policy_changes"
+    __table_args__ = (
+        # The primary key is appended to secondary indexes, so this also serves MAX(id) per kind
+        Index("ix_policy_changes_kind", "kind"),
+    )
+    kind = Column(String(16), nullable=False)  # "key" for one API key id, "roles" for grants or the hierarchy
+    key_id = Column(String(12), nullable=True)  # Set for "key" changes; the key may no longer exist
+    timestamp = Column(DateTime, default=datetime.now, nullable=False)
+
+
+class AccessLogRollupMixin:
+    """Pre-aggregated access log counts for one time bucket, maintained by the log drain."""
+
+    bucket = Column(DateTime, nullable=False)  # Start of the minute or hour
+    endpoint = Column(String(255), nullable=False)
+    action = Column(String(10), nullable=False)
+    user_id = Column(Integer, nullable=False, default=0)  # 0 for anonymous access, so the unique key applies
+    success = Column(Boolean, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class AccessLogMinuteRollup(AccessLogRollupMixin, Base):
+    __tablename__ = "access_log_rollup_minute"
+    __table_args__ = (
+        UniqueConstraint("bucket", "endpoint", "action", "user_id", "success", name="uq_access_log_rollup_minute"),
+    )
+
+
+class AccessLogHourRollup(AccessLogRollupMixin, Base):
+    __tablename__ = "access_log_rollup_hour"
+    __table_args__ = (
+        UniqueConstraint("bucket", "endpoint", "action", "user_id", "success", name="uq_access_log_rollup_hour"),
+    )
+
+
 if __name__ == "__main__":
     load_dotenv()
     
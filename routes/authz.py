@@ -0,0 +1,69 @@
+from fastapi import APIRouter, Depends
+from schemas import AuthzCheckRequest, AuthzDecision, GeneralResponseSchema
+from services.authz import permission_matrix
+from services.helpers import (
+    access_log_entry,
+    allow_access,
+    find_principals,
+    hash_api_key_secret,
+    parse_api_key,
+    required_roles_for,
+)
+from services.log_buffer import log_buffer
+import hmac
+
+router = APIRouter()
+
+
+@router.post("/check", response_model=GeneralResponseSchema, dependencies=[Depends(allow_access())])
+async def check_access(request: AuthzCheckRequest):
+    """
+    Authorize a batch of (api_key, endpoint, method, roles, permissions) tuples for a gateway.
+
+    Every distinct key is resolved in one pass over the auth caches and at most one
+    database query, each check is decided exactly like allow_access would, and the
+    access logs go through the log buffer like those of any request, so a slow or
+    unavailable Redis does not fail the batch. Results are in the order of `checks`.
+    """
+    parsed = {check.api_key: parse_api_key(check.api_key) for check in request.checks}
+    principals = await find_principals([key[0] for key in parsed.values() if key])
+
+    if not permission_matrix.loaded:
+        await permission_matrix.load()
+
+    # Keys and requirements repeat across a batch, so verify and resolve each once
+    verified = {}
+    for api_key, key in parsed.items():
+        principal = principals.get(key[0]) if key else None
+        if principal and hmac.compare_digest(principal.key_digest, hash_api_key_secret(key[1])):
+            verified[api_key] = principal
+    requirements = {}
+
+    decisions = []
+    for check in request.checks:
+        principal = verified.get(check.api_key)
+        if not principal:
+            decision = AuthzDecision(allowed=False, message="Invalid API key")
+        else:
+            requirement = (tuple(check.roles or ()), tuple(check.permissions or ()))
+            if requirement not in requirements:
+                mask = permission_matrix.mask_for(check.permissions) if check.permissions else 0
+                requirements[requirement] = (required_roles_for(check.roles, check.permissions), mask)
+            roles, mask = requirements[requirement]
+            allowed = permission_matrix.authorizes(principal.role, roles, mask)
+            decision = AuthzDecision(
+                allowed=allowed,
+                message="" if allowed else "Insufficient privileges",
+                user_id=principal.user_id,
+                role=principal.role,
+            )
+        decisions.append(decision)
+        await log_buffer.put(
+            access_log_entry(decision.user_id, check.endpoint, check.method, decision.allowed, decision.message)
+        )
+
+    return GeneralResponseSchema(
+        success=True,
+        message=f"Checked {len(decisions)} requests",
+        data={"results": [decision.model_dump() for decision in decisions]},
+    )
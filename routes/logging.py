@@ -1,34 +1,215 @@
-from typing import List
+from contextlib import asynccontextmanager
+from itertools import islice
+import asyncio
+import base64
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from db import get_db
-from models import AccessLog
-from schemas import GeneralResponseSchema, LogTimeRangeRequest, ResponseSchema
+from typing import Optional, Union
+from db import SessionLocal, get_db, get_engine
+from models import AccessLog, AccessLogHourRollup, AccessLogMinuteRollup
+from schemas import (
+    GeneralResponseSchema,
+    LogExportFormat,
+    LogSearchRequest,
+    LogStatsRequest,
+    LogTimeRangeRequest,
+    ResponseSchema,
+    StatsGranularity,
+)
+from services.admission import async_admission, held_stream, sync_admission
+from services.log import AsyncSessionLocal, get_async_engine
+from services.partitions import read_archived_logs
+
+load_dotenv()
 
 
 router = APIRouter()
 
+# Rows fetched per round trip from the server-side cursor while streaming
+EXPORT_FETCH_SIZE = 1000
+
+EXPORT_COLUMNS = [
+    AccessLog.id,
+    AccessLog.user_id,
+    AccessLog.endpoint,
+    AccessLog.action,
+    AccessLog.success,
+    AccessLog.message,
+    AccessLog.timestamp,
+]
+
+# Streamed searches allowed at once. Each holds an async engine connection, which is
+# shared with API key lookups, until its response is fully sent
+LOG_SEARCH_MAX_STREAMS = int(os.getenv("LOG_SEARCH_MAX_STREAMS", "2"))
+# Most frequent values returned per facet
+LOG_SEARCH_FACET_SIZE = 10
+
+FACET_COLUMNS = {
+    "endpoint": AccessLog.endpoint,
+    "user_id": AccessLog.user_id,
+    "action": AccessLog.action,
+    "success": AccessLog.success,
+}
+
+search_streams = asyncio.Semaphore(LOG_SEARCH_MAX_STREAMS)
+
+
+@asynccontextmanager
+async def search_stream_slot():
+    """Hold one of the search stream slots, or raise a 503 right away if none is free."""
+    # Reject rather than queue: a waiting stream would hold its request open indefinitely.
+    # acquire() does not suspend while the semaphore is unlocked, so no other request can
+    # take the slot in between
+    if search_streams.locked():
+        async_admission.reject("search_streams")
+    async with search_streams:
+        yield
+
+
+ROLLUP_MODELS = {
+    StatsGranularity.MINUTE: AccessLogMinuteRollup,
+    StatsGranularity.HOUR: AccessLogHourRollup,
+}
+
+
+def encode_cursor(log: dict) -> str:
+    """Encode the (timestamp, id) position of the last row on a page."""
+    position = json.dumps([log["timestamp"].isoformat(), log["id"]])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    timestamp, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(timestamp), log_id
+
+
+def validate_cursor(cursor: Optional[str]):
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except (ValueError, TypeError):
+            raise HTTPException(
+                status_code=400,
+                detail=ResponseSchema(success=False, message="Invalid cursor").model_dump(),
+            )
+
+
+def time_range_statement(time_range: Union[LogTimeRangeRequest, LogSearchRequest], *columns):
+    """Select logs in the range ordered by (timestamp, id), starting after the cursor if given."""
+    stmt = (
+        select(*columns)
+        .where(AccessLog.timestamp >= time_range.start_time)
+        .where(AccessLog.timestamp <= time_range.end_time)
+        .order_by(AccessLog.timestamp, AccessLog.id)
+    )
+    if time_range.cursor:
+        timestamp, log_id = decode_cursor(time_range.cursor)
+        stmt = stmt.where(
+            or_(
+                AccessLog.timestamp > timestamp,
+                and_(AccessLog.timestamp == timestamp, AccessLog.id > log_id),
+            )
+        )
+    return stmt
+
+
+def archived_logs(time_range: LogTimeRangeRequest):
+    """Archived logs in the range after the cursor, or nothing unless include_archived is set."""
+    if not time_range.include_archived:
+        return iter(())
+    after = decode_cursor(time_range.cursor) if time_range.cursor else None
+    return read_archived_logs(time_range.start_time, time_range.end_time, after)
+
+
+def stream_logs(time_range: LogTimeRangeRequest):
+    """
+    Yield every matching row, archived days first, then MySQL through a server-side cursor,
+    so memory stays constant.
+
+    Runs with its own session, under the sync engine admission slot the response holds.
+    """
+    yield from archived_logs(time_range)
+
+    stmt = time_range_statement(time_range, *EXPORT_COLUMNS).execution_options(
+        stream_results=True, yield_per=EXPORT_FETCH_SIZE
+    )
+    with SessionLocal() as db:
+        for row in db.execute(stmt):
+            yield row._asdict()
+
+
+def ndjson_lines(time_range: LogTimeRangeRequest):
+    for log in stream_logs(time_range):
+        log["timestamp"] = log["timestamp"].isoformat()
+        yield json.dumps(log) + "\n"
+
+
+def csv_lines(time_range: LogTimeRangeRequest):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in EXPORT_COLUMNS])
+    for log in stream_logs(time_range):
+        writer.writerow([log[column.key] for column in EXPORT_COLUMNS])
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def logs_page(time_range: LogTimeRangeRequest) -> list:
+    """One page of logs, archived days before anything still in MySQL."""
+    logs = list(islice(archived_logs(time_range), time_range.limit))
+    remaining = time_range.limit - len(logs)
+    if remaining:
+        with SessionLocal() as db:
+            logs += [
+                log.to_dict()  # Convert SQLAlchemy objects to dicts
+                for log in db.execute(time_range_statement(time_range, AccessLog).limit(remaining)).scalars()
+            ]
+    return logs
+
+
 @router.post("/time-range", response_model=GeneralResponseSchema)
-def get_logs_by_time_range(
-    time_range: LogTimeRangeRequest,
-    db: Session = Depends(get_db),
-):
+async def get_logs_by_time_range(time_range: LogTimeRangeRequest):
     """
     Retrieve logs within a specified time range.
+
+    The JSON format returns one page of at most `limit` logs and a `next_cursor` to pass
+    back for the following page. The ndjson and csv formats stream the whole range, holding
+    a sync engine admission slot until the response is fully sent.
     """
+    validate_cursor(time_range.cursor)
+    get_engine()
+
+    if time_range.format == LogExportFormat.NDJSON:
+        body = await held_stream(sync_admission.slot(), lambda: iterate_in_threadpool(ndjson_lines(time_range)))
+        return StreamingResponse(body, media_type="application/x-ndjson")
+    if time_range.format == LogExportFormat.CSV:
+        body = await held_stream(sync_admission.slot(), lambda: iterate_in_threadpool(csv_lines(time_range)))
+        return StreamingResponse(body, media_type="text/csv")
+
     try:
-        logs: List[AccessLog] = (
-            db.query(AccessLog)
-            .filter(AccessLog.timestamp >= time_range.start_time)
-            .filter(AccessLog.timestamp <= time_range.end_time)
-            .order_by(AccessLog.timestamp)
-            .all()
-        )
+        async with sync_admission.slot():
+            logs = await run_in_threadpool(logs_page, time_range)
+        next_cursor = encode_cursor(logs[-1]) if len(logs) == time_range.limit else None
         return GeneralResponseSchema(
             success=True,
             message="Logs retrieved successfully",
-            data={"logs": [log.to_dict() for log in logs]}  # Convert SQLAlchemy objects to dicts
+            data={"logs": logs, "next_cursor": next_cursor},
         )
+    except HTTPException:
+        raise
     except Exception:
         raise HTTPException(
             status_code=500,
@@ -36,4 +217,180 @@ def get_logs_by_time_range(
                 success=False,
                 message="An error occured while fetching the logs"
             ).model_dump(),
-        )
\ No newline at end of file
+        )
+
+
+def search_filters(search: LogSearchRequest) -> list:
+    """
+    Conditions for the optional filters of a search.
+
+    The user, endpoint prefix and action filters each lead one of the (column, timestamp)
+    indexes on access_logs; success and the message substring are checked on the rows an
+    index selects.
+    """
+    filters = []
+    if search.user_id is not None:
+        filters.append(AccessLog.user_id == search.user_id)
+    if search.endpoint_prefix:
+        filters.append(AccessLog.endpoint.startswith(search.endpoint_prefix, autoescape=True))
+    if search.action is not None:
+        filters.append(AccessLog.action == search.action)
+    if search.success is not None:
+        filters.append(AccessLog.success == search.success)
+    if search.message_contains:
+        filters.append(AccessLog.message.contains(search.message_contains, autoescape=True))
+    return filters
+
+
+def search_statement(search: LogSearchRequest, *columns):
+    return time_range_statement(search, *columns).where(*search_filters(search))
+
+
+async def search_summary(db: AsyncSession, search: LogSearchRequest) -> dict:
+    """Number of matches in the whole range and the most frequent values of each facet column."""
+    where = [
+        AccessLog.timestamp >= search.start_time,
+        AccessLog.timestamp <= search.end_time,
+        *search_filters(search),
+    ]
+    count = (await db.execute(select(func.count()).select_from(AccessLog).where(*where))).scalar()
+    facets = {}
+    for name, column in FACET_COLUMNS.items():
+        rows = await db.execute(
+            select(column, func.count().label("count"))
+            .where(*where)
+            .group_by(column)
+            .order_by(func.count().desc(), column)
+            .limit(LOG_SEARCH_FACET_SIZE)
+        )
+        facets[name] = [{"value": value, "count": count} for value, count in rows]
+    return {"count": count, "facets": facets}
+
+
+async def search_logs_stream(search: LogSearchRequest):
+    """Every match through a server-side cursor on the async engine, as dicts."""
+    stmt = search_statement(search, *EXPORT_COLUMNS).execution_options(yield_per=EXPORT_FETCH_SIZE)
+    async with AsyncSessionLocal() as db:
+        async for row in await db.stream(stmt):
+            yield row._asdict()
+
+
+async def search_ndjson_lines(search: LogSearchRequest, summary: Optional[dict]):
+    if summary is not None:
+        yield json.dumps(summary) + "\n"
+    async for log in search_logs_stream(search):
+        log["timestamp"] = log["timestamp"].isoformat()
+        yield json.dumps(log) + "\n"
+
+
+async def search_csv_lines(search: LogSearchRequest):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.key for column in EXPORT_COLUMNS])
+    async for log in search_logs_stream(search):
+        writer.writerow([log[column.key] for column in EXPORT_COLUMNS])
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@router.post("/search", response_model=GeneralResponseSchema)
+async def search_logs(search: LogSearchRequest):
+    """
+    Search logs in a time range by user, endpoint prefix, action, outcome and message substring.
+
+    The JSON format returns the number of matches and facets (the most frequent endpoints,
+    users, actions and outcomes among them) with one page of logs and a `next_cursor`. The
+    ndjson format streams a first line with the count and facets, then every match; csv
+    streams the matches only. Counts and facets cover the whole range, not just the pages
+    after the cursor, so pass `facets: false` when paging.
+    """
+    validate_cursor(search.cursor)
+    get_async_engine()
+
+    if search.format == LogExportFormat.CSV:
+        body = await held_stream(search_stream_slot(), lambda: search_csv_lines(search))
+        return StreamingResponse(body, media_type="text/csv")
+    if search.format == LogExportFormat.NDJSON:
+        summary = None
+        # The stream slot is taken first, so a rejected stream does not run the summary.
+        # The lines only start, reading `summary`, once the response is sent
+        body = await held_stream(search_stream_slot(), lambda: search_ndjson_lines(search, summary))
+        if search.facets:
+            try:
+                async with async_admission.slot(), AsyncSessionLocal() as db:
+                    summary = await search_summary(db, search)
+            except BaseException:
+                await body.aclose()
+                raise
+        return StreamingResponse(body, media_type="application/x-ndjson")
+
+    try:
+        async with async_admission.slot(), AsyncSessionLocal() as db:
+            data = await search_summary(db, search) if search.facets else {}
+            logs = [
+                log.to_dict()
+                for log in (await db.execute(search_statement(search, AccessLog).limit(search.limit))).scalars()
+            ]
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(
+            status_code=500,
+            detail=ResponseSchema(
+                success=False,
+                message="An error occured while searching the logs"
+            ).model_dump(),
+        )
+    data["logs"] = logs
+    data["next_cursor"] = encode_cursor(logs[-1]) if len(logs) == search.limit else None
+    return GeneralResponseSchema(success=True, message="Logs retrieved successfully", data=data)
+
+
+
+@router.post("/stats/{granularity}", response_model=GeneralResponseSchema)
+def get_log_stats(
+    granularity: StatsGranularity,
+    stats: LogStatsRequest,
+    db: Session = Depends(get_db),
+):
+    """
+    Access counts per minute or hour, endpoint, action and outcome, read from the rollup tables.
+    """
+    model = ROLLUP_MODELS[granularity]
+    group_by = [model.bucket, model.endpoint, model.action, model.success]
+    query = (
+        select(*group_by, func.sum(model.count).label("count"))
+        .where(model.bucket >= stats.start_time)
+        .where(model.bucket <= stats.end_time)
+        .group_by(*group_by)
+        .order_by(*group_by)
+    )
+    if stats.endpoint is not None:
+        query = query.where(model.endpoint == stats.endpoint)
+    if stats.action is not None:
+        query = query.where(model.action == stats.action)
+    if stats.success is not None:
+        query = query.where(model.success == stats.success)
+    if stats.user_id is not None:
+        query = query.where(model.user_id == stats.user_id)
+
+    return GeneralResponseSchema(
+        success=True,
+        message="Stats retrieved successfully",
+        data={
+            "granularity": granularity.value,
+            "stats": [
+                {
+                    "bucket": row.bucket,
+                    "endpoint": row.endpoint,
+                    "action": row.action,
+                    "success": row.success,
+                    "count": int(row.count),
+                }
+                for row in db.execute(query)
+            ],
+        },
+    )
@@ -1,20 +1,44 @@
-from fastapi import APIRouter, Depends
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Depends, Request
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from schemas import GeneralResponseSchema
 from models import Permission
 from db import get_db
+from services.catalog import catalog_response
+from services.pagination import ListParams
 
 router = APIRouter()
 
 
+PERMISSION_FIELDS = {"id": Permission.id, "name": Permission.name}
+
+
 @router.get("/", response_model=GeneralResponseSchema)
-def get_permissions_list(db: Session = Depends(get_db)):
-    """Retrieve a list of all permissions."""
-    permissions = db.query(Permission).all()
+async def get_permissions_list(request: Request, params: ListParams = Depends(), db: Session = Depends(get_db)):
+    """
+    Retrieve a page of permissions ordered by id, selecting only the requested fields.
+
+    Responses carry a catalog ETag and are cached per catalog version.
+    """
+    fields = params.selected(list(PERMISSION_FIELDS))
+    return await catalog_response(request, db, lambda: permissions_page(db, params, fields))
+
+
+def permissions_page(db: Session, params: ListParams, fields) -> GeneralResponseSchema:
+    query = (
+        select(Permission.id, *[PERMISSION_FIELDS[field] for field in fields if field != "id"])
+        .order_by(Permission.id)
+        .limit(params.limit)
+    )
+    if params.cursor is not None:
+        query = query.where(Permission.id > params.cursor)
+    rows = db.execute(query).all()
     return GeneralResponseSchema(
         success=True,
         message="Data fetched successfully",
-        data={"result": [jsonable_encoder(permission) for permission in permissions]},
+        data={
+            "result": [{field: getattr(row, field) for field in fields} for row in rows],
+            "next_cursor": params.next_cursor([row.id for row in rows]),
+        },
     )
 
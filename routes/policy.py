@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Depends, Query, Response
+from sqlalchemy.orm import Session
+from db import get_db
+from services.helpers import allow_access
+from services.policy import POLICY_READ_PERMISSION, build_delta, build_snapshot
+
+router = APIRouter()
+
+POLICY_MEDIA_TYPE = "application/octet-stream"
+
+
+def policy_response(data: bytes, version: int) -> Response:
+    return Response(content=data, media_type=POLICY_MEDIA_TYPE, headers={"X-Policy-Version": str(version)})
+
+
+@router.get("/snapshot", response_class=Response, dependencies=[Depends(allow_access(permissions=[POLICY_READ_PERMISSION]))])
+def get_policy_snapshot(db: Session = Depends(get_db)):
+    """
+    Binary snapshot of every API key digest, role and permission, for services.policy_evaluator.
+    """
+    return policy_response(*build_snapshot(db))
+
+
+@router.get("/delta", response_class=Response, dependencies=[Depends(allow_access(permissions=[POLICY_READ_PERMISSION]))])
+def get_policy_delta(since: int = Query(..., ge=0), db: Session = Depends(get_db)):
+    """
+    Changes since policy version `since`, or a full snapshot if they are no longer available.
+    """
+    return policy_response(*build_delta(db, since))
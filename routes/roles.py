@@ -1,33 +1,76 @@
-from fastapi import APIRouter, Depends
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from schemas import AssignPermissionToRoleSchema, GeneralResponseSchema, ResponseSchema
-from models import Permission, Role
+from sqlalchemy import select
+from sqlalchemy.orm import Session, aliased, selectinload
+from schemas import (
+    AssignParentRolesSchema,
+    AssignPermissionToRoleSchema,
+    GeneralResponseSchema,
+    ResponseSchema,
+)
+from models import Permission, Role, role_closure
 from db import get_db
+from services.authz import permission_matrix
+from services.cache import publish_invalidation
+from services.catalog import catalog_response, publish_catalog_version
 from services.helpers import allow_access
+from services.hierarchy import RoleHierarchyError, set_parents
+from services.pagination import ListParams
+from services.policy import record_roles_change
 
 router = APIRouter()
 
 
+ROLE_FIELDS = ["id", "name", "permissions"]
+
+
 @router.get("/", response_model=GeneralResponseSchema)
-def get_roles_list(db: Session = Depends(get_db)):
-    """Retrieve a list of all roles."""
-    roles = db.query(Role).all()
+async def get_roles_list(request: Request, params: ListParams = Depends(), db: Session = Depends(get_db)):
+    """
+    Retrieve a page of roles ordered by id.
+
+    Permissions are only loaded when requested, for the whole page in one extra query.
+    Responses carry a catalog ETag and are cached per catalog version.
+    """
+    fields = params.selected(ROLE_FIELDS)
+    return await catalog_response(request, db, lambda: roles_page(db, params, fields))
+
+
+def roles_page(db: Session, params: ListParams, fields) -> GeneralResponseSchema:
+    query = db.query(Role).order_by(Role.id).limit(params.limit)
+    if "permissions" in fields:
+        query = query.options(selectinload(Role.permissions))
+    if params.cursor is not None:
+        query = query.filter(Role.id > params.cursor)
+    roles = query.all()
+
+    def serialize(role: Role) -> dict:
+        values = {"id": role.id, "name": role.name.value}
+        if "permissions" in fields:
+            values["permissions"] = [
+                {"id": permission.id, "name": permission.name} for permission in role.permissions
+            ]
+        return {field: values[field] for field in fields}
+
     return GeneralResponseSchema(
         success=True,
         message="Data fetched successfully",
-        data={"result": [jsonable_encoder(role) for role in roles]},
+        data={
+            "result": [serialize(role) for role in roles],
+            "next_cursor": params.next_cursor([role.id for role in roles]),
+        },
     )
 
 
-
-    
 @router.get("/{role_id}/permissions", response_model=GeneralResponseSchema)
-def list_permissions_for_role(role_id: str, db: Session = Depends(get_db)):
-    """List permissions assigned to a specific role."""
+async def list_permissions_for_role(role_id: str, request: Request, db: Session = Depends(get_db)):
+    """List permissions assigned to a specific role, with a catalog ETag."""
+    return await catalog_response(request, db, lambda: role_permissions(db, role_id))
+
+
+def role_permissions(db: Session, role_id: str):
     role = db.query(Role).filter_by(id=role_id).first()
-    
+
     if not role:
         return JSONResponse(
             status_code=404,
@@ -42,7 +85,7 @@ def list_permissions_for_role(role_id: str, db: Session = Depends(get_db)):
     return GeneralResponseSchema(
         success=True,
         message="Data fetched successfully",
-        data={"result": [jsonable_encoder(permission) for permission in permissions]},
+        data={"result": [{"id": permission.id, "name": permission.name} for permission in permissions]},
     )
 
 
@@ -50,6 +93,7 @@ def list_permissions_for_role(role_id: str, db: Session = Depends(get_db)):
 def assign_permissions(
     role_id: str,
     payload: AssignPermissionToRoleSchema,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
 ):
     """Assign permissions to a role."""
@@ -91,9 +135,79 @@ def assign_permissions(
 
     # Add only new permissions to the role
     role.permissions.extend(new_permissions)
+    version = record_roles_change(db)
     db.commit()
 
+    # Other workers reload this role's permissions into their matrix
+    permission_matrix.set_role_permissions(role.name.value, [perm.name for perm in role.permissions])
+    background_tasks.add_task(publish_invalidation, "role", role.name.value)
+    background_tasks.add_task(publish_catalog_version, version)
+
     return ResponseSchema(
         success=True,
         message=f"Added {len(new_permissions)} new permissions to role {str(role.name.value)}.",
     )
+
+
+@router.put("/{role_id}/parents", dependencies=[Depends(allow_access())])
+def assign_parent_roles(
+    role_id: int,
+    payload: AssignParentRolesSchema,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+):
+    """Replace the roles a role inherits from."""
+    role = db.query(Role).filter_by(id=role_id).first()
+    if not role:
+        return JSONResponse(
+            status_code=404,
+            content=ResponseSchema(
+                success=False,
+                message="Role not found",
+            ).model_dump(),
+        )
+
+    parents = db.query(Role).filter(Role.id.in_(payload.parent_ids)).all()
+    if len(parents) != len(set(payload.parent_ids)):
+        return JSONResponse(
+            status_code=404,
+            content=ResponseSchema(
+                success=False,
+                message="Some parent roles not found",
+            ).model_dump(),
+        )
+
+    try:
+        set_parents(db, role.id, payload.parent_ids)
+    except RoleHierarchyError as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail=ResponseSchema(success=False, message=str(e)).model_dump(),
+        )
+    record_roles_change(db)
+    db.commit()
+
+    # Effective roles and permissions changed for this role and everything inheriting from it
+    ancestor = aliased(Role)
+    permission_matrix.set_closure(
+        (child.value, inherited.value)
+        for child, inherited in db.execute(
+            select(Role.name, ancestor.name)
+            .select_from(role_closure)
+            .join(Role, Role.id == role_closure.c.role_id)
+            .join(ancestor, ancestor.id == role_closure.c.ancestor_id)
+        )
+    )
+    background_tasks.add_task(publish_invalidation, "hierarchy", role.name.value)
+
+    return GeneralResponseSchema(
+        success=True,
+        message=f"Updated parent roles of role {str(role.name.value)}.",
+        data={
+            "result": {
+                "parents": [parent.name.value for parent in parents],
+                "effective_roles": sorted(permission_matrix.effective_roles(role.name.value)),
+            }
+        },
+    )
@@ -0,0 +1,26 @@
+from dotenv import load_dotenv
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+from schemas import ResponseSchema
+from services.telemetry import render_metrics
+import hmac
+import os
+
+load_dotenv()
+
+# Bearer token required to scrape, if set. Leave unset when the endpoint is only reachable internally
+TELEMETRY_TOKEN = os.getenv("TELEMETRY_TOKEN", "")
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_telemetry(authorization: Optional[str] = Header(None)):
+    """Internal telemetry in the Prometheus text exposition format."""
+    if TELEMETRY_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {TELEMETRY_TOKEN}"):
+        raise HTTPException(
+            status_code=403,
+            detail=ResponseSchema(success=False, message="Invalid telemetry token").model_dump(),
+        )
+    return PlainTextResponse(await render_metrics(), media_type="text/plain; version=0.0.4")
@@ -1,5 +1,10 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload
+import json
+from tempfile import SpooledTemporaryFile
 from schemas import (
     CreateUserRequest,
     GeneralResponseSchema,
@@ -9,8 +14,18 @@ from schemas import (
     UserSchema,
 )
 from models import User, Role
-from db import get_db
-from services.helpers import generate_api_key
+from db import SessionLocal, get_db, get_engine
+from services.admission import sync_admission
+from services.cache import auth_cache, publish_invalidation
+from services.helpers import allow_access, generate_api_key
+from services.pagination import ListParams
+from services.policy import record_key_changes
+from services.provisioning import insert_chunk, load_role_ids, read_chunks, read_rows
+
+# Rows inserted per multi-row INSERT during bulk provisioning
+BULK_CHUNK_SIZE = 1000
+# Per-row results are kept in memory up to this size, then in a temporary file
+BULK_RESULTS_SPOOL_BYTES = 8 * 1024 * 1024
 
 router = APIRouter()
 
@@ -35,9 +50,11 @@ def create_user(user: CreateUserRequest, db: Session = Depends(get_db)):
             detail=ResponseSchema(success=False, message="Invalid Role").model_dump(),
         )
 
-    db_user = User(username=user.username, role_id=role.id, api_key=generate_api_key())
+    issued = generate_api_key()
+    db_user = User(username=user.username, role_id=role.id, key_id=issued.key_id, api_key_hash=issued.digest)
 
     db.add(db_user)
+    record_key_changes(db, [issued.key_id])
     db.commit()
 
     # Refresh to get ID
@@ -50,16 +67,88 @@ def create_user(user: CreateUserRequest, db: Session = Depends(get_db)):
             id=db_user.id,
             username=db_user.username,
             role=db_user.role.name,
-            api_key=db_user.api_key,
+            api_key=issued.api_key,
         ).model_dump(),
     )
 
 
+@router.post("/bulk", dependencies=[Depends(allow_access())])
+async def create_users_bulk(request: Request):
+    """
+    Create many users from a streamed NDJSON body (one {"username", "role"} object per line)
+    or a CSV body with a username,role header when sent as text/csv.
+
+    All rows are inserted in a single transaction while the body is read. The response
+    then streams one NDJSON result per input row, followed by a summary line saying
+    whether the transaction committed. Admin only, since rows may be for any role.
+    """
+    is_csv = request.headers.get("content-type", "").startswith("text/csv")
+
+    # The body must be consumed before the response starts: under ASGI spec < 2.4
+    # StreamingResponse listens for disconnects on the same receive channel and would
+    # swallow the remaining body chunks
+    results = SpooledTemporaryFile(max_size=BULK_RESULTS_SPOOL_BYTES, mode="w+")
+    created = failed = 0
+    seen = set()
+    get_engine()
+    async with sync_admission.slot():
+        db = SessionLocal()
+        try:
+            role_ids = await run_in_threadpool(load_role_ids, db)
+            async for chunk in read_chunks(read_rows(request.stream(), is_csv), BULK_CHUNK_SIZE):
+                for result in await run_in_threadpool(insert_chunk, db, role_ids, chunk, seen):
+                    if result["success"]:
+                        created += 1
+                    else:
+                        failed += 1
+                    results.write(json.dumps(result) + "\n")
+
+            await run_in_threadpool(db.commit)
+            summary = {"committed": True, "created": created, "failed": failed}
+        except Exception:
+            await run_in_threadpool(db.rollback)
+            summary = {"committed": False, "created": 0, "failed": created + failed}
+        finally:
+            await run_in_threadpool(db.close)
+
+    results.seek(0)
+    return StreamingResponse(bulk_result_lines(results, summary), media_type="application/x-ndjson")
+
+
+def bulk_result_lines(results, summary: dict):
+    """Stream the spooled per-row results in blocks, then the summary line."""
+    try:
+        while True:
+            block = results.read(64 * 1024)
+            if not block:
+                break
+            yield block
+        yield json.dumps(summary) + "\n"
+    finally:
+        results.close()
+
+
+USER_FIELDS = {"id": User.id, "username": User.username, "role": Role.name}
+
+
 @router.get("/", response_model=GeneralResponseSchema)
-def get_user_list(db: Session = Depends(get_db)):
-    """Retrieve a list of all users."""
+def get_user_list(params: ListParams = Depends(), db: Session = Depends(get_db)):
+    """
+    Retrieve a page of users ordered by id.
+
+    Only the requested `fields` are selected; the role name comes from the same joined query.
+    """
+    fields = params.selected(list(USER_FIELDS))
     # Query the users and join the Role table to get the role name
-    users = db.query(User).join(Role).all()
+    query = (
+        select(User.id, *[USER_FIELDS[field] for field in fields if field != "id"])
+        .join(Role, User.role_id == Role.id)
+        .order_by(User.id)
+        .limit(params.limit)
+    )
+    if params.cursor is not None:
+        query = query.where(User.id > params.cursor)
+    rows = db.execute(query).all()
 
     # Return a list of user data with role name instead of role ID
     return GeneralResponseSchema(
@@ -67,13 +156,10 @@ def get_user_list(db: Session = Depends(get_db)):
         message="Data fetched successfully",
         data={
             "result": [
-                UserResponseSchema(
-                    id=user.id,
-                    username=user.username,
-                    role=user.role.name,
-                ).model_dump()
-                for user in users
-            ]
+                {field: getattr(row, USER_FIELDS[field].key) for field in fields}
+                for row in rows
+            ],
+            "next_cursor": params.next_cursor([row.id for row in rows]),
         },
     )
 
@@ -82,7 +168,7 @@ def get_user_list(db: Session = Depends(get_db)):
 def get_user(user_id: int, db: Session = Depends(get_db)):
     """Retrieve a user."""
     # Query the users and join the Role table to get the role name
-    user = db.query(User).filter(User.id == user_id).join(Role).first()
+    user = db.query(User).options(joinedload(User.role)).filter(User.id == user_id).join(Role).first()
 
     if not user:
         raise HTTPException(
@@ -105,7 +191,12 @@ def get_user(user_id: int, db: Session = Depends(get_db)):
 
 
 @router.put("/{user_id}/role/", response_model=GeneralResponseSchema)
-def assign_role(user_id: int, payload: UpdateUserSchema, db: Session = Depends(get_db)):
+def assign_role(
+    user_id: int,
+    payload: UpdateUserSchema,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+):
     """Assign a predefined role to a user."""
 
     user = db.query(User).filter(User.id == user_id).first()
@@ -123,8 +214,13 @@ def assign_role(user_id: int, payload: UpdateUserSchema, db: Session = Depends(g
         )
 
     user.role_id = role_obj.id
+    record_key_changes(db, [user.key_id])
     db.commit()
     db.refresh(user)
+
+    # Drop the cached principal so the new role applies on the next request, here and on other workers
+    auth_cache.invalidate_user(user.id)
+    background_tasks.add_task(publish_invalidation, "user", user.id, key_id=user.key_id)
     return GeneralResponseSchema(
         success=True,
         message="User role updated successfully",
@@ -138,3 +234,36 @@ def assign_role(user_id: int, payload: UpdateUserSchema, db: Session = Depends(g
             ]
         },
     )
+
+
+@router.post("/{user_id}/api-key", response_model=GeneralResponseSchema, dependencies=[Depends(allow_access())])
+def rotate_api_key(user_id: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Issue a new API key for a user, revoking the current one."""
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(
+            status_code=404,
+            detail=ResponseSchema(success=False, message="User not found").model_dump(),
+        )
+
+    old_key_id = user.key_id
+    issued = generate_api_key()
+    user.key_id = issued.key_id
+    user.api_key_hash = issued.digest
+    record_key_changes(db, [old_key_id, issued.key_id])
+    db.commit()
+    db.refresh(user)
+
+    auth_cache.invalidate(old_key_id)
+    background_tasks.add_task(publish_invalidation, "user", user.id, key_id=old_key_id)
+
+    return GeneralResponseSchema(
+        success=True,
+        message="API key rotated successfully",
+        data=UserSchema(
+            id=user.id,
+            username=user.username,
+            role=user.role.name,
+            api_key=issued.api_key,
+        ).model_dump(),
+    )
@@ -1,5 +1,5 @@
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from enum import Enum
 from typing import Any, List, Optional
 
@@ -58,6 +58,10 @@ class AssignPermissionToRoleSchema(BaseModel):
     permission_ids: List[str]
 
 
+class AssignParentRolesSchema(BaseModel):
+    parent_ids: List[int]
+
+
 class ResponseSchema(BaseModel):
     success: bool
     message: str
@@ -83,6 +87,72 @@ class AccessLogSchema(BaseModel):
         from_attributes = True
 
 
+class LogExportFormat(str, Enum):
+    JSON = "json"
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
 class LogTimeRangeRequest(BaseModel):
     start_time: datetime
     end_time: datetime
+    # Page size for the JSON format; ndjson and csv stream every matching row
+    limit: int = Field(1000, ge=1, le=10000)
+    # Opaque next_cursor from the previous page
+    cursor: Optional[str] = None
+    format: LogExportFormat = LogExportFormat.JSON
+    # Also read days that were moved out of MySQL into the local archive
+    include_archived: bool = False
+
+
+class StatsGranularity(str, Enum):
+    MINUTE = "minute"
+    HOUR = "hour"
+
+
+class LogStatsRequest(BaseModel):
+    start_time: datetime
+    end_time: datetime
+    endpoint: Optional[str] = None
+    action: Optional[str] = None
+    success: Optional[bool] = None
+    # Restrict to one user; 0 selects anonymous access. Counts are summed over users otherwise
+    user_id: Optional[int] = None
+
+
+class AuthzCheck(BaseModel):
+    api_key: str
+    # Bounded by the access_logs columns they are logged to
+    endpoint: str = Field(..., max_length=255)
+    method: str = Field("GET", max_length=10)
+    # Same meaning as the arguments of allow_access: no roles means Admin only unless permissions are given
+    roles: Optional[List[str]] = None
+    permissions: Optional[List[str]] = None
+
+
+class AuthzCheckRequest(BaseModel):
+    checks: List[AuthzCheck] = Field(..., min_length=1, max_length=1000)
+
+
+class AuthzDecision(BaseModel):
+    allowed: bool
+    message: str
+    user_id: Optional[int] = None
+    role: Optional[str] = None
+
+
+class LogSearchRequest(BaseModel):
+    start_time: datetime
+    end_time: datetime
+    user_id: Optional[int] = None
+    endpoint_prefix: Optional[str] = None
+    action: Optional[str] = None
+    success: Optional[bool] = None
+    # Case sensitivity follows the column collation
+    message_contains: Optional[str] = None
+    # Page size for the JSON format; ndjson and csv stream every matching row
+    limit: int = Field(1000, ge=1, le=10000)
+    cursor: Optional[str] = None
+    format: LogExportFormat = LogExportFormat.JSON
+    # Return the total count and the most frequent values per field (not for csv)
+    facets: bool = True
@@ -0,0 +1,143 @@
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from schemas import ResponseSchema
+from services.telemetry import admission_rejections_total, admission_requests, checkout_listeners, collector
+from typing import AsyncContextManager, AsyncIterable, AsyncIterator, Callable
+import asyncio
+import math
+import os
+import time
+
+load_dotenv()
+
+# Pool sizes live here so the pools, the admission limits and the threadpool are sized together
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "5"))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "10"))
+# Threads for sync routes: one per admitted database request plus headroom for routes without one
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", str(DB_POOL_SIZE + DB_MAX_OVERFLOW + 10)))
+
+# Requests allowed to wait for a slot once every connection is in use, and for how long
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "50"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1"))
+# Shed new requests while the recent pool checkout wait is above this
+ADMISSION_MAX_POOL_WAIT_MS = float(os.getenv("ADMISSION_MAX_POOL_WAIT_MS", "250"))
+# The recorded pool wait halves every this many seconds without a new checkout
+POOL_WAIT_HALF_LIFE = 1.0
+
+
+class AdmissionController:
+    """
+    Caps the requests doing database work on one engine at the size of its pool.
+
+    Requests beyond that wait in a short bounded queue, and are answered with a fast 503
+    and Retry-After when the queue is full, when they waited ADMISSION_QUEUE_TIMEOUT, or
+    when pool checkouts have recently been slow (other users of the pool such as
+    background tasks are not admitted here, so the pool can be saturated regardless). A
+    spike then costs some clients a retry instead of every client a 30 second pool timeout.
+    """
+
+    def __init__(
+        self,
+        engine: str,
+        capacity: int,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+        max_pool_wait: float = ADMISSION_MAX_POOL_WAIT_MS / 1000,
+    ):
+        self.engine = engine
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.max_pool_wait = max_pool_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self._pool_wait = 0.0
+        self._pool_wait_at = 0.0
+        self._slots = asyncio.Semaphore(capacity)
+        checkout_listeners.setdefault(engine, []).append(self.record_pool_wait)
+
+    def record_pool_wait(self, seconds: float):
+        """Fold one checkout wait into the moving average. Called from pool threads."""
+        self._pool_wait = 0.8 * self.pool_wait() + 0.2 * seconds
+        self._pool_wait_at = time.monotonic()
+
+    def pool_wait(self) -> float:
+        """Recent checkout wait, decaying while there are no checkouts so shedding stops by itself."""
+        idle = time.monotonic() - self._pool_wait_at
+        return self._pool_wait * 0.5 ** (idle / POOL_WAIT_HALF_LIFE)
+
+    def reject(self, reason: str):
+        admission_rejections_total.inc(self.engine, reason)
+        retry_after = max(1, math.ceil(self.pool_wait() + self.queue_timeout))
+        raise HTTPException(
+            status_code=503,
+            detail=ResponseSchema(success=False, message="Server is busy, retry later").model_dump(),
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the engine's slots for the duration of the block, or raise a 503."""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self):
+        if self.pool_wait() > self.max_pool_wait:
+            self.reject("pool_wait")
+
+        if self._slots.locked():
+            if self.waiting >= self.queue_size:
+                self.reject("queue_full")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.reject("queue_timeout")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+
+sync_admission = AdmissionController("sync", DB_POOL_SIZE + DB_MAX_OVERFLOW)
+async_admission = AdmissionController("async", ASYNC_DB_POOL_SIZE + ASYNC_DB_MAX_OVERFLOW)
+
+
+async def held_stream(slot: AsyncContextManager, lines: Callable[[], AsyncIterable]) -> AsyncIterator:
+    """
+    Enter `slot`, which may raise a 503, and return a response body streaming `lines()`
+    that leaves the slot once it is done.
+
+    The slot is taken before the response starts, so a rejection is still an error
+    response. The body has already started running, so it also leaves the slot when the
+    response is dropped without ever iterating it.
+    """
+    body = holding(slot, lines)
+    await body.__anext__()
+    return body
+
+
+async def holding(slot: AsyncContextManager, lines: Callable[[], AsyncIterable]) -> AsyncIterator:
+    async with slot:
+        yield
+        async for line in lines():
+            yield line
+
+
+@collector
+async def collect_admission():
+    for controller in (sync_admission, async_admission):
+        admission_requests.set(controller.in_flight, controller.engine, "in_flight")
+        admission_requests.set(controller.waiting, controller.engine, "waiting")
@@ -3,6 +3,8 @@ from sqlalchemy.orm import Session
 from fastapi.security import APIKeyHeader
 from db import get_db
 from models import User
+from services.helpers import hash_api_key_secret, parse_api_key
+import hmac
 
 # Dependency to get API key from headers
 api_key_header = APIKeyHeader(name="Authorization")
@@ -10,7 +12,8 @@ api_key_header = APIKeyHeader(name="Authorization")
 
 def get_user_by_api_key(api_key: str = Depends(api_key_header), db: Session = Depends(get_db)) -> User:
     """Query the database to find the user associated with the provided API key"""
-    user = db.query(User).filter_by(api_key=api_key).first()
-    if not user:
+    parsed = parse_api_key(api_key)
+    user = db.query(User).filter_by(key_id=parsed[0]).first() if parsed else None
+    if not user or not hmac.compare_digest(user.api_key_hash, hash_api_key_secret(parsed[1])):
         raise HTTPException(status_code=403, detail="Invalid API Key")
     return user
\ No newline at end of file
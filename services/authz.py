@@ -0,0 +1,149 @@
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+import threading
+
+from models import Permission, Role, RoleEnum, role_closure, role_permission
+from services.log import AsyncSessionLocal
+
+# Holds every role and every permission regardless of the hierarchy
+SUPERUSER_ROLE = RoleEnum.ADMIN.value
+ALL_PERMISSIONS = -1  # All bits set, so ALL_PERMISSIONS & mask == mask for any mask
+
+
+class PermissionMatrix:
+    """
+    Precompiled role to permission matrix.
+
+    Every permission name gets a bit index and every role an integer mask of the
+    permissions granted to it, so checking a set of permissions is a single AND. Bit
+    indexes are never reassigned, so masks computed earlier stay valid across reloads.
+
+    Role inheritance is folded in ahead of time: for each role the matrix keeps its
+    effective roles (from the role_closure table) and the OR of their masks, so an
+    authorization check is one dict lookup.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._bits: Dict[str, int] = {}
+        self._role_masks: Dict[str, int] = {}
+        self._ancestors: Dict[str, FrozenSet[str]] = {}
+        self._effective: Dict[str, Tuple[FrozenSet[str], int]] = {}
+        self._lock = threading.Lock()
+
+    def _bit(self, permission: str) -> int:
+        # Callers hold the lock
+        if permission not in self._bits:
+            self._bits[permission] = 1 << len(self._bits)
+        return self._bits[permission]
+
+    def _recompute(self):
+        # Callers hold the lock
+        all_roles = frozenset(role.value for role in RoleEnum)
+        effective = {}
+        for role in all_roles | set(self._role_masks) | set(self._ancestors):
+            if role == SUPERUSER_ROLE:
+                effective[role] = (all_roles, ALL_PERMISSIONS)
+                continue
+            roles = self._ancestors.get(role, frozenset()) | {role}
+            mask = 0
+            for inherited in roles:
+                mask |= self._role_masks.get(inherited, 0)
+            effective[role] = (frozenset(roles), mask)
+        self._effective = effective
+
+    def mask_for(self, permissions: Iterable[str]) -> Optional[int]:
+        """Mask requiring all the given permissions, or None if one of them does not exist."""
+        mask = 0
+        for permission in permissions:
+            bit = self._bits.get(permission)
+            if bit is None:
+                return None
+            mask |= bit
+        return mask
+
+    def effective_roles(self, role: str) -> FrozenSet[str]:
+        return self._effective.get(role, (frozenset({role}), 0))[0]
+
+    def authorizes(self, role: str, roles: Optional[FrozenSet[str]], mask: Optional[int]) -> bool:
+        """
+        Whether the role is, or inherits, one of `roles` (None means any role) and holds
+        every permission in `mask` (None means a required permission does not exist).
+        """
+        if mask is None:
+            return False
+        effective_roles, effective_mask = self._effective.get(role, (frozenset({role}), 0))
+        if roles is not None and roles.isdisjoint(effective_roles):
+            return False
+        return effective_mask & mask == mask
+
+    def set_role_permissions(self, role: str, permissions: Iterable[str]):
+        """Replace a single role's row of the matrix."""
+        with self._lock:
+            mask = 0
+            for permission in permissions:
+                mask |= self._bit(permission)
+            self._role_masks[role] = mask
+            self._recompute()
+
+    def set_closure(self, pairs: Iterable[Tuple[str, str]]):
+        """Replace the role hierarchy with (role, ancestor) pairs from role_closure."""
+        ancestors: Dict[str, set] = {}
+        for role, ancestor in pairs:
+            ancestors.setdefault(role, set()).add(ancestor)
+        with self._lock:
+            self._ancestors = {role: frozenset(names) for role, names in ancestors.items()}
+            self._recompute()
+
+    async def load(self):
+        """Rebuild the whole matrix from the permission, role_permission and role_closure tables."""
+        ancestor = aliased(Role)
+        async with AsyncSessionLocal() as db:
+            permission_names = (await db.execute(select(Permission.name).order_by(Permission.id))).scalars().all()
+            grants = (
+                await db.execute(
+                    select(Role.name, Permission.name)
+                    .select_from(role_permission)
+                    .join(Role, Role.id == role_permission.c.role_id)
+                    .join(Permission, Permission.id == role_permission.c.permission_id)
+                )
+            ).all()
+            closure = (
+                await db.execute(
+                    select(Role.name, ancestor.name)
+                    .select_from(role_closure)
+                    .join(Role, Role.id == role_closure.c.role_id)
+                    .join(ancestor, ancestor.id == role_closure.c.ancestor_id)
+                )
+            ).all()
+
+        with self._lock:
+            for name in permission_names:
+                self._bit(name)
+            role_masks: Dict[str, int] = {}
+            for role, permission in grants:
+                role_masks[role.value] = role_masks.get(role.value, 0) | self._bit(permission)
+            self._role_masks = role_masks
+            ancestors: Dict[str, set] = {}
+            for role, inherited in closure:
+                ancestors.setdefault(role.value, set()).add(inherited.value)
+            self._ancestors = {role: frozenset(names) for role, names in ancestors.items()}
+            self._recompute()
+            self.loaded = True
+
+    async def reload_role(self, role: str):
+        """Reload one role's permissions, e.g. after another worker changed them."""
+        async with AsyncSessionLocal() as db:
+            permissions = (
+                await db.execute(
+                    select(Permission.name)
+                    .join(role_permission, Permission.id == role_permission.c.permission_id)
+                    .join(Role, Role.id == role_permission.c.role_id)
+                    .where(Role.name == role)
+                )
+            ).scalars().all()
+        self.set_role_permissions(role, permissions)
+
+
+permission_matrix = PermissionMatrix()
@@ -0,0 +1,261 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from typing import Dict, List, NamedTuple, Optional
+from services.authz import permission_matrix
+from services.log import LOG_PUSH_BUDGET_MS
+from services.redis import get_redis, redis_breaker
+from services.telemetry import auth_cache_entries, auth_cache_evictions_total, auth_cache_lookups_total, collector
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+SHARED_AUTH_CACHE_TTL = float(os.getenv("SHARED_AUTH_CACHE_TTL", "300"))
+
+# Redis hash of resolved principals keyed by API key id, shared by every worker
+AUTH_PRINCIPALS_KEY = "auth_principals"
+# Pub/sub channel carrying invalidations for the per-process caches
+AUTH_INVALIDATION_CHANNEL = "auth_invalidations"
+# Shared tier commands slower than this are abandoned like failed ones
+SHARED_AUTH_CACHE_BUDGET = LOG_PUSH_BUDGET_MS / 1000
+
+
+class Principal(NamedTuple):
+    """Compact, immutable view of an authenticated user used for authorization checks."""
+
+    user_id: int
+    role: str  # Permissions and inherited roles come from the permission matrix
+    key_digest: bytes  # Digest of the API key secret, checked on every request
+
+
+class AuthCache:
+    """
+    Bounded in-process cache from API key id to Principal with TTL and LRU eviction.
+
+    Lookups happen on the event loop while invalidations come from sync routes running
+    in the threadpool, so every operation takes the same lock.
+    """
+
+    def __init__(self, maxsize: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, tuple[float, Principal]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key_id: str) -> Optional[Principal]:
+        """Return the cached principal for a key, or None if missing or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, principal = entry
+            if expires_at <= now:
+                del self._entries[key_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_id)
+            self.hits += 1
+            return principal
+
+    def set(self, key_id: str, principal: Principal):
+        """Cache a principal, evicting the least recently used entries when full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key_id] = (time.monotonic() + self.ttl, principal)
+            self._entries.move_to_end(key_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key_id: str):
+        """Drop a single key."""
+        with self._lock:
+            self._entries.pop(key_id, None)
+
+    def invalidate_user(self, user_id: int):
+        """Drop every entry that resolves to the given user."""
+        with self._lock:
+            for key in [k for k, (_, p) in self._entries.items() if p.user_id == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+auth_cache = AuthCache()
+
+
+@collector
+async def collect_auth_cache():
+    stats = auth_cache.stats()
+    auth_cache_lookups_total.set_total(stats["hits"], "hit")
+    auth_cache_lookups_total.set_total(stats["misses"], "miss")
+    auth_cache_evictions_total.set_total(stats["evictions"])
+    auth_cache_entries.set(stats["size"])
+
+
+def decode_shared_principal(raw: bytes) -> Optional[Principal]:
+    """Turn a shared tier entry into a Principal, or None if it has expired."""
+    entry = json.loads(raw)
+    if entry["expires_at"] <= time.time():
+        return None
+    return Principal(
+        user_id=entry["user_id"],
+        role=entry["role"],
+        key_digest=bytes.fromhex(entry["key_digest"]),
+    )
+
+
+def encode_shared_principal(principal: Principal) -> str:
+    return json.dumps({
+        "user_id": principal.user_id,
+        "role": principal.role,
+        "key_digest": principal.key_digest.hex(),
+        "expires_at": time.time() + SHARED_AUTH_CACHE_TTL,
+    })
+
+
+async def get_shared_principal(key_id: str) -> Optional[Principal]:
+    """
+    Read a principal from the shared Redis tier, or None if missing or expired.
+
+    The shared tier is only a cache: while Redis is unavailable or slower than
+    LOG_PUSH_BUDGET_MS, or redis_breaker is open, lookups fall through to MySQL.
+    """
+    if redis_breaker.open:
+        return None
+    try:
+        raw = await asyncio.wait_for(get_redis().hget(AUTH_PRINCIPALS_KEY, key_id), SHARED_AUTH_CACHE_BUDGET)
+        if not raw:
+            return None
+        principal = decode_shared_principal(raw)
+        if not principal:
+            await asyncio.wait_for(get_redis().hdel(AUTH_PRINCIPALS_KEY, key_id), SHARED_AUTH_CACHE_BUDGET)
+        return principal
+    except (RedisError, asyncio.TimeoutError) as e:
+        logger.warning("Shared auth cache unavailable: %r", e)
+        redis_breaker.trip()
+        return None
+
+
+async def get_shared_principals(key_ids: List[str]) -> Dict[str, Principal]:
+    """Read several principals from the shared Redis tier in one call, skipping missing and expired ones."""
+    if not key_ids or redis_breaker.open:
+        return {}
+    try:
+        values = await asyncio.wait_for(get_redis().hmget(AUTH_PRINCIPALS_KEY, key_ids), SHARED_AUTH_CACHE_BUDGET)
+    except (RedisError, asyncio.TimeoutError) as e:
+        logger.warning("Shared auth cache unavailable: %r", e)
+        redis_breaker.trip()
+        return {}
+    principals = {}
+    for key_id, raw in zip(key_ids, values):
+        principal = decode_shared_principal(raw) if raw else None
+        if principal:
+            principals[key_id] = principal
+    return principals
+
+
+async def set_shared_principal(key_id: str, principal: Principal):
+    """Store a principal in the shared Redis tier, if Redis is available."""
+    if redis_breaker.open:
+        return
+    try:
+        await asyncio.wait_for(
+            get_redis().hset(AUTH_PRINCIPALS_KEY, key_id, encode_shared_principal(principal)),
+            SHARED_AUTH_CACHE_BUDGET,
+        )
+    except (RedisError, asyncio.TimeoutError) as e:
+        logger.warning("Shared auth cache unavailable: %r", e)
+        redis_breaker.trip()
+
+
+async def set_shared_principals(principals: Dict[str, Principal]):
+    """Store several principals in the shared Redis tier in one call, if Redis is available."""
+    if not principals or redis_breaker.open:
+        return
+    try:
+        await asyncio.wait_for(
+            get_redis().hset(
+                AUTH_PRINCIPALS_KEY,
+                mapping={key_id: encode_shared_principal(principal) for key_id, principal in principals.items()},
+            ),
+            SHARED_AUTH_CACHE_BUDGET,
+        )
+    except (RedisError, asyncio.TimeoutError) as e:
+        logger.warning("Shared auth cache unavailable: %r", e)
+        redis_breaker.trip()
+
+
+async def publish_invalidation(kind: str, value, key_id: Optional[str] = None):
+    """
+    Tell every worker about a change to a user or to the role grants.
+
+    kind is "user" (value is a user id), whose stale principal is also dropped from the
+    shared tier, "role" (value is a role name) or "hierarchy". Principals only name their
+    role, so role and hierarchy changes just reload the permission matrix.
+    """
+    if kind == "user" and key_id:
+        await get_redis().hdel(AUTH_PRINCIPALS_KEY, key_id)
+    await get_redis().publish(AUTH_INVALIDATION_CHANNEL, json.dumps({"kind": kind, "value": value}))
+
+
+def apply_invalidation(message: dict):
+    """Apply an invalidation message to the in-process cache."""
+    if message["kind"] == "user":
+        auth_cache.invalidate_user(message["value"])
+
+
+async def listen_for_invalidations():
+    """
+    Background task that subscribes to auth invalidations for this worker.
+    """
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(AUTH_INVALIDATION_CHANNEL)
+            # Anything may have changed while we were not subscribed
+            auth_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                invalidation = json.loads(message["data"])
+                apply_invalidation(invalidation)
+                if invalidation["kind"] == "role":
+                    await permission_matrix.reload_role(invalidation["value"])
+                elif invalidation["kind"] == "hierarchy":
+                    await permission_matrix.load()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Auth invalidation subscription failed, reconnecting")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
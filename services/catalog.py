@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from redis.exceptions import RedisError
+from sqlalchemy.orm import Session
+from typing import Any, Callable
+from services.log import LOG_PUSH_BUDGET_MS
+from services.policy import roles_version
+from services.redis import get_redis, redis_breaker
+import asyncio
+import logging
+import os
+import threading
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Redis copy of the catalog version, the id of the last "roles" policy change (see
+# services/policy.py), which writes to role grants insert in their own transaction. It
+# expires so a version lost while Redis was down, or after a Redis restart, is read again
+# from MySQL; versions never go back, so an old ETag cannot match a newer catalog.
+CATALOG_VERSION_KEY = "catalog_version"
+CATALOG_VERSION_TTL = int(os.getenv("CATALOG_VERSION_TTL", "5"))
+CATALOG_VERSION_BUDGET = LOG_PUSH_BUDGET_MS / 1000
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "256"))
+
+
+class CatalogBodyCache:
+    """Bounded LRU of serialized response bodies keyed by (catalog version, URL)."""
+
+    def __init__(self, maxsize: int = CATALOG_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._bodies: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+            return body
+
+    def set(self, key: tuple, body: bytes):
+        with self._lock:
+            self._bodies[key] = body
+            while len(self._bodies) > self.maxsize:
+                self._bodies.popitem(last=False)
+
+
+catalog_cache = CatalogBodyCache()
+
+
+async def get_catalog_version(db: Session) -> int:
+    """
+    The current catalog version, from Redis or else from MySQL.
+
+    Redis commands slower than LOG_PUSH_BUDGET_MS are abandoned like failed ones, and
+    Redis is skipped while redis_breaker is open. A version read from MySQL is only stored
+    if Redis has none, so it never overwrites a newer one published meanwhile.
+    """
+    if redis_breaker.open:
+        return await run_in_threadpool(roles_version, db)
+    try:
+        cached = await asyncio.wait_for(get_redis().get(CATALOG_VERSION_KEY), CATALOG_VERSION_BUDGET)
+        if cached is not None:
+            return int(cached)
+    except (RedisError, asyncio.TimeoutError) as e:
+        logger.warning("Catalog version cache unavailable: %r", e)
+        redis_breaker.trip()
+        return await run_in_threadpool(roles_version, db)
+
+    version = await run_in_threadpool(roles_version, db)
+    try:
+        await asyncio.wait_for(
+            get_redis().set(CATALOG_VERSION_KEY, version, ex=CATALOG_VERSION_TTL, nx=True), CATALOG_VERSION_BUDGET
+        )
+    except (RedisError, asyncio.TimeoutError) as e:
+        logger.warning("Catalog version cache unavailable: %r", e)
+    return version
+
+
+async def publish_catalog_version(version: int):
+    """Invalidate every cached catalog response and ETag, on all workers, once `version` is committed."""
+    try:
+        await asyncio.wait_for(
+            get_redis().set(CATALOG_VERSION_KEY, version, ex=CATALOG_VERSION_TTL), CATALOG_VERSION_BUDGET
+        )
+    except (RedisError, asyncio.TimeoutError) as e:
+        # Workers read the version from MySQL again once the cached one expires
+        logger.warning("Could not publish catalog version %s: %r", version, e)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+async def catalog_response(request: Request, db: Session, build: Callable[[], Any]) -> Response:
+    """
+    Serve a catalog read with an ETag derived from the catalog version.
+
+    Returns 304 when the client already has the current version, otherwise a cached body
+    for this URL and version, and only calls build (in the threadpool) on a miss. The
+    version is read before building so a body is never cached under a newer version than
+    the data it was built from. Responses that build returns directly, like a 404, are
+    passed through uncached.
+    """
+    version = await get_catalog_version(db)
+    etag = f'"catalog-{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    key = (version, request.url.path, request.url.query)
+    body = catalog_cache.get(key)
+    if body is None:
+        result = await run_in_threadpool(build)
+        if isinstance(result, Response):
+            return result
+        body = JSONResponse(content=jsonable_encoder(result)).body
+        catalog_cache.set(key, body)
+    return Response(content=body, media_type="application/json", headers=headers)
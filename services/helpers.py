@@ -1,33 +1,220 @@
 from datetime import datetime
 import json
-from db import get_db
-from fastapi import Depends, HTTPException, Request
+from fastapi import Depends, HTTPException, Request, Response
 from fastapi.security import APIKeyHeader
 from models import Role, User
 from schemas import ResponseSchema
-from sqlalchemy.orm import Session
-from typing import List, Optional
-from services.redis import redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple, Union
+from services.admission import async_admission
+from services.authz import SUPERUSER_ROLE, permission_matrix
+from services.cache import (
+    Principal,
+    auth_cache,
+    get_shared_principal,
+    get_shared_principals,
+    set_shared_principal,
+    set_shared_principals,
+)
+from services.log import LOG_ENTRY_FORMAT, AsyncSessionLocal
+from services.log_record import encode_log_entry
+from services.log_buffer import log_buffer
+from services.policy_evaluator import split_api_key
+from services.ratelimit import limit_and_log
+from services.telemetry import access_decisions_total, access_phase_seconds, log_access_seconds, principal_lookups_total
+from dotenv import load_dotenv
+import hashlib
+import hmac
+import os
 import secrets
-import string
+import time
+
+load_dotenv()
 
 api_key_header = APIKeyHeader(name="Authorization")
 
+API_KEY_ID_BYTES = 6  # Rendered as 12 hex characters
+API_KEY_SECRET_BYTES = 32
+# Optional server-side secret mixed into the digests, so a leaked users table alone cannot be brute forced
+API_KEY_PEPPER = os.getenv("API_KEY_PEPPER", "").encode()
+
+
+class IssuedApiKey(NamedTuple):
+    api_key: str  # Shown to the user once, never stored
+    key_id: str
+    digest: bytes
+
+
+def hash_api_key_secret(secret: str) -> bytes:
+    """Fixed-length digest of the secret part of an API key"""
+    return hmac.new(API_KEY_PEPPER, secret.encode(), hashlib.sha256).digest()
+
+
+def generate_api_key() -> IssuedApiKey:
+    """Returns a cryptographically secure API key of the form <key id>.<secret>"""
+    key_id = secrets.token_hex(API_KEY_ID_BYTES)
+    secret = secrets.token_urlsafe(API_KEY_SECRET_BYTES)
+    return IssuedApiKey(api_key=f"{key_id}.{secret}", key_id=key_id, digest=hash_api_key_secret(secret))
+
+
+def generate_api_keys(count: int) -> List[IssuedApiKey]:
+    """Returns `count` API keys like generate_api_key"""
+    return [generate_api_key() for _ in range(count)]
+
+
+def parse_api_key(api_key: str) -> Optional[Tuple[str, str]]:
+    """Split a presented API key into (key id, secret), or None if it is not well formed"""
+    # Also accepts legacy keys migrated by `python db.py`, until they are rotated
+    return split_api_key(api_key, API_KEY_PEPPER)
+
+
+def to_principal(user: User) -> Principal:
+    role: Role = user.role
+    return Principal(
+        user_id=user.id,
+        role=role.name.value,
+        key_digest=user.api_key_hash,
+    )
+
 
-def generate_api_key(length: int = 32) -> str:
-    """Returns a cryptographically secure API key"""
-    # Define the characters that can be used in the API key (uppercase, lowercase, digits, and special characters)
-    characters = string.ascii_letters + string.digits + string.punctuation
-    # Generate a secure random API key
-    api_key = "".join(secrets.choice(characters) for _ in range(length))
-    return api_key
+async def load_principal(db: AsyncSession, key_id: str) -> Optional[Principal]:
+    """Query MySQL for the user behind an API key id, with the role joined into the same query."""
+    result = await db.execute(
+        select(User)
+        .options(joinedload(User.role))
+        .where(User.key_id == key_id)
+    )
+    user = result.unique().scalars().first()
+    if not user:
+        return None
+    return to_principal(user)
 
 
-def allow_access(allowed_roles: Optional[List[str]] = []):
+async def load_principals(db: AsyncSession, key_ids: List[str]) -> Dict[str, Principal]:
+    """Query MySQL for the users behind several API key ids in one statement."""
+    result = await db.execute(
+        select(User)
+        .options(joinedload(User.role))
+        .where(User.key_id.in_(key_ids))
+    )
+    return {user.key_id: to_principal(user) for user in result.unique().scalars()}
+
+
+async def find_principal(key_id: str) -> Optional[Principal]:
+    """
+    Resolve an API key id to a Principal.
+
+    Lookups go through the in-process cache, then the shared Redis tier, then MySQL on
+    the async engine so a miss never blocks the event loop. The caches are keyed by key id
+    and only hold the secret's digest, never the plaintext key.
+    """
+    started = time.perf_counter()
+    principal = auth_cache.get(key_id)
+    if principal:
+        access_phase_seconds.observe(time.perf_counter() - started, "local_cache")
+        principal_lookups_total.inc("local")
+        return principal
+
+    started = time.perf_counter()
+    principal = await get_shared_principal(key_id)
+    access_phase_seconds.observe(time.perf_counter() - started, "shared_cache")
+    if principal:
+        auth_cache.set(key_id, principal)
+        principal_lookups_total.inc("shared")
+        return principal
+
+    started = time.perf_counter()
+    async with async_admission.slot(), AsyncSessionLocal() as db:
+        principal = await load_principal(db, key_id)
+    access_phase_seconds.observe(time.perf_counter() - started, "database")
+    if not principal:
+        principal_lookups_total.inc("missing")
+        return None
+    principal_lookups_total.inc("database")
+
+    auth_cache.set(key_id, principal)
+    await set_shared_principal(key_id, principal)
+    return principal
+
+
+async def get_principal(key_id: str, secret: str) -> Optional[Principal]:
+    """Resolve an API key split by parse_api_key to a Principal, or None if the key is not valid."""
+    principal = await find_principal(key_id)
+    if not principal:
+        return None
+    started = time.perf_counter()
+    valid = hmac.compare_digest(principal.key_digest, hash_api_key_secret(secret))
+    access_phase_seconds.observe(time.perf_counter() - started, "verify_key")
+    return principal if valid else None
+
+
+async def find_principals(key_ids: List[str]) -> Dict[str, Principal]:
+    """
+    Resolve many API key ids at once through the same tiers as find_principal.
+
+    Each tier is asked only for the ids the previous ones missed: one HMGET for the shared
+    tier and one IN query for MySQL. Unknown ids are left out of the result.
+    """
+    principals = {}
+    missing = []
+    for key_id in dict.fromkeys(key_ids):
+        principal = auth_cache.get(key_id)
+        if principal:
+            principals[key_id] = principal
+        else:
+            missing.append(key_id)
+
+    shared = await get_shared_principals(missing)
+    for key_id, principal in shared.items():
+        auth_cache.set(key_id, principal)
+    principals.update(shared)
+
+    missing = [key_id for key_id in missing if key_id not in shared]
+    if missing:
+        async with async_admission.slot(), AsyncSessionLocal() as db:
+            loaded = await load_principals(db, missing)
+        for key_id, principal in loaded.items():
+            auth_cache.set(key_id, principal)
+        await set_shared_principals(loaded)
+        principals.update(loaded)
+    return principals
+
+
+def required_roles_for(allowed_roles: Optional[List[str]], permissions: Optional[List[str]]) -> Optional[FrozenSet[str]]:
+    """
+    Roles a caller must hold or inherit, or None if any role will do.
+
+    "*" in `allowed_roles` allows any valid user. Without `allowed_roles` only Admins
+    pass, unless `permissions` are given, in which case any role holding all of them passes.
+    """
+    if (allowed_roles and "*" in allowed_roles) or (permissions and not allowed_roles):
+        return None
+    return frozenset(allowed_roles or [SUPERUSER_ROLE])
+
+
+def allow_access(allowed_roles: Optional[List[str]] = None, permissions: Optional[List[str]] = None):
+    """
+    Build a dependency that authorizes the caller by role and, optionally, by permission.
+
+    A user passes the role check if their role is, or inherits from, one of `allowed_roles`
+    (see required_roles_for) and holds every permission in `permissions`.
+    """
+    required_roles = required_roles_for(allowed_roles, permissions)
+    required_mask = None if permissions else 0
+
+    def is_authorized(role: str) -> bool:
+        nonlocal required_mask
+        if required_mask is None:
+            # Permissions unknown so far stay None and are looked up again next time
+            required_mask = permission_matrix.mask_for(permissions)
+        return permission_matrix.authorizes(role, required_roles, required_mask)
+
     async def access_dependency(
         request: Request,
+        response: Response,
         api_key: str = Depends(api_key_header),  # Extract API key from headers
-        db: Session = Depends(get_db),
     ):
         """
         Validate API key and user access to the endpoint.
@@ -35,9 +222,13 @@ def allow_access(allowed_roles: Optional[List[str]] = []):
         endpoint = request.url.path
         method = request.method
         # Validate API key
-        user = db.query(User).filter_by(api_key=api_key).first()
+        started = time.perf_counter()
+        parsed = parse_api_key(api_key)
+        user = await get_principal(*parsed) if parsed else None
+        access_phase_seconds.observe(time.perf_counter() - started, "principal")
         if not user:
-            await log_access(db, None, endpoint, method, success=False, message="Invalid API key")
+            access_decisions_total.inc("invalid_key")
+            await log_access(None, endpoint, method, success=False, message="Invalid API key")
             raise HTTPException(
                 status_code=403,
                 detail=ResponseSchema(
@@ -45,31 +236,74 @@ def allow_access(allowed_roles: Optional[List[str]] = []):
                 ).model_dump(),
             )
 
-        # Check user's role
-        role: Role = user.role
+        if not permission_matrix.loaded:
+            await permission_matrix.load()
 
-        if role.name == "Admin" or "*" in allowed_roles:
-            await log_access(db, user.id, endpoint, method, success=True, message="")
-            return user
+        # Check user's role, including inherited roles and permissions
+        started = time.perf_counter()
+        authorized = is_authorized(user.role)
+        access_phase_seconds.observe(time.perf_counter() - started, "authorize")
+        message = "" if authorized else "Insufficient privileges"
 
-        if role.name not in allowed_roles:
-            await log_access(db, user.id, endpoint, method, success=False, message="Insufficient privileges")
+        # Denied requests count against the limit too; the same call queues the log entry.
+        # Buckets are named by key id, never by the key: a legacy key is its own secret
+        limit = await limit_and_log(
+            parsed[0],
+            user.role,
+            access_log_entry(user.user_id, endpoint, method, authorized, message),
+            access_log_entry(user.user_id, endpoint, method, False, "Rate limit exceeded"),
+        )
+        if limit is None:
+            await log_access(user.user_id, endpoint, method, success=authorized, message=message)
+        elif not limit.allowed:
+            access_decisions_total.inc("rate_limited")
+            raise HTTPException(
+                status_code=429,
+                detail=ResponseSchema(success=False, message="Rate limit exceeded").model_dump(),
+                headers=limit.headers(),
+            )
+        headers = limit.headers() if limit else None
+
+        if not authorized:
+            access_decisions_total.inc("denied")
             raise HTTPException(
                 status_code=403,
                 detail=ResponseSchema(
                     success=False,
-                    message=f"User with role '{role.name.value}' does NOT have access to this endpoint",
+                    message=f"User with role '{user.role}' does NOT have access to this endpoint",
                 ).model_dump(),
+                headers=headers,
             )
 
-        await log_access(db, user.id, endpoint, method, success=True, message="")
+        access_decisions_total.inc("allowed")
+        if headers:
+            response.headers.update(headers)
         return user
 
     return access_dependency
 
 
+def access_log_entry(
+    user_id: Optional[int],
+    endpoint: str,
+    action: str,
+    success: bool,
+    message: Optional[str] = None,
+) -> Union[bytes, str]:
+    """Serialize an access log entry the way the log drain expects it."""
+    if LOG_ENTRY_FORMAT == "json":
+        return json.dumps({
+            "user_id": user_id,
+            "endpoint": endpoint,
+            "action": action,
+            "success": success,
+            "message": message,
+            "timestamp": datetime.now().isoformat(),
+        })
+    return encode_log_entry(user_id, endpoint, action, success, message, datetime.now())
+
+
 async def log_access(
-    db: Session,
     user_id: Optional[str],
     endpoint: str,
     action: str,
@@ -78,13 +312,10 @@ async def log_access(
 ):
     """
     Log access attempts to the database.
+
+    The entry is only appended to the in-process log buffer; the network write happens in
+    the buffer's flusher task.
     """
-    log_entry = json.dumps({
-        "user_id": user_id,
-        "endpoint": endpoint,
-        "action": action,
-        "success": success,
-        "message": message,
-        "timestamp": datetime.now().isoformat(),
-    })
-    await redis.rpush("access_logs", log_entry)
\ No newline at end of file
+    started = time.perf_counter()
+    await log_buffer.put(access_log_entry(user_id, endpoint, action, success, message))
+    log_access_seconds.observe(time.perf_counter() - started)
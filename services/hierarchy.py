@@ -0,0 +1,77 @@
+from collections import deque
+from sqlalchemy import delete, insert, select
+from typing import Dict, Iterable, Set
+
+from models import Role, role_closure, role_parents
+
+
+class RoleHierarchyError(ValueError):
+    """Raised when a parent assignment would make a role inherit from itself."""
+
+
+def load_edges(db) -> Dict[int, Set[int]]:
+    """Map each role id to the ids of its direct parents."""
+    edges: Dict[int, Set[int]] = {}
+    for role_id, parent_id in db.execute(select(role_parents.c.role_id, role_parents.c.parent_id)):
+        edges.setdefault(role_id, set()).add(parent_id)
+    return edges
+
+
+def ancestors(edges: Dict[int, Set[int]], role_id: int) -> Dict[int, int]:
+    """Every role reachable from role_id through its parents, with the shortest depth, itself included."""
+    depths = {role_id: 0}
+    queue = deque([role_id])
+    while queue:
+        current = queue.popleft()
+        for parent_id in edges.get(current, ()):
+            if parent_id not in depths:
+                depths[parent_id] = depths[current] + 1
+                queue.append(parent_id)
+    return depths
+
+
+def recompute_closure(db, role_ids: Iterable[int]):
+    """Rewrite the closure rows of the given roles from role_parents."""
+    role_ids = list(role_ids)
+    if not role_ids:
+        return
+    edges = load_edges(db)
+    db.execute(delete(role_closure).where(role_closure.c.role_id.in_(role_ids)))
+    db.execute(
+        insert(role_closure),
+        [
+            {"role_id": role_id, "ancestor_id": ancestor_id, "depth": depth}
+            for role_id in role_ids
+            for ancestor_id, depth in ancestors(edges, role_id).items()
+        ],
+    )
+
+
+def rebuild_closure(db):
+    """Rewrite the whole closure table."""
+    recompute_closure(db, db.execute(select(Role.id)).scalars().all())
+
+
+def set_parents(db, role_id: int, parent_ids: Iterable[int]):
+    """
+    Replace a role's parents and update the closure of that role and every role inheriting from it.
+
+    Only those roles can change, so the rest of the closure table is left alone.
+    """
+    parent_ids = set(parent_ids)
+    edges = load_edges(db)
+    for parent_id in parent_ids:
+        if role_id in ancestors(edges, parent_id):
+            raise RoleHierarchyError(f"Role {parent_id} already inherits from role {role_id}")
+
+    affected = db.execute(
+        select(role_closure.c.role_id).where(role_closure.c.ancestor_id == role_id)
+    ).scalars().all()
+
+    db.execute(delete(role_parents).where(role_parents.c.role_id == role_id))
+    if parent_ids:
+        db.execute(
+            insert(role_parents),
+            [{"role_id": role_id, "parent_id": parent_id} for parent_id in parent_ids],
+        )
+    recompute_closure(db, set(affected) | {role_id})
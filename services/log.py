@@ -1,43 +1,385 @@
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from redis.exceptions import RedisError, ResponseError
 import asyncio
-import json
-from services.redis import redis
-from models import AccessLog
+import logging
+import socket
+import time
+from services.log_record import UNDECODABLE_ERRORS, decode_log_entries, decode_log_entry
+from services.admission import ASYNC_DB_MAX_OVERFLOW, ASYNC_DB_POOL_SIZE, DB_POOL_TIMEOUT
+from services.redis import get_redis
+from services.telemetry import (
+    TimedAsyncQueuePool,
+    collector,
+    log_drain_batch_size,
+    log_drain_lag_seconds,
+    log_dead_letters_total,
+    log_drain_phase_seconds,
+    log_queue_length,
+)
+from models import AccessLog, AccessLogHourRollup, AccessLogMinuteRollup
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("ASYNC_DB_URL")
 
-# Create an async engine
-async_engine = create_async_engine(DATABASE_URL, future=True)
+# "list" pushes to a Redis list drained destructively, "stream" uses a Redis Stream with a
+# consumer group shared by every worker and acknowledges entries only after the MySQL commit
+LOG_TRANSPORT = os.getenv("LOG_TRANSPORT", "list")
 
-# Create an async session
-AsyncSessionLocal = sessionmaker(
-    async_engine, class_=AsyncSession, expire_on_commit=False
-)
+# Encoding of queued entries (see services/log_record.py). Both are always read; keep
+# writing "json" until no worker older than the binary format drains the queue
+LOG_ENTRY_FORMAT = os.getenv("LOG_ENTRY_FORMAT", "binary")
+
+# Redis list that log_access pushes to and the drain task pops from
+ACCESS_LOGS_KEY = "access_logs"
+# Redis list of entries the drain could not decode or MySQL rejected, kept for inspection
+ACCESS_LOG_DEAD_LETTER_KEY = "access_logs_dead"
+
+# Redis stream and consumer group used by the "stream" transport
+ACCESS_LOG_STREAM_KEY = "access_log_stream"
+ACCESS_LOG_GROUP = "access_log_drain"
+ACCESS_LOG_CONSUMER = f"{socket.gethostname()}-{os.getpid()}"
+# Entries pending this long on another consumer are assumed abandoned and claimed
+LOG_STREAM_CLAIM_IDLE_MS = int(os.getenv("LOG_STREAM_CLAIM_IDLE_MS", "60000"))
+LOG_STREAM_BLOCK_MS = int(os.getenv("LOG_STREAM_BLOCK_MS", "5000"))
+
+LOG_DRAIN_BATCH_SIZE = int(os.getenv("LOG_DRAIN_BATCH_SIZE", "5000"))
+LOG_DRAIN_MIN_INTERVAL = float(os.getenv("LOG_DRAIN_MIN_INTERVAL", "0.1"))
+LOG_DRAIN_MAX_INTERVAL = float(os.getenv("LOG_DRAIN_MAX_INTERVAL", "10"))
+
+# Longest a log push may take before the entries are spilled to local disk instead (see
+# services/log_spill.py). Also bounds the rate limit script, which queues the entry too
+LOG_PUSH_BUDGET_MS = float(os.getenv("LOG_PUSH_BUDGET_MS", "50"))
+
+async_engine = None
+
+# Async session, also used by the allow_access dependency for API key lookups. Bound to the
+# engine by get_async_engine() so importing this module never opens a connection.
+AsyncSessionLocal = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
+
+def get_async_engine():
+    """Create the async engine on first use."""
+    global async_engine
+    if async_engine is None:
+        async_engine = create_async_engine(
+            DATABASE_URL,
+            future=True,
+            poolclass=TimedAsyncQueuePool,  # Records checkout wait for the telemetry endpoint
+            pool_size=ASYNC_DB_POOL_SIZE,
+            max_overflow=ASYNC_DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=3600,  # Recycle connections after 1 hour to avoid stale ones
+            pool_pre_ping=True,  # Checks if connections are alive before using them
+        )
+        AsyncSessionLocal.configure(bind=async_engine)
+    return async_engine
+
+
+async def push_log_entries(entries):
+    """Queue several serialized log entries on the configured transport in one round trip."""
+    if LOG_TRANSPORT == "stream":
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for entry in entries:
+                pipe.xadd(ACCESS_LOG_STREAM_KEY, {"entry": entry})
+            await pipe.execute()
+    else:
+        await get_redis().rpush(ACCESS_LOGS_KEY, *entries)
+
+
+def observe_drained(rows, phase_started: float):
+    """Record the write phase, size and lag of a batch that was just committed."""
+    log_drain_phase_seconds.observe(time.perf_counter() - phase_started, "write")
+    log_drain_batch_size.observe(len(rows))
+    if not rows:
+        return
+    oldest = min(row["timestamp"] for row in rows)
+    log_drain_lag_seconds.observe((datetime.now() - oldest).total_seconds())
+
+
+def rollup_counts(rows, truncate) -> Counter:
+    """Count rows per (bucket, endpoint, action, user_id, success), with the bucket from truncate(timestamp)."""
+    return Counter(
+        (truncate(row["timestamp"]), row["endpoint"], row["action"], row["user_id"] or 0, row["success"])
+        for row in rows
+    )
+
+
+async def upsert_rollups(db: AsyncSession, rows):
+    """
+    Add a batch of access logs to the per-minute and per-hour rollup tables.
+
+    Runs in the same transaction as the raw insert so the rollups never drift from it.
+    SQLite is supported for the benchmark suite.
+    """
+    dialect = db.get_bind().dialect.name
+    rollups = [
+        (AccessLogMinuteRollup, lambda ts: ts.replace(second=0, microsecond=0)),
+        (AccessLogHourRollup, lambda ts: ts.replace(minute=0, second=0, microsecond=0)),
+    ]
+    for model, truncate in rollups:
+        values = [
+            {
+                "bucket": bucket,
+                "endpoint": endpoint,
+                "action": action,
+                "user_id": user_id,
+                "success": success,
+                "count": count,
+            }
+            for (bucket, endpoint, action, user_id, success), count in rollup_counts(rows, truncate).items()
+        ]
+        if dialect == "sqlite":
+            stmt = sqlite_insert(model).values(values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["bucket", "endpoint", "action", "user_id", "success"],
+                set_={"count": model.count + stmt.excluded["count"]},
+            )
+        else:
+            stmt = mysql_insert(model).values(values)
+            stmt = stmt.on_duplicate_key_update(count=model.count + stmt.inserted["count"])
+        await db.execute(stmt)
+
+
+async def dead_letter(entries, reason: str):
+    """Set entries that can never be written aside, so they cannot fail the rest of their batch."""
+    if not entries:
+        return
+    log_dead_letters_total.inc(amount=len(entries))
+    logger.error("Dead-lettering %d access log entries: %s", len(entries), reason)
+    try:
+        await get_redis().rpush(ACCESS_LOG_DEAD_LETTER_KEY, *entries)
+    except RedisError:
+        logger.exception("Could not store dead-lettered access log entries, dropping them")
+
+
+async def commit_log_rows(stmt, rows):
+    async with AsyncSessionLocal() as db:
+        await db.execute(stmt, rows)
+        await upsert_rollups(db, rows)
+        await db.commit()
+
+
+async def insert_log_rows(rows, entries, ignore_duplicates: bool = False) -> list:
+    """
+    Insert rows and their rollups in one transaction. Returns the rows written.
+
+    If MySQL rejects the batch, e.g. a value too long for its column in strict mode, the
+    rows are retried one at a time and the rejected ones dead-lettered with their entries.
+    """
+    stmt = insert(AccessLog)
+    if ignore_duplicates:
+        stmt = stmt.prefix_with("IGNORE", dialect="mysql")
+    if not rows:
+        return rows
+    try:
+        await commit_log_rows(stmt, rows)
+        return rows
+    except (DataError, IntegrityError):
+        logger.warning("MySQL rejected a batch of %d access logs, retrying them one by one", len(rows))
+
+    written = []
+    for row, entry in zip(rows, entries):
+        try:
+            await commit_log_rows(stmt, [row])
+            written.append(row)
+        except (DataError, IntegrityError) as e:
+            await dead_letter([entry], str(e.orig))
+    return written
+
+
+async def write_log_entries(entries) -> list:
+    """Insert queued entries and their rollups, dead-lettering the ones that cannot be written. Returns the rows written."""
+    rows, decoded, rejected = decode_log_entries(entries)
+    await dead_letter(rejected, "undecodable")
+    return await insert_log_rows(rows, decoded)
+
+
+async def requeue_log_entries(entries):
+    """Put a popped batch back at the head of the list, or on local disk if Redis is unavailable."""
+    try:
+        await get_redis().lpush(ACCESS_LOGS_KEY, *reversed(entries))
+    except RedisError:
+        # Imported here because services.log_spill builds on this module
+        from services.log_spill import log_spill
+
+        spilled = log_spill.append(entries)
+        if spilled < len(entries):
+            logger.error("Lost %d access log entries that could not be requeued", len(entries) - spilled)
+
+
+async def drain_log_batch(batch_size: int = LOG_DRAIN_BATCH_SIZE) -> int:
+    """
+    Pop up to batch_size entries in one round trip and write them with a single executemany insert.
+
+    Returns the number of entries moved.
+    """
+    started = time.perf_counter()
+    entries = await get_redis().lpop(ACCESS_LOGS_KEY, batch_size)
+    log_drain_phase_seconds.observe(time.perf_counter() - started, "fetch")
+    if not entries:
+        return 0
+
+    started = time.perf_counter()
+    try:
+        rows = await write_log_entries(entries)
+    except BaseException:
+        # Also on cancellation: the entries are no longer in Redis
+        await requeue_log_entries(entries)
+        raise
+    observe_drained(rows, started)
+    return len(entries)
 
 
 async def move_logs_to_mysql():
     """
     Background task to move logs from Redis to MySQL.
+
+    Full batches are drained back to back. Otherwise the wait between polls shrinks towards
+    LOG_DRAIN_MIN_INTERVAL while entries keep arriving and backs off towards
+    LOG_DRAIN_MAX_INTERVAL while the queue stays empty. Failed batches are put back and
+    retried after the same backoff.
     """
+    interval = LOG_DRAIN_MAX_INTERVAL
     while True:
-        logs = []
-        async with AsyncSessionLocal() as db:  # Async session for database
-            while True:
-                # Pop a log entry from Redis
-                log_entry = await redis.rpop("access_logs")
-                if not log_entry:
-                    break
-                logs.append(json.loads(log_entry))
-
-            if logs:
-                # Batch write logs to MySQL
-                db.add_all([AccessLog(**log) for log in logs])
-                await db.commit()  # Async commit
+        try:
+            moved = await drain_log_batch()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to move logs from Redis to MySQL")
+            interval = min(LOG_DRAIN_MAX_INTERVAL, max(LOG_DRAIN_MIN_INTERVAL, interval * 2))
+            await asyncio.sleep(interval)
+            continue
+
+        if moved >= LOG_DRAIN_BATCH_SIZE:
+            # Backlog: keep draining without sleeping
+            continue
+
+        if moved:
+            interval = max(LOG_DRAIN_MIN_INTERVAL, interval / 2)
+        else:
+            interval = min(LOG_DRAIN_MAX_INTERVAL, interval * 2)
 
         # Wait before fetching more logs
-        await asyncio.sleep(10)
+        await asyncio.sleep(interval)
+
+
+async def ensure_log_stream_group():
+    """Create the stream and its consumer group if they do not exist yet."""
+    try:
+        await get_redis().xgroup_create(ACCESS_LOG_STREAM_KEY, ACCESS_LOG_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def write_stream_entries(messages) -> int:
+    """
+    Insert stream entries and acknowledge them once the commit has succeeded.
+
+    The stream entry id doubles as the access log id, so entries redelivered after a crash
+    between commit and XACK are skipped by INSERT IGNORE instead of duplicated. The rollups
+    are not deduplicated and may count such entries twice.
+    """
+    if not messages:
+        return 0
+
+    started = time.perf_counter()
+    rows = []
+    entries = []
+    rejected = []
+    for message_id, fields in messages:
+        try:
+            row = decode_log_entry(fields[b"entry"])
+        except UNDECODABLE_ERRORS:
+            rejected.append(fields[b"entry"])
+            continue
+        row["id"] = message_id.decode()
+        rows.append(row)
+        entries.append(fields[b"entry"])
+
+    # Dead-lettered entries are acknowledged with the rest
+    await dead_letter(rejected, "undecodable")
+    rows = await insert_log_rows(rows, entries, ignore_duplicates=True)
+    observe_drained(rows, started)
+
+    message_ids = [message_id for message_id, _ in messages]
+    async with get_redis().pipeline(transaction=False) as pipe:
+        pipe.xack(ACCESS_LOG_STREAM_KEY, ACCESS_LOG_GROUP, *message_ids)
+        pipe.xdel(ACCESS_LOG_STREAM_KEY, *message_ids)
+        await pipe.execute()
+    return len(messages)
+
+
+async def consume_log_stream():
+    """
+    Background task to move logs from the Redis stream to MySQL.
+
+    Every worker joins the same consumer group, so the drain scales with the number of
+    workers. Entries left pending by consumers that died are claimed after
+    LOG_STREAM_CLAIM_IDLE_MS and written by whoever picks them up. The group is created
+    again whenever it is missing, e.g. after Redis restarted without persistence.
+    """
+    group_ready = False
+    while True:
+        try:
+            if not group_ready:
+                await ensure_log_stream_group()
+                group_ready = True
+            # Take over entries abandoned by dead consumers first
+            _, claimed, *_ = await get_redis().xautoclaim(
+                ACCESS_LOG_STREAM_KEY,
+                ACCESS_LOG_GROUP,
+                ACCESS_LOG_CONSUMER,
+                min_idle_time=LOG_STREAM_CLAIM_IDLE_MS,
+                start_id="0-0",
+                count=LOG_DRAIN_BATCH_SIZE,
+            )
+            await write_stream_entries(claimed)
+
+            response = await get_redis().xreadgroup(
+                ACCESS_LOG_GROUP,
+                ACCESS_LOG_CONSUMER,
+                {ACCESS_LOG_STREAM_KEY: ">"},
+                count=LOG_DRAIN_BATCH_SIZE,
+                block=LOG_STREAM_BLOCK_MS,
+            )
+            for _, messages in response or []:
+                await write_stream_entries(messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, ResponseError) and "NOGROUP" in str(e):
+                logger.warning("Access log consumer group is missing, creating it again")
+                group_ready = False
+            else:
+                # Unacknowledged entries stay pending and are retried after the claim timeout
+                logger.exception("Failed to move logs from the Redis stream to MySQL")
+            await asyncio.sleep(LOG_DRAIN_MIN_INTERVAL)
+
+
+@collector
+async def collect_queue_length():
+    if LOG_TRANSPORT == "stream":
+        log_queue_length.set(await get_redis().xlen(ACCESS_LOG_STREAM_KEY), "stream")
+    else:
+        log_queue_length.set(await get_redis().llen(ACCESS_LOGS_KEY), "list")
+
+
+def drain_logs():
+    """Return the background drain coroutine for the configured transport."""
+    if LOG_TRANSPORT == "stream":
+        return consume_log_stream()
+    return move_logs_to_mysql()
@@ -0,0 +1,131 @@
+from collections import deque
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from services.log import LOG_PUSH_BUDGET_MS, push_log_entries
+from services.log_spill import log_spill
+from services.redis import redis_breaker
+from services.telemetry import log_buffer_dropped_total, log_push_batch_size, log_push_seconds
+import asyncio
+import logging
+import os
+import time
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", "10000"))
+LOG_BUFFER_BATCH_SIZE = int(os.getenv("LOG_BUFFER_BATCH_SIZE", "500"))
+LOG_BUFFER_FLUSH_MS = float(os.getenv("LOG_BUFFER_FLUSH_MS", "5"))
+# What to do with new entries while the buffer is full: "drop" them or "block" the request
+LOG_BUFFER_POLICY = os.getenv("LOG_BUFFER_POLICY", "drop")
+
+
+class LogBuffer:
+    """
+    In-process buffer of serialized access log entries.
+
+    Requests append without touching the network and a single flusher task sends
+    everything accumulated as one Redis call every LOG_BUFFER_FLUSH_MS milliseconds, or as
+    soon as LOG_BUFFER_BATCH_SIZE entries are waiting. Batches that fail or take longer
+    than LOG_PUSH_BUDGET_MS go to the local spill segments instead, as do new entries while
+    the buffer is full.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = LOG_BUFFER_SIZE,
+        batch_size: int = LOG_BUFFER_BATCH_SIZE,
+        flush_interval: float = LOG_BUFFER_FLUSH_MS / 1000,
+        policy: str = LOG_BUFFER_POLICY,
+    ):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.dropped = 0
+        self.spilling = False
+        self._entries = deque()
+        self._wake = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def put(self, entry):
+        """Append an entry, waiting for space or dropping it when the buffer is full."""
+        while len(self._entries) >= self.maxsize:
+            if log_spill.append([entry]):
+                return
+            if self.policy != "block":
+                self.dropped += 1
+                log_buffer_dropped_total.inc()
+                return
+            self._not_full.clear()
+            await self._not_full.wait()
+
+        self._entries.append(entry)
+        if len(self._entries) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        """Send everything currently buffered. Returns the number of entries sent."""
+        if not self._entries:
+            return 0
+
+        entries = list(self._entries)
+        self._entries.clear()
+        self._not_full.set()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(push_log_entries(entries), LOG_PUSH_BUDGET_MS / 1000)
+        except (RedisError, asyncio.TimeoutError):
+            # A push that timed out may still have reached Redis; spilled entries can be duplicates
+            redis_breaker.trip()
+            spilled = log_spill.append(entries)
+            if spilled:
+                if not self.spilling:
+                    logger.warning("Redis is unavailable or slow, spilling access logs to disk")
+                self.spilling = True
+            if spilled < len(entries):
+                self.requeue(entries[spilled:])
+                raise
+            return 0
+        except BaseException:
+            # Also covers cancellation mid-flush
+            self.requeue(entries)
+            raise
+        if self.spilling:
+            logger.info("Access log pushes to Redis have recovered")
+            self.spilling = False
+        log_push_seconds.observe(time.perf_counter() - started)
+        log_push_batch_size.observe(len(entries))
+        return len(entries)
+
+    def requeue(self, entries):
+        """Put a batch back in front of newer entries, as far as space allows."""
+        keep = entries[: max(0, self.maxsize - len(self._entries))]
+        self.dropped += len(entries) - len(keep)
+        log_buffer_dropped_total.inc(amount=len(entries) - len(keep))
+        self._entries.extendleft(reversed(keep))
+
+    async def run(self):
+        """
+        Background task that flushes the buffer until cancelled.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush access logs to Redis")
+                await asyncio.sleep(self.flush_interval)
+
+
+log_buffer = LogBuffer()
@@ -0,0 +1,152 @@
+"""
+Binary encoding of the access log entries queued in Redis.
+
+A record is a fixed 18 byte header, little-endian:
+
+    version u8, flags u8, timestamp i64, user id u32, endpoint id u16, action id u8, message id u8
+
+followed by the strings that are not in the dictionaries below, in that order: the
+endpoint (u16 length + UTF-8) if its id is 0, the action (u8 length) if its id is 0 and
+the message (u16 length) if it is set and its id is 0. The timestamp counts microseconds
+since 1970-01-01 in local time, matching the naive timestamps stored in access_logs.
+
+JSON entries always start with "{", so the version byte tells the two formats apart and
+entries queued by older workers are still read.
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple, Union
+import json
+import struct
+
+RECORD_VERSION = 1
+
+HAS_USER = 1
+SUCCESS = 2
+HAS_MESSAGE = 4
+
+RECORD = struct.Struct("<BBqIHBB")
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Raised by decode_log_entry for corrupt or unknown entries (JSON and UTF-8 errors are ValueErrors)
+UNDECODABLE_ERRORS = (ValueError, KeyError, TypeError, IndexError, struct.error)
+
+# Append only: ids are positions in these lists and queued records outlive a deploy.
+# Id 0 means the value is written inline.
+ENDPOINTS = [
+    None,
+    "/billing",
+    "/metrics",
+    "/all",
+    "/authz/check",
+    "/policy/snapshot",
+    "/policy/delta",
+]
+ACTIONS = [None, "GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"]
+MESSAGES = [None, "", "Invalid API key", "Insufficient privileges", "Rate limit exceeded"]
+
+ENDPOINT_IDS = {value: index for index, value in enumerate(ENDPOINTS) if index}
+ACTION_IDS = {value: index for index, value in enumerate(ACTIONS) if index}
+MESSAGE_IDS = {value: index for index, value in enumerate(MESSAGES) if index}
+
+
+def encode_string(value: str, length: struct.Struct) -> bytes:
+    data = value.encode()
+    if len(data) >= 1 << (8 * length.size):
+        # Longer than the column anyway, cut at a character boundary
+        data = data[: (1 << (8 * length.size)) - 1].decode(errors="ignore").encode()
+    return length.pack(len(data)) + data
+
+
+def encode_log_entry(
+    user_id: Optional[int],
+    endpoint: str,
+    action: str,
+    success: bool,
+    message: Optional[str],
+    timestamp: datetime,
+) -> bytes:
+    flags = (HAS_USER if user_id is not None else 0) | (SUCCESS if success else 0)
+    if message is not None:
+        flags |= HAS_MESSAGE
+    endpoint_id = ENDPOINT_IDS.get(endpoint, 0)
+    action_id = ACTION_IDS.get(action, 0)
+    message_id = MESSAGE_IDS.get(message, 0)
+    record = RECORD.pack(
+        RECORD_VERSION,
+        flags,
+        (timestamp - EPOCH) // MICROSECOND,
+        user_id or 0,
+        endpoint_id,
+        action_id,
+        message_id,
+    )
+    if not endpoint_id:
+        record += encode_string(endpoint, U16)
+    if not action_id:
+        record += encode_string(action, U8)
+    if message is not None and not message_id:
+        record += encode_string(message, U16)
+    return record
+
+
+def decode_json_entry(raw: Union[bytes, str]) -> dict:
+    log = json.loads(raw)
+    log["timestamp"] = datetime.fromisoformat(log["timestamp"])
+    return log
+
+
+def decode_log_entry(raw: Union[bytes, str]) -> dict:
+    """Turn one queued entry, binary or JSON, into insert parameters for the access_logs table."""
+    if isinstance(raw, str) or raw[:1] == b"{":
+        return decode_json_entry(raw)
+
+    version, flags, micros, user_id, endpoint_id, action_id, message_id = RECORD.unpack_from(raw)
+    if version != RECORD_VERSION:
+        raise ValueError(f"Unknown access log record version {version}")
+    offset = RECORD.size
+    endpoint = ENDPOINTS[endpoint_id]
+    if endpoint is None:
+        size = U16.unpack_from(raw, offset)[0]
+        endpoint = raw[offset + 2:offset + 2 + size].decode()
+        offset += 2 + size
+    action = ACTIONS[action_id]
+    if action is None:
+        size = raw[offset]
+        action = raw[offset + 1:offset + 1 + size].decode()
+        offset += 1 + size
+    message = None
+    if flags & HAS_MESSAGE:
+        message = MESSAGES[message_id]
+        if message is None:
+            size = U16.unpack_from(raw, offset)[0]
+            message = raw[offset + 2:offset + 2 + size].decode()
+    return {
+        "user_id": user_id if flags & HAS_USER else None,
+        "endpoint": endpoint,
+        "action": action,
+        "success": bool(flags & SUCCESS),
+        "message": message,
+        "timestamp": EPOCH + timedelta(microseconds=micros),
+    }
+
+
+def decode_log_entries(entries: Iterable[Union[bytes, str]]) -> Tuple[List[dict], list, list]:
+    """
+    Decode a batch of queued entries, setting aside those that cannot be decoded.
+
+    Returns the rows, the entries they were decoded from and the undecodable entries.
+    """
+    rows = []
+    decoded = []
+    rejected = []
+    for raw in entries:
+        try:
+            rows.append(decode_log_entry(raw))
+            decoded.append(raw)
+        except UNDECODABLE_ERRORS:
+            rejected.append(raw)
+    return rows, decoded, rejected
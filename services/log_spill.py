@@ -0,0 +1,308 @@
+"""
+Local spill buffer for access log entries that could not be pushed to Redis.
+
+Entries go to append-only segment files of LOG_SPILL_SEGMENT_BYTES, preallocated and
+memory-mapped so an append is a memory copy. Each segment starts with a header holding
+how far it has been replayed, followed by records of u32 length, u32 CRC-32 and the
+entry. The unused tail is zeros, so a zero length marks the end.
+
+Recovery needs no journal: a segment is read up to the first zero length or CRC
+mismatch, which also stops at a record torn by a crash. Written pages survive a crash of
+the process; an OS crash can lose those not yet written back, and with them the tail of
+the segment. Delivery is at least once, since a batch sent but not yet recorded as
+replayed is sent again.
+
+Segments are locked with flock by the process writing or replaying them, so segments
+left by a crashed worker are picked up by the replayer of any other worker.
+"""
+from dotenv import load_dotenv
+from glob import glob
+from redis.exceptions import RedisError
+from typing import List, Optional, Tuple, Union
+from services.log import LOG_PUSH_BUDGET_MS, push_log_entries, write_log_entries
+from services.telemetry import (
+    collector,
+    log_buffer_dropped_total,
+    log_spill_bytes,
+    log_spill_replayed_total,
+    log_spilled_total,
+)
+import asyncio
+import fcntl
+import itertools
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Empty disables spilling; entries then stay in the in-process buffer until it is full
+LOG_SPILL_DIR = os.getenv("LOG_SPILL_DIR", "spill/access_logs")
+LOG_SPILL_SEGMENT_BYTES = int(os.getenv("LOG_SPILL_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+# Entries that do not fit once segments use this much disk are dropped
+LOG_SPILL_MAX_BYTES = int(os.getenv("LOG_SPILL_MAX_BYTES", str(256 * 1024 * 1024)))
+LOG_SPILL_REPLAY_INTERVAL = float(os.getenv("LOG_SPILL_REPLAY_INTERVAL", "1"))
+LOG_SPILL_REPLAY_BATCH_SIZE = 1000
+
+MAGIC = b"RBS1"
+SEGMENT_HEADER = struct.Struct("<4sQ")  # Magic, offset replayed up to
+RECORD = struct.Struct("<II")  # Length, CRC-32
+SEGMENT_SUFFIX = ".seg"
+
+
+class Segment:
+    """One memory-mapped segment file, locked for as long as it is open."""
+
+    def __init__(self, path: str, size: int = 0):
+        """Open an existing segment, or create one of `size` bytes. Raises BlockingIOError if it is locked."""
+        self.path = path
+        self.replaying = False
+        self.fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_EXCL if size else 0), 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if size:
+                # Reserve the blocks now: a write to a sparse mapping on a full disk kills the process
+                os.posix_fallocate(self.fd, 0, size)
+            self.map = mmap.mmap(self.fd, 0)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+        if size:
+            SEGMENT_HEADER.pack_into(self.map, 0, MAGIC, SEGMENT_HEADER.size)
+        magic, _ = SEGMENT_HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a spill segment")
+        self.end = self.scan()
+
+    @property
+    def replayed(self) -> int:
+        return SEGMENT_HEADER.unpack_from(self.map)[1]
+
+    @replayed.setter
+    def replayed(self, offset: int):
+        SEGMENT_HEADER.pack_into(self.map, 0, MAGIC, offset)
+
+    def scan(self) -> int:
+        """Offset just past the last intact record."""
+        offset = SEGMENT_HEADER.size
+        for offset, _ in self.records(offset):
+            pass
+        return offset
+
+    def records(self, offset: int):
+        """Yield (offset after the record, entry) for the intact records from `offset` on."""
+        size = len(self.map)
+        while offset + RECORD.size <= size:
+            length, checksum = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            if not length or start + length > size:
+                return
+            entry = self.map[start:start + length]
+            if zlib.crc32(entry) != checksum:
+                return
+            offset = start + length
+            yield offset, entry
+
+    def read(self, limit: int) -> Tuple[List[bytes], int]:
+        """Up to `limit` entries not yet replayed, and the offset after the last one."""
+        offset = self.replayed
+        entries = []
+        for offset, entry in itertools.islice(self.records(offset), limit):
+            entries.append(entry)
+        return entries, offset
+
+    def append(self, entry: bytes) -> bool:
+        """Append one entry, or return False if it does not fit."""
+        start = self.end + RECORD.size
+        if start + len(entry) > len(self.map):
+            return False
+        self.map[start:start + len(entry)] = entry
+        RECORD.pack_into(self.map, self.end, len(entry), zlib.crc32(entry))
+        self.end = start + len(entry)
+        return True
+
+    def close(self):
+        if not self.map.closed:
+            self.map.flush()
+            self.map.close()
+            # Also releases the lock
+            os.close(self.fd)
+
+    def delete(self):
+        # Unlinked before the lock is released so no other replayer can open it again
+        os.unlink(self.path)
+        self.close()
+
+
+class LogSpill:
+    """
+    Spill segments written when Redis is down or over the push budget, and their replayer.
+
+    append() is synchronous and only touches the mapping, so it can run on the request
+    path. The replayer sends the entries back to Redis, or straight to MySQL while Redis
+    is still unavailable, and deletes each segment once it has been fully replayed.
+    """
+
+    def __init__(
+        self,
+        directory: str = LOG_SPILL_DIR,
+        segment_size: int = LOG_SPILL_SEGMENT_BYTES,
+        max_bytes: int = LOG_SPILL_MAX_BYTES,
+    ):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.current: Optional[Segment] = None
+        self._sequence = itertools.count()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def segment_paths(self) -> List[str]:
+        # Names start with the creation time, so this is oldest first
+        return sorted(glob(os.path.join(self.directory, f"*{SEGMENT_SUFFIX}")))
+
+    def disk_usage(self) -> int:
+        usage = 0
+        for path in self.segment_paths():
+            try:
+                usage += os.path.getsize(path)
+            except OSError:
+                # Deleted by a replayer in the meantime
+                pass
+        return usage
+
+    def rotate(self) -> bool:
+        """Close the current segment and start a new one, unless that would exceed LOG_SPILL_MAX_BYTES."""
+        if self.current:
+            # A segment being replayed is closed by the replayer once it is done with it
+            if not self.current.replaying:
+                self.current.close()
+            self.current = None
+
+        if self.disk_usage() + self.segment_size > self.max_bytes:
+            return False
+        name = f"{time.time_ns()}-{os.getpid()}-{next(self._sequence)}"
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Created under a temporary name so replayers never see a segment without its header
+            segment = Segment(path + ".tmp", self.segment_size)
+            os.rename(segment.path, path + SEGMENT_SUFFIX)
+        except OSError:
+            logger.exception("Could not create a log spill segment in %s", self.directory)
+            if os.path.exists(path + ".tmp"):
+                os.unlink(path + ".tmp")
+            return False
+        segment.path = path + SEGMENT_SUFFIX
+        self.current = segment
+        return True
+
+    def append(self, entries: List[Union[bytes, str]]) -> int:
+        """
+        Write entries to disk. Returns how many of the leading entries were handled; the
+        rest did not fit in LOG_SPILL_MAX_BYTES.
+        """
+        if not self.enabled:
+            return 0
+        for index, entry in enumerate(entries):
+            if isinstance(entry, str):
+                entry = entry.encode()
+            if self.current and self.current.append(entry):
+                continue
+            if not self.rotate():
+                log_spilled_total.inc(amount=index)
+                return index
+            if not self.current.append(entry):
+                # Larger than a whole segment
+                log_buffer_dropped_total.inc()
+        log_spilled_total.inc(amount=len(entries))
+        return len(entries)
+
+    async def send(self, entries: List[bytes]):
+        try:
+            await asyncio.wait_for(push_log_entries(entries), LOG_PUSH_BUDGET_MS / 1000)
+            log_spill_replayed_total.inc("redis", amount=len(entries))
+        except (RedisError, asyncio.TimeoutError):
+            await write_log_entries(entries)
+            log_spill_replayed_total.inc("database", amount=len(entries))
+
+    async def replay_segment(self, segment: Segment) -> int:
+        replayed = 0
+        segment.replaying = True
+        try:
+            while True:
+                entries, offset = segment.read(LOG_SPILL_REPLAY_BATCH_SIZE)
+                if not entries:
+                    return replayed
+                await self.send(entries)
+                segment.replayed = offset
+                replayed += len(entries)
+        finally:
+            segment.replaying = False
+
+    async def replay(self) -> int:
+        """Send every spilled entry on. Returns the number of entries replayed."""
+        replayed = 0
+        for path in self.segment_paths():
+            if self.current and path == self.current.path:
+                continue
+            try:
+                segment = Segment(path)
+            except (BlockingIOError, FileNotFoundError):
+                # Being written or replayed by another worker, or already done
+                continue
+            except (OSError, ValueError):
+                logger.exception("Skipping unreadable log spill segment %s", path)
+                continue
+            try:
+                replayed += await self.replay_segment(segment)
+                segment.delete()
+            finally:
+                segment.close()
+
+        # The segment still being written is replayed in place, and deleted like the others once rotated
+        segment = self.current
+        if segment:
+            try:
+                replayed += await self.replay_segment(segment)
+            finally:
+                if segment is not self.current:
+                    segment.close()
+        return replayed
+
+    async def run(self):
+        """
+        Background task that replays spilled entries until cancelled.
+        """
+        while True:
+            await asyncio.sleep(LOG_SPILL_REPLAY_INTERVAL)
+            try:
+                replayed = await self.replay()
+                if replayed:
+                    logger.info("Replayed %d spilled access log entries", replayed)
+            except Exception:
+                # Whatever was not recorded as replayed is retried on the next pass
+                logger.exception("Failed to replay spilled access logs")
+
+    def close(self):
+        if self.current:
+            self.current.close()
+            self.current = None
+
+
+log_spill = LogSpill()
+
+
+@collector
+async def collect_spill_bytes():
+    if log_spill.enabled:
+        log_spill_bytes.set(log_spill.disk_usage())
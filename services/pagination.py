@@ -0,0 +1,37 @@
+from fastapi import HTTPException, Query
+from typing import List, Optional
+from schemas import ResponseSchema
+
+
+class ListParams:
+    """Common query parameters for list endpoints: keyset cursor, page size and field projection."""
+
+    def __init__(
+        self,
+        limit: int = Query(100, ge=1, le=1000),
+        cursor: Optional[int] = Query(None, description="next_cursor from the previous page"),
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    ):
+        self.limit = limit
+        self.cursor = cursor
+        self.fields = fields
+
+    def selected(self, available: List[str]) -> List[str]:
+        """Requested fields in the order given, or every available field."""
+        if not self.fields:
+            return list(available)
+        selected = [field.strip() for field in self.fields.split(",") if field.strip()]
+        unknown = [field for field in selected if field not in available]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=ResponseSchema(
+                    success=False,
+                    message=f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}",
+                ).model_dump(),
+            )
+        return selected
+
+    def next_cursor(self, ids: List[int]) -> Optional[int]:
+        """Cursor for the following page, or None if this page was the last."""
+        return ids[-1] if len(ids) == self.limit else None
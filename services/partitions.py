@@ -0,0 +1,208 @@
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+from sqlalchemy import text
+from typing import Iterator, Optional, Tuple
+import asyncio
+import glob
+import gzip
+import json
+import logging
+import os
+
+from db import get_engine
+from models import AccessLog
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Partition access_logs by day and archive old partitions (MySQL only)
+LOG_PARTITIONING = os.getenv("LOG_PARTITIONING", "false").lower() in ("1", "true", "yes")
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "90"))
+LOG_PARTITION_DAYS_AHEAD = int(os.getenv("LOG_PARTITION_DAYS_AHEAD", "7"))
+LOG_PARTITION_CHECK_INTERVAL = float(os.getenv("LOG_PARTITION_CHECK_INTERVAL", "3600"))
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "archive/access_logs")
+
+TABLE = AccessLog.__tablename__
+# MySQL TO_DAYS(d) is Python's d.toordinal() shifted by one year of days
+TO_DAYS_OFFSET = 365
+HISTORY_PARTITION = "p_history"
+MAX_PARTITION = "pmax"
+ARCHIVE_COLUMNS = ["id", "user_id", "endpoint", "action", "success", "message", "timestamp"]
+
+
+def to_days(day: date) -> int:
+    return day.toordinal() + TO_DAYS_OFFSET
+
+
+def from_days(days: int) -> date:
+    return date.fromordinal(days - TO_DAYS_OFFSET)
+
+
+def partition_name(day: date) -> str:
+    return f"p{day:%Y%m%d}"
+
+
+def partition_clause(day: date) -> str:
+    """Partition holding the rows of a single day."""
+    return f"PARTITION {partition_name(day)} VALUES LESS THAN ({to_days(day + timedelta(days=1))})"
+
+
+def list_partitions(connection):
+    """Return (name, upper bound in TO_DAYS, or None for MAXVALUE) ordered by position."""
+    rows = connection.execute(
+        text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        ),
+        {"table": TABLE},
+    ).all()
+    return [
+        (name, None if description == "MAXVALUE" else int(description))
+        for name, description in rows
+        if name is not None
+    ]
+
+
+def ensure_partitions(connection, today: date):
+    """Partition the table on first run and keep LOG_PARTITION_DAYS_AHEAD days of empty partitions ahead."""
+    partitions = list_partitions(connection)
+    days = [today + timedelta(days=offset) for offset in range(LOG_PARTITION_DAYS_AHEAD + 1)]
+
+    if not partitions:
+        # MySQL requires the partitioning column in every unique key, including the primary key
+        primary_key = {
+            row.Column_name
+            for row in connection.execute(text(f"SHOW KEYS FROM {TABLE} WHERE Key_name = 'PRIMARY'"))
+        }
+        alter_key = "" if "timestamp" in primary_key else "DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp) "
+        # Everything already in the table lands in the history partition
+        clauses = [f"PARTITION {HISTORY_PARTITION} VALUES LESS THAN ({to_days(today)})"]
+        clauses += [partition_clause(day) for day in days]
+        clauses.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+        connection.execute(
+            text(f"ALTER TABLE {TABLE} {alter_key}PARTITION BY RANGE (TO_DAYS(timestamp)) ({', '.join(clauses)})")
+        )
+        logger.info("Partitioned %s by day", TABLE)
+        return
+
+    last_bound = max(bound for _, bound in partitions if bound is not None)
+    missing = [day for day in days if to_days(day) >= last_bound]
+    if missing:
+        clauses = [partition_clause(day) for day in missing]
+        clauses.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+        connection.execute(
+            text(f"ALTER TABLE {TABLE} REORGANIZE PARTITION {MAX_PARTITION} INTO ({', '.join(clauses)})")
+        )
+
+
+def archive_path(first_day: date, last_day: date) -> str:
+    return os.path.join(LOG_ARCHIVE_DIR, f"{TABLE}_{first_day:%Y%m%d}_{last_day:%Y%m%d}.ndjson.gz")
+
+
+def archive_partition(connection, name: str, upper_bound: int) -> Optional[str]:
+    """
+    Write every row of a partition to a gzipped NDJSON file ordered by (timestamp, id).
+
+    The file is written under a temporary name and renamed once complete, so a crash never
+    leaves a partial archive behind a dropped partition. Returns the path, or None if the
+    partition was empty.
+    """
+    first = connection.execute(text(f"SELECT MIN(timestamp) FROM {TABLE} PARTITION ({name})")).scalar()
+    if first is None:
+        return None
+
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    path = archive_path(first.date(), from_days(upper_bound) - timedelta(days=1))
+    rows = connection.execute(
+        text(
+            f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM {TABLE} PARTITION ({name}) "
+            "ORDER BY timestamp, id"
+        ).execution_options(stream_results=True, yield_per=1000)
+    )
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as archive:
+        for row in rows:
+            log = row._asdict()
+            log["success"] = bool(log["success"])
+            log["timestamp"] = log["timestamp"].isoformat()
+            archive.write(json.dumps(log) + "\n")
+        archive.flush()
+        os.fsync(archive.fileno())
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def expire_partitions(connection, today: date):
+    """Archive and drop partitions whose rows are all older than LOG_RETENTION_DAYS."""
+    cutoff = to_days(today - timedelta(days=LOG_RETENTION_DAYS))
+    for name, upper_bound in list_partitions(connection):
+        if upper_bound is None or upper_bound > cutoff:
+            continue
+        path = archive_partition(connection, name, upper_bound)
+        connection.execute(text(f"ALTER TABLE {TABLE} DROP PARTITION {name}"))
+        logger.info("Dropped partition %s of %s, archived to %s", name, TABLE, path)
+
+
+def maintain_partitions():
+    """
+    One round of partition maintenance. Only one worker runs it at a time, the others skip.
+    """
+    with get_engine().connect() as connection:
+        if not connection.execute(text("SELECT GET_LOCK('access_log_partitions', 0)")).scalar():
+            return
+        try:
+            today = date.today()
+            ensure_partitions(connection, today)
+            expire_partitions(connection, today)
+        finally:
+            connection.execute(text("SELECT RELEASE_LOCK('access_log_partitions')"))
+
+
+async def manage_log_partitions():
+    """
+    Background task that keeps access_logs partitions and the archive up to date.
+    """
+    while True:
+        try:
+            await asyncio.to_thread(maintain_partitions)
+        except Exception:
+            logger.exception("Access log partition maintenance failed")
+        await asyncio.sleep(LOG_PARTITION_CHECK_INTERVAL)
+
+
+def archived_files(start_time: datetime, end_time: datetime):
+    """Archive files whose day range overlaps [start_time, end_time], oldest first."""
+    files = []
+    for path in glob.glob(os.path.join(LOG_ARCHIVE_DIR, f"{TABLE}_*_*.ndjson.gz")):
+        first, last = os.path.basename(path)[len(TABLE) + 1:].split(".")[0].split("_")
+        first_day = datetime.strptime(first, "%Y%m%d").date()
+        last_day = datetime.strptime(last, "%Y%m%d").date()
+        if first_day <= end_time.date() and last_day >= start_time.date():
+            files.append((first_day, path))
+    return [path for _, path in sorted(files)]
+
+
+def read_archived_logs(
+    start_time: datetime,
+    end_time: datetime,
+    after: Optional[Tuple[datetime, str]] = None,
+) -> Iterator[dict]:
+    """
+    Yield archived logs in the range ordered by (timestamp, id), optionally after a cursor position.
+
+    Archived days always precede the rows still in MySQL, so callers can simply chain
+    this with the live query.
+    """
+    for path in archived_files(start_time, end_time):
+        with gzip.open(path, "rt", encoding="utf-8") as archive:
+            for line in archive:
+                log = json.loads(line)
+                log["timestamp"] = datetime.fromisoformat(log["timestamp"])
+                if log["timestamp"] < start_time:
+                    continue
+                if log["timestamp"] > end_time:
+                    break
+                if after and (log["timestamp"], log["id"]) <= after:
+                    continue
+                yield log
@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, or_, select
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from models import Permission, PolicyChange, Role, User, role_closure, role_permission
+from services.authz import SUPERUSER_ROLE
+from services.policy_evaluator import (
+    DELTA,
+    FORMAT_VERSION,
+    FULL,
+    HEADER,
+    KEY_ID,
+    MAGIC,
+    SUPERUSER,
+    U8,
+    U16,
+    U32,
+    USER,
+)
+
+# Permission required to read policy snapshots and deltas, seeded by db.bootstrap()
+POLICY_READ_PERMISSION = "policy:read"
+# Beyond this many changed keys a full snapshot is cheaper than the IN query of a delta
+POLICY_DELTA_MAX_KEYS = 10000
+# Versions are allocated at insert but become visible at commit, possibly out of order, so
+# deltas also resend keys changed this recently. Resending a key is harmless.
+POLICY_DELTA_REPLAY_SECONDS = 60
+
+
+def record_key_changes(db: Session, key_ids: Iterable[str]):
+    """Bump the policy version for API keys that were created, rotated, revoked or changed role."""
+    rows = [{"kind": "key", "key_id": key_id} for key_id in key_ids]
+    if rows:
+        db.execute(insert(PolicyChange), rows)
+
+
+def record_roles_change(db: Session) -> int:
+    """Bump the policy version after a change to role grants or the role hierarchy, and return it."""
+    return db.execute(insert(PolicyChange).values(kind="roles")).inserted_primary_key[0]
+
+
+def policy_version(db: Session) -> int:
+    return db.execute(select(func.max(PolicyChange.id))).scalar() or 0
+
+
+def roles_version(db: Session) -> int:
+    """Policy version of the last change to role grants or the hierarchy, which is also the catalog version."""
+    return db.execute(select(func.max(PolicyChange.id)).where(PolicyChange.kind == "roles")).scalar() or 0
+
+
+def encode_string(value: str, length) -> bytes:
+    data = value.encode()
+    return length.pack(len(data)) + data
+
+
+def encode_roles(db: Session) -> Tuple[bytes, Dict[int, int]]:
+    """
+    The permissions and roles sections, with each role's effective roles and permissions.
+
+    Returns the encoded sections and the role index of every role id, for the users section.
+    """
+    permissions = db.execute(select(Permission.name).order_by(Permission.id)).scalars().all()
+    permission_index = {name: index for index, name in enumerate(permissions)}
+    roles = db.execute(select(Role.id, Role.name).order_by(Role.id)).all()
+    role_index = {role_id: index for index, (role_id, _) in enumerate(roles)}
+
+    grants: Dict[int, Set[str]] = {}
+    for role_id, name in db.execute(
+        select(role_permission.c.role_id, Permission.name).join(Permission, Permission.id == role_permission.c.permission_id)
+    ):
+        grants.setdefault(role_id, set()).add(name)
+    ancestors: Dict[int, Set[int]] = {}
+    for role_id, ancestor_id in db.execute(select(role_closure.c.role_id, role_closure.c.ancestor_id)):
+        ancestors.setdefault(role_id, set()).add(ancestor_id)
+
+    data = U16.pack(len(permissions)) + b"".join(encode_string(name, U16) for name in permissions)
+    data += U8.pack(len(roles))
+    for role_id, name in roles:
+        # Mirrors PermissionMatrix: the superuser holds every role and permission
+        if name.value == SUPERUSER_ROLE:
+            flags = SUPERUSER
+            effective_roles = [role_index[other_id] for other_id, _ in roles]
+            effective_permissions = list(range(len(permissions)))
+        else:
+            flags = 0
+            inherited = ancestors.get(role_id, set()) | {role_id}
+            effective_roles = sorted(role_index[other_id] for other_id in inherited if other_id in role_index)
+            effective_permissions = sorted(
+                {permission_index[permission] for other_id in inherited for permission in grants.get(other_id, ())}
+            )
+        data += encode_string(name.value, U8) + U8.pack(flags)
+        data += U8.pack(len(effective_roles)) + b"".join(U8.pack(index) for index in effective_roles)
+        data += U16.pack(len(effective_permissions)) + b"".join(U16.pack(index) for index in effective_permissions)
+    return data, role_index
+
+
+def encode_users(db: Session, role_index: Dict[int, int], key_ids: Optional[List[str]] = None) -> Tuple[bytes, Set[str]]:
+    """The users section for every API key, or only for `key_ids`. Also returns the key ids found."""
+    query = select(User.key_id, User.api_key_hash, User.id, User.role_id).where(User.role_id.is_not(None))
+    if key_ids is not None:
+        query = query.where(User.key_id.in_(key_ids))
+    rows = db.execute(query).all()
+    data = U32.pack(len(rows)) + b"".join(
+        USER.pack(bytes.fromhex(key_id), digest, user_id, role_index[role_id])
+        for key_id, digest, user_id, role_id in rows
+    )
+    return data, {row.key_id for row in rows}
+
+
+def build_snapshot(db: Session) -> Tuple[bytes, int]:
+    """Encode the whole policy. Returns the snapshot and its version."""
+    version = policy_version(db)
+    roles, role_index = encode_roles(db)
+    users, _ = encode_users(db, role_index)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, FULL, 0, version) + roles + users + U32.pack(0), version
+
+
+def build_delta(db: Session, since: int) -> Tuple[bytes, int]:
+    """
+    Encode the changes made after version `since`. Returns the delta and its version.
+
+    Falls back to a full snapshot when `since` is newer than the current version (e.g.
+    the database was restored), older than the oldest change still in policy_changes (so
+    old rows can be deleted from that table at any time), or too many keys changed.
+    """
+    version = policy_version(db)
+    oldest = db.execute(select(func.min(PolicyChange.id))).scalar()
+    if since > version or (oldest is not None and since < oldest - 1):
+        return build_snapshot(db)
+
+    changed = db.execute(
+        select(PolicyChange.key_id)
+        .where(
+            or_(PolicyChange.id > since, PolicyChange.timestamp >= datetime.now() - timedelta(seconds=POLICY_DELTA_REPLAY_SECONDS)),
+            PolicyChange.id <= version,
+            PolicyChange.kind == "key",
+        )
+        .distinct()
+    ).scalars().all()
+    if len(changed) > POLICY_DELTA_MAX_KEYS:
+        return build_snapshot(db)
+
+    roles, role_index = encode_roles(db)
+    users, found = encode_users(db, role_index, changed)
+    removed = [key_id for key_id in changed if key_id not in found]
+    data = HEADER.pack(MAGIC, FORMAT_VERSION, DELTA, since, version) + roles + users
+    data += U32.pack(len(removed)) + b"".join(KEY_ID.pack(bytes.fromhex(key_id)) for key_id in removed)
+    return data, version
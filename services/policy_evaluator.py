@@ -0,0 +1,254 @@
+"""
+In-process evaluator for the policy snapshots served by GET /policy/snapshot and /policy/delta.
+
+Standard library only, so an edge service can vendor this single file. It answers the
+same decisions as the allow_access dependency:
+
+    evaluator = PolicyEvaluator(pepper=b"<API_KEY_PEPPER>")
+    # Any API key whose role holds the policy:read permission
+    PolicySync(evaluator, "https://rbac.internal", sync_api_key).start()
+    decision = evaluator.authorize(api_key, allowed_roles=["Supervisor"])
+
+Binary format, little-endian:
+
+    header      magic "RBPS", format u8, kind u8 (0 full, 1 delta), base version u64, version u64
+    permissions u16 count, then u16 length + UTF-8 name each
+    roles       u8 count, then per role: u8 length + UTF-8 name, u8 flags (1 = superuser),
+                u8 count + u8 indexes of its effective roles (itself and every ancestor),
+                u16 count + u16 indexes of its effective permissions
+    users       u32 count, then per API key: 6 byte key id, 32 byte digest, u32 user id, u8 role index
+    removed     u32 count, then 6 byte key ids that no longer exist (always 0 in a full snapshot)
+
+A full snapshot replaces everything. A delta applies on top of `base version` and carries
+the complete roles and permissions sections plus every API key changed since then.
+"""
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+import hashlib
+import hmac
+import logging
+import struct
+import threading
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RBPS"
+FORMAT_VERSION = 1
+FULL = 0
+DELTA = 1
+SUPERUSER = 1
+
+HEADER = struct.Struct("<4sBBQQ")
+USER = struct.Struct("<6s32sIB")
+KEY_ID = struct.Struct("<6s")
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+
+KEY_ID_LENGTH = 12  # Hex characters
+LEGACY_KEY_LENGTH = 32
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+class PolicyFormatError(ValueError):
+    """Raised for data that is not a snapshot, or a delta that does not apply to the loaded version."""
+
+
+class RolePolicy(NamedTuple):
+    roles: FrozenSet[str]  # The role itself and every role it inherits
+    permissions: FrozenSet[str]
+    superuser: bool  # The role allow_access requires when no roles are given
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    message: str
+    user_id: Optional[int] = None
+    role: Optional[str] = None
+
+
+class Reader:
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def read(self, layout: struct.Struct) -> tuple:
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def number(self, layout: struct.Struct) -> int:
+        return self.read(layout)[0]
+
+    def string(self, length: struct.Struct) -> str:
+        size = self.number(length)
+        value = bytes(self.data[self.offset:self.offset + size]).decode()
+        self.offset += size
+        return value
+
+
+def decode(data: bytes) -> dict:
+    """Parse a snapshot or delta into plain Python structures."""
+    reader = Reader(data)
+    try:
+        magic, format_version, kind, base_version, version = reader.read(HEADER)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise PolicyFormatError("Not a policy snapshot this evaluator understands")
+
+        permissions = [reader.string(U16) for _ in range(reader.number(U16))]
+        role_rows = []
+        for _ in range(reader.number(U8)):
+            name = reader.string(U8)
+            flags = reader.number(U8)
+            role_indexes = [reader.number(U8) for _ in range(reader.number(U8))]
+            permission_indexes = [reader.number(U16) for _ in range(reader.number(U16))]
+            role_rows.append((name, flags, role_indexes, permission_indexes))
+        names = [row[0] for row in role_rows]
+        roles = {
+            name: RolePolicy(
+                roles=frozenset(names[index] for index in role_indexes),
+                permissions=frozenset(permissions[index] for index in permission_indexes),
+                superuser=bool(flags & SUPERUSER),
+            )
+            for name, flags, role_indexes, permission_indexes in role_rows
+        }
+
+        users = {}
+        for _ in range(reader.number(U32)):
+            key_id, digest, user_id, role_index = reader.read(USER)
+            users[key_id.hex()] = (digest, user_id, names[role_index])
+        removed = [reader.read(KEY_ID)[0].hex() for _ in range(reader.number(U32))]
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise PolicyFormatError(f"Truncated or corrupt policy snapshot: {e}")
+
+    return {
+        "kind": kind,
+        "base_version": base_version,
+        "version": version,
+        "roles": roles,
+        "users": users,
+        "removed": removed,
+    }
+
+
+def legacy_key_id(api_key: str, pepper: bytes) -> str:
+    """Key id given to a legacy API key, from before keys had an id, when its users row was migrated."""
+    return hmac.new(pepper, b"legacy:" + api_key.encode(), hashlib.sha256).hexdigest()[:KEY_ID_LENGTH]
+
+
+def split_api_key(api_key: str, pepper: bytes) -> Optional[Tuple[str, str]]:
+    """
+    Split a presented API key into (key id, secret), or None if it is not well formed.
+
+    Keys are "<key id>.<secret>" with a key id of 12 hex digits. Anything else of
+    LEGACY_KEY_LENGTH characters is a legacy key, which may contain any punctuation
+    including ".", and is checked whole under the key id legacy_key_id() derives from it.
+    """
+    key_id, _, secret = api_key.partition(".")
+    if secret and len(key_id) == KEY_ID_LENGTH and HEX_DIGITS.issuperset(key_id):
+        return key_id, secret
+    if len(api_key) == LEGACY_KEY_LENGTH:
+        return legacy_key_id(api_key, pepper), api_key
+    return None
+
+
+def required_roles_for(allowed_roles: Optional[List[str]], permissions: Optional[List[str]], superuser: str) -> Optional[FrozenSet[str]]:
+    # Same rules as services.helpers.required_roles_for
+    if (allowed_roles and "*" in allowed_roles) or (permissions and not allowed_roles):
+        return None
+    return frozenset(allowed_roles or [superuser])
+
+
+class PolicyEvaluator:
+    """Holds a policy snapshot in memory and authorizes API keys against it."""
+
+    def __init__(self, pepper: bytes = b""):
+        self.pepper = pepper
+        self.version = 0
+        self.loaded = False
+        self._roles: Dict[str, RolePolicy] = {}
+        self._users: Dict[str, Tuple[bytes, int, str]] = {}
+        self._lock = threading.Lock()
+
+    def apply(self, data: bytes):
+        """Load a full snapshot, or apply a delta on top of the loaded version."""
+        policy = decode(data)
+        with self._lock:
+            if policy["kind"] == DELTA:
+                if not self.loaded or policy["base_version"] != self.version:
+                    raise PolicyFormatError(
+                        f"Delta from version {policy['base_version']} does not apply to version {self.version}"
+                    )
+                users = dict(self._users)
+                for key_id in policy["removed"]:
+                    users.pop(key_id, None)
+                users.update(policy["users"])
+            else:
+                users = policy["users"]
+            # Swap whole dicts so concurrent authorize() calls never see a half-applied update
+            self._roles = policy["roles"]
+            self._users = users
+            self.version = policy["version"]
+            self.loaded = True
+
+    def superuser_role(self) -> Optional[str]:
+        return next((name for name, role in self._roles.items() if role.superuser), None)
+
+    def authorize(
+        self,
+        api_key: str,
+        allowed_roles: Optional[List[str]] = None,
+        permissions: Optional[List[str]] = None,
+    ) -> Decision:
+        """Decide like allow_access(allowed_roles, permissions) would for a request with this key."""
+        parsed = split_api_key(api_key, self.pepper)
+        user = self._users.get(parsed[0]) if parsed else None
+        if not user or not hmac.compare_digest(user[0], hmac.new(self.pepper, parsed[1].encode(), hashlib.sha256).digest()):
+            return Decision(False, "Invalid API key")
+
+        _, user_id, role_name = user
+        role = self._roles.get(role_name, RolePolicy(frozenset({role_name}), frozenset(), False))
+        # The superuser role is exported with every role and every existing permission
+        required = required_roles_for(allowed_roles, permissions, self.superuser_role())
+        allowed = (required is None or not required.isdisjoint(role.roles)) and role.permissions.issuperset(permissions or ())
+        if not allowed:
+            return Decision(False, "Insufficient privileges", user_id, role_name)
+        return Decision(True, "", user_id, role_name)
+
+
+class PolicySync(threading.Thread):
+    """Daemon thread that keeps an evaluator in sync with the service, falling back to a full snapshot when needed."""
+
+    def __init__(self, evaluator: PolicyEvaluator, base_url: str, api_key: str, interval: float = 5.0):
+        super().__init__(daemon=True)
+        self.evaluator = evaluator
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def fetch(self, path: str) -> bytes:
+        request = urllib.request.Request(self.base_url + path, headers={"Authorization": self.api_key})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.read()
+
+    def sync(self):
+        if self.evaluator.loaded:
+            try:
+                self.evaluator.apply(self.fetch(f"/policy/delta?since={self.evaluator.version}"))
+                return
+            except PolicyFormatError:
+                logger.warning("Policy delta did not apply, reloading the full snapshot")
+        self.evaluator.apply(self.fetch("/policy/snapshot"))
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.sync()
+            except Exception:
+                # Keep deciding with the last good snapshot
+                logger.exception("Policy sync failed")
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,124 @@
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from typing import AsyncIterator, Dict, List, Set
+import csv
+import json
+
+from models import Role, User
+from services.helpers import generate_api_keys
+from services.policy import record_key_changes
+
+
+def load_role_ids(db: Session) -> Dict[str, int]:
+    """Resolve every role name to its id once for the whole import."""
+    return {role.name.value: role.id for role in db.query(Role).all()}
+
+
+async def read_lines(body: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a streamed request body into lines without reading it all into memory."""
+    buffered = b""
+    async for chunk in body:
+        buffered += chunk
+        *complete, buffered = buffered.split(b"\n")
+        for raw in complete:
+            yield raw.decode("utf-8")
+    if buffered:
+        yield buffered.decode("utf-8")
+
+
+async def read_rows(body: AsyncIterator[bytes], is_csv: bool) -> AsyncIterator[dict]:
+    """
+    Parse a streamed NDJSON or CSV body into {"line", "username", "role"} rows, or
+    {"line", "error"} for lines that cannot be parsed. CSV bodies need a header row.
+    """
+    header = None
+    line_number = 0
+    async for line in read_lines(body):
+        line_number += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if is_csv:
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = values
+                    continue
+                row = dict(zip(header, values))
+            else:
+                row = json.loads(line)
+            if not isinstance(row["username"], str) or not row["username"]:
+                raise ValueError("username must be a non-empty string")
+            yield {"line": line_number, "username": row["username"], "role": row.get("role") or "Staff"}
+        except (ValueError, KeyError, TypeError, AttributeError):
+            yield {"line": line_number, "error": "Malformed row"}
+
+
+async def read_chunks(rows: AsyncIterator[dict], size: int) -> AsyncIterator[List[dict]]:
+    """Group parsed rows into lists of at most `size`."""
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def insert_chunk(db: Session, role_ids: Dict[str, int], rows: List[dict], seen: Set[str]) -> List[dict]:
+    """
+    Insert one chunk of rows inside the caller's transaction and return a result per row.
+
+    Existing usernames are found with a single IN query for the chunk, the new users are
+    written with one executemany insert and their ids read back with one more query.
+    """
+    results = {}
+    candidates = []
+    for row in rows:
+        if "error" in row:
+            results[row["line"]] = {"line": row["line"], "success": False, "message": row["error"]}
+        elif row["role"] not in role_ids:
+            results[row["line"]] = {"line": row["line"], "success": False, "message": "Invalid Role"}
+        elif row["username"] in seen:
+            results[row["line"]] = {"line": row["line"], "success": False, "message": "Duplicate username in import"}
+        else:
+            seen.add(row["username"])
+            candidates.append(row)
+
+    usernames = [row["username"] for row in candidates]
+    existing = set(db.execute(select(User.username).where(User.username.in_(usernames))).scalars()) if usernames else set()
+    new_rows = [row for row in candidates if row["username"] not in existing]
+    for row in candidates:
+        if row["username"] in existing:
+            results[row["line"]] = {"line": row["line"], "success": False, "message": "User already exists"}
+
+    if new_rows:
+        issued = generate_api_keys(len(new_rows))
+        values = [
+            {
+                "username": row["username"],
+                "role_id": role_ids[row["role"]],
+                "key_id": key.key_id,
+                "api_key_hash": key.digest,
+            }
+            for row, key in zip(new_rows, issued)
+        ]
+        db.execute(insert(User), values)
+        record_key_changes(db, [key.key_id for key in issued])
+        ids = dict(
+            db.execute(
+                select(User.username, User.id).where(User.username.in_([row["username"] for row in new_rows]))
+            ).all()
+        )
+        for row, key in zip(new_rows, issued):
+            results[row["line"]] = {
+                "line": row["line"],
+                "success": True,
+                "id": ids[row["username"]],
+                "username": row["username"],
+                "role": row["role"],
+                "api_key": key.api_key,
+            }
+
+    return [results[row["line"]] for row in rows]
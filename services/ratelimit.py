@@ -0,0 +1,173 @@
+from dotenv import load_dotenv
+from models import RoleEnum
+from redis.exceptions import RedisError
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+from services.log import ACCESS_LOG_STREAM_KEY, ACCESS_LOGS_KEY, LOG_PUSH_BUDGET_MS, LOG_TRANSPORT
+from services.redis import get_redis, redis_breaker
+from services.telemetry import rate_limit_seconds
+import asyncio
+import logging
+import math
+import os
+import time
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITING = os.getenv("RATE_LIMITING", "true").lower() in ("1", "true", "yes")
+
+# "<tokens per second>/<burst>" per role; RATE_LIMIT_<ROLE> applies to each API key of
+# that role and RATE_LIMIT_ROLE_<ROLE>, if set, to all keys of the role together
+DEFAULT_KEY_LIMITS = {
+    RoleEnum.STAFF: "10/20",
+    RoleEnum.SUPERVISOR: "20/40",
+    RoleEnum.ADMIN: "50/100",
+}
+
+RATE_LIMIT_KEY_PREFIX = "rate_limit"
+
+# Takes one token from every bucket only if each has one, then appends the access log entry
+# for the outcome, so the check and the log write are a single atomic round trip.
+# KEYS: bucket hashes..., log list or stream
+# ARGV: transport, entry if allowed, entry if limited, then rate and burst per bucket
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local buckets = #KEYS - 1
+local allowed = 1
+local retry_ms = 0
+local states = {}
+for i = 1, buckets do
+    local rate = tonumber(ARGV[2 + 2 * i])
+    local burst = tonumber(ARGV[3 + 2 * i])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+    tokens = math.min(burst, tokens + elapsed * rate / 1000)
+    if tokens < 1 then
+        allowed = 0
+        retry_ms = math.max(retry_ms, math.ceil((1 - tokens) * 1000 / rate))
+    end
+    states[i] = {tokens, rate, burst}
+end
+local remaining = -1
+for i = 1, buckets do
+    local tokens, rate, burst = states[i][1], states[i][2], states[i][3]
+    if allowed == 1 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens), 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], math.ceil(burst * 1000 / rate) + 1000)
+    if i == 1 then
+        remaining = math.floor(tokens)
+    end
+end
+local entry = allowed == 1 and ARGV[2] or ARGV[3]
+if ARGV[1] == 'stream' then
+    redis.call('XADD', KEYS[buckets + 1], '*', 'entry', entry)
+else
+    redis.call('RPUSH', KEYS[buckets + 1], entry)
+end
+return {allowed, remaining, retry_ms}
+"""
+
+
+class RateLimit(NamedTuple):
+    rate: float  # Tokens added per second
+    burst: int  # Bucket size
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: int  # Seconds until a token is available, 0 when allowed
+
+    def headers(self) -> Dict[str, str]:
+        headers = {"X-RateLimit-Limit": str(self.limit), "X-RateLimit-Remaining": str(max(0, self.remaining))}
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+def parse_limit(value: str) -> Optional[RateLimit]:
+    if not value:
+        return None
+    rate, _, burst = value.partition("/")
+    return RateLimit(float(rate), int(burst or math.ceil(float(rate))))
+
+
+def load_limits(prefix: str, defaults: Dict[RoleEnum, str]) -> Dict[str, RateLimit]:
+    limits = {}
+    for role in RoleEnum:
+        limit = parse_limit(os.getenv(f"{prefix}_{role.name}", defaults.get(role, "")))
+        if limit:
+            limits[role.value] = limit
+    return limits
+
+
+KEY_LIMITS = load_limits("RATE_LIMIT", DEFAULT_KEY_LIMITS)
+ROLE_LIMITS = load_limits("RATE_LIMIT_ROLE", {})
+
+_script = None
+
+
+def token_bucket():
+    global _script
+    if _script is None:
+        # Sent with EVALSHA, falling back to EVAL the first time a server sees it
+        _script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+    return _script
+
+
+def buckets_for(key_id: str, role: str) -> List[Tuple[str, RateLimit]]:
+    buckets = []
+    if role in KEY_LIMITS:
+        buckets.append((f"{RATE_LIMIT_KEY_PREFIX}:key:{key_id}", KEY_LIMITS[role]))
+    if role in ROLE_LIMITS:
+        buckets.append((f"{RATE_LIMIT_KEY_PREFIX}:role:{role}", ROLE_LIMITS[role]))
+    return buckets
+
+
+async def limit_and_log(key_id: str, role: str, entry: Union[bytes, str], limited_entry: Union[bytes, str]) -> Optional[RateLimitResult]:
+    """
+    Take a token for the API key and queue its access log entry in one Redis call.
+
+    `entry` is queued if the request is allowed and `limited_entry` if it is not. Returns
+    None without logging anything when the role has no limits or Redis is unavailable or
+    slower than LOG_PUSH_BUDGET_MS, so the caller logs through the buffer instead and the
+    request is let through. While redis_breaker is open Redis is not even tried.
+    """
+    buckets = buckets_for(key_id, role)
+    if not RATE_LIMITING or not buckets or redis_breaker.open:
+        return None
+
+    log_key = ACCESS_LOG_STREAM_KEY if LOG_TRANSPORT == "stream" else ACCESS_LOGS_KEY
+    args = [LOG_TRANSPORT, entry, limited_entry]
+    for _, limit in buckets:
+        args += [limit.rate, limit.burst]
+
+    started = time.perf_counter()
+    try:
+        allowed, remaining, retry_ms = await asyncio.wait_for(
+            token_bucket()(keys=[key for key, _ in buckets] + [log_key], args=args, client=get_redis()),
+            LOG_PUSH_BUDGET_MS / 1000,
+        )
+    except asyncio.TimeoutError:
+        # The script may still run, in which case the entry is logged twice
+        logger.warning("Rate limit check exceeded %sms, letting requests through", LOG_PUSH_BUDGET_MS)
+        redis_breaker.trip()
+        return None
+    except RedisError:
+        logger.exception("Rate limit check failed, letting requests through")
+        redis_breaker.trip()
+        return None
+    finally:
+        rate_limit_seconds.observe(time.perf_counter() - started)
+    return RateLimitResult(
+        allowed=bool(allowed),
+        limit=buckets[0][1].burst,
+        remaining=remaining,
+        retry_after=math.ceil(retry_ms / 1000),
+    )
@@ -1,8 +1,50 @@
 import os
+import time
 import redis.asyncio as aioredis
 from dotenv import load_dotenv
 
 load_dotenv()
 
 service_uri = os.getenv("REDIS_URL")
-redis = aioredis.from_url(service_uri)
\ No newline at end of file
+redis = None
+
+# After an optional Redis call on the request path fails or runs over its budget, such calls
+# are skipped for this long, so requests do not each wait out the budget while Redis stalls
+REDIS_BREAKER_SECONDS = float(os.getenv("REDIS_BREAKER_SECONDS", "2"))
+
+
+class RedisBreaker:
+    """
+    Circuit breaker for the Redis calls requests can do without: rate limits, the shared
+    auth cache and the cached catalog version. Once the cooldown is over the next calls go
+    to Redis again and trip it anew if Redis is still failing.
+    """
+
+    def __init__(self, cooldown: float = REDIS_BREAKER_SECONDS):
+        self.cooldown = cooldown
+        self.open_until = 0.0
+
+    @property
+    def open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def trip(self):
+        self.open_until = time.monotonic() + self.cooldown
+
+
+redis_breaker = RedisBreaker()
+
+
+def get_redis() -> aioredis.Redis:
+    """Return the shared client, creating it on first use. Connections are opened lazily by the pool."""
+    global redis
+    if redis is None:
+        redis = aioredis.from_url(service_uri)
+    return redis
+
+
+async def close_redis():
+    global redis
+    if redis is not None:
+        await redis.aclose()
+        redis = None
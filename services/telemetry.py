@@ -0,0 +1,311 @@
+from bisect import bisect_left
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from typing import Callable, Dict, List, Sequence, Tuple
+import asyncio
+import logging
+import os
+import threading
+import time
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_ENABLED = os.getenv("TELEMETRY_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Seconds, from a local cache hit to a slow MySQL round trip
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 2500, 5000, 10000)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+# A collector slower than this is abandoned so the scrape still answers while Redis stalls
+TELEMETRY_COLLECT_TIMEOUT_MS = float(os.getenv("TELEMETRY_COLLECT_TIMEOUT_MS", "250"))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base for metrics kept in memory and rendered in the Prometheus text format."""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        if not TELEMETRY_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_total(self, value: float, *labels: str):
+        """Mirror a total counted elsewhere, e.g. by a collector just before a scrape."""
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in values]
+
+
+class Gauge(Metric):
+    """Last value set, usually by a collector just before a scrape."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in values]
+
+
+class Histogram(Metric):
+    """Cumulative bucket histogram. observe() is a bisect and a few additions under a lock."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket..., count above the last bucket], sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        if not TELEMETRY_ENABLED:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(counts), total[0]) for labels, (counts, total) in self._values.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+registry: List[Metric] = []
+# Refresh gauges that are only worth reading when scraped, e.g. Redis queue lengths
+collectors: List[Callable] = []
+
+
+def collector(function: Callable) -> Callable:
+    """Register an async function run before every scrape."""
+    collectors.append(function)
+    return function
+
+
+async def render_metrics() -> str:
+    for collect in collectors:
+        try:
+            await asyncio.wait_for(collect(), TELEMETRY_COLLECT_TIMEOUT_MS / 1000)
+        except (RedisError, asyncio.TimeoutError) as e:
+            # Only this collector's metrics keep their previous values; the rest still render
+            logger.warning("Telemetry collector %s failed: %r", collect.__name__, e)
+            telemetry_collect_failures_total.inc(collect.__name__)
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+access_phase_seconds = Histogram(
+    "rbac_access_phase_seconds",
+    "Time spent in each phase of the allow_access dependency",
+    ["phase"],
+)
+access_decisions_total = Counter(
+    "rbac_access_decisions_total",
+    "allow_access outcomes (allowed, denied, invalid_key or rate_limited)",
+    ["result"],
+)
+principal_lookups_total = Counter(
+    "rbac_principal_lookups_total",
+    "API key id lookups by the tier that answered (local, shared, database, or missing)",
+    ["source"],
+)
+rate_limit_seconds = Histogram(
+    "rbac_rate_limit_seconds",
+    "Round trip of the token bucket script that also queues the access log entry",
+)
+auth_cache_lookups_total = Counter(
+    "rbac_auth_cache_lookups_total",
+    "In-process API key cache lookups by result (hit or miss)",
+    ["result"],
+)
+auth_cache_evictions_total = Counter(
+    "rbac_auth_cache_evictions_total",
+    "Principals evicted from the in-process API key cache to stay within AUTH_CACHE_SIZE",
+)
+auth_cache_entries = Gauge(
+    "rbac_auth_cache_entries",
+    "Principals held in the in-process API key cache",
+)
+log_access_seconds = Histogram(
+    "rbac_log_access_seconds",
+    "Time log_access spent queuing an entry in the in-process buffer",
+)
+log_buffer_dropped_total = Counter(
+    "rbac_log_buffer_dropped_total",
+    "Access log entries dropped because the in-process buffer was full",
+)
+log_push_seconds = Histogram(
+    "rbac_log_push_seconds",
+    "Time to push one buffered batch of access logs to Redis",
+)
+log_push_batch_size = Histogram(
+    "rbac_log_push_batch_size",
+    "Entries per push from the in-process buffer to Redis",
+    buckets=SIZE_BUCKETS,
+)
+log_spilled_total = Counter(
+    "rbac_log_spilled_total",
+    "Access log entries written to the local spill segments because Redis was down or slow",
+)
+log_spill_replayed_total = Counter(
+    "rbac_log_spill_replayed_total",
+    "Spilled access log entries sent on, by target (redis, or database while Redis is unavailable)",
+    ["target"],
+)
+log_spill_bytes = Gauge(
+    "rbac_log_spill_bytes",
+    "Disk space held by spill segments",
+)
+log_dead_letters_total = Counter(
+    "rbac_log_dead_letters_total",
+    "Access log entries the drain could not decode or MySQL rejected, moved to the dead letter list",
+)
+log_drain_phase_seconds = Histogram(
+    "rbac_log_drain_phase_seconds",
+    "Time spent in each phase of one drain batch (fetch from Redis, write to MySQL)",
+    ["phase"],
+)
+log_drain_batch_size = Histogram(
+    "rbac_log_drain_batch_size",
+    "Entries moved from Redis to MySQL per drain batch",
+    buckets=SIZE_BUCKETS,
+)
+log_drain_lag_seconds = Histogram(
+    "rbac_log_drain_lag_seconds",
+    "Age of the oldest entry in a drain batch when it was committed",
+    buckets=LAG_BUCKETS,
+)
+log_queue_length = Gauge(
+    "rbac_log_queue_length",
+    "Access log entries waiting in Redis",
+    ["transport"],
+)
+pool_checkout_seconds = Histogram(
+    "rbac_db_pool_checkout_seconds",
+    "Time to check a connection out of the SQLAlchemy pool, including waiting for a free one",
+    ["engine"],
+)
+pool_connections = Gauge(
+    "rbac_db_pool_connections",
+    "SQLAlchemy pool connections by state",
+    ["engine", "state"],
+)
+
+admission_rejections_total = Counter(
+    "rbac_admission_rejections_total",
+    "Requests answered with 503 by admission control, by engine and reason",
+    ["engine", "reason"],
+)
+admission_requests = Gauge(
+    "rbac_admission_requests",
+    "Requests holding or waiting for a database admission slot",
+    ["engine", "state"],
+)
+telemetry_collect_failures_total = Counter(
+    "rbac_telemetry_collect_failures_total",
+    "Scrapes on which a collector failed or timed out, by collector",
+    ["collector"],
+)
+
+# Pools registered by timed_pool() so their state can be read at scrape time
+pools: Dict[str, QueuePool] = {}
+# Called with the checkout wait in seconds after every checkout, per engine (see services/admission.py)
+checkout_listeners: Dict[str, List[Callable[[float], None]]] = {}
+
+
+def timed_pool(base: type, engine_name: str) -> type:
+    """
+    Pool class for create_engine(poolclass=...) that times every checkout.
+
+    _do_get is where QueuePool waits for a free connection or opens an overflow one, so
+    timing it measures exactly the checkout wait.
+    """
+
+    class TimedPool(base):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # Also runs for the replacement pool built by engine.dispose()
+            pools[engine_name] = self
+
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                waited = time.perf_counter() - started
+                pool_checkout_seconds.observe(waited, engine_name)
+                for listener in checkout_listeners.get(engine_name, ()):
+                    listener(waited)
+
+    TimedPool.__name__ = f"Timed{base.__name__}"
+    return TimedPool
+
+
+TimedQueuePool = timed_pool(QueuePool, "sync")
+TimedAsyncQueuePool = timed_pool(AsyncAdaptedQueuePool, "async")
+
+
+@collector
+async def collect_pools():
+    for engine_name, pool in list(pools.items()):
+        pool_connections.set(pool.checkedout(), engine_name, "checked_out")
+        pool_connections.set(pool.checkedin(), engine_name, "idle")
+        # Negative until the pool has opened pool_size connections
+        pool_connections.set(max(0, pool.overflow()), engine_name, "overflow")
@@ -0,0 +1,87 @@
+import pytest
+from sqlalchemy import create_engine, delete, insert, select
+from sqlalchemy.orm import Session
+
+from models import Base, Role, RoleEnum, role_closure, role_parents
+from services.hierarchy import RoleHierarchyError, rebuild_closure, set_parents
+
+STAFF, SUPERVISOR, ADMIN = 1, 2, 3
+
+
+@pytest.fixture
+def db():
+    """Roles with the default hierarchy: Admin inherits Supervisor, which inherits Staff."""
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add_all([Role(id=STAFF, name=RoleEnum.STAFF), Role(id=SUPERVISOR, name=RoleEnum.SUPERVISOR), Role(id=ADMIN, name=RoleEnum.ADMIN)])
+        db.flush()
+        db.execute(insert(role_parents), [{"role_id": SUPERVISOR, "parent_id": STAFF}, {"role_id": ADMIN, "parent_id": SUPERVISOR}])
+        rebuild_closure(db)
+        yield db
+    engine.dispose()
+
+
+def closure(db) -> dict:
+    """{role id: {ancestor id: depth}} as stored."""
+    ancestors = {}
+    for role_id, ancestor_id, depth in db.execute(select(role_closure)):
+        ancestors.setdefault(role_id, {})[ancestor_id] = depth
+    return ancestors
+
+
+def rebuilt_closure(db) -> dict:
+    """The closure a full rebuild computes from the current role_parents."""
+    stored = db.execute(select(role_closure)).all()
+    rebuild_closure(db)
+    rebuilt = closure(db)
+    db.execute(delete(role_closure))
+    if stored:
+        db.execute(insert(role_closure), [row._asdict() for row in stored])
+    return rebuilt
+
+
+def test_default_hierarchy(db):
+    assert closure(db) == {
+        STAFF: {STAFF: 0},
+        SUPERVISOR: {SUPERVISOR: 0, STAFF: 1},
+        ADMIN: {ADMIN: 0, SUPERVISOR: 1, STAFF: 2},
+    }
+
+
+def test_removing_a_parent_updates_inheriting_roles(db):
+    set_parents(db, SUPERVISOR, [])
+    assert closure(db) == {
+        STAFF: {STAFF: 0},
+        SUPERVISOR: {SUPERVISOR: 0},
+        ADMIN: {ADMIN: 0, SUPERVISOR: 1},
+    }
+    assert closure(db) == rebuilt_closure(db)
+
+
+def test_adding_a_parent_keeps_the_shortest_depth(db):
+    set_parents(db, ADMIN, [SUPERVISOR, STAFF])
+    assert closure(db)[ADMIN] == {ADMIN: 0, SUPERVISOR: 1, STAFF: 1}
+    assert closure(db) == rebuilt_closure(db)
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        [(SUPERVISOR, []), (STAFF, [ADMIN])],
+        [(ADMIN, []), (STAFF, [ADMIN]), (SUPERVISOR, [STAFF])],
+        [(SUPERVISOR, []), (ADMIN, [STAFF]), (SUPERVISOR, [ADMIN])],
+    ],
+)
+def test_changes_match_a_full_rebuild(db, changes):
+    for role_id, parent_ids in changes:
+        set_parents(db, role_id, parent_ids)
+        assert closure(db) == rebuilt_closure(db), (role_id, parent_ids)
+
+
+@pytest.mark.parametrize("role_id, parent_id", [(STAFF, ADMIN), (STAFF, SUPERVISOR), (ADMIN, ADMIN)])
+def test_cycles_are_rejected(db, role_id, parent_id):
+    before = closure(db)
+    with pytest.raises(RoleHierarchyError):
+        set_parents(db, role_id, [parent_id])
+    assert closure(db) == before
@@ -0,0 +1,122 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from services.log_record import (
+    ACTIONS,
+    ENDPOINTS,
+    MESSAGES,
+    RECORD,
+    RECORD_VERSION,
+    UNDECODABLE_ERRORS,
+    decode_log_entries,
+    decode_log_entry,
+    encode_log_entry,
+)
+
+TIMESTAMP = datetime(2024, 5, 17, 13, 45, 12, 345678)
+
+
+def entry(**overrides) -> dict:
+    values = {
+        "user_id": 42,
+        "endpoint": "/billing",
+        "action": "GET",
+        "success": True,
+        "message": "",
+        "timestamp": TIMESTAMP,
+    }
+    values.update(overrides)
+    return values
+
+
+def round_trip(values: dict) -> dict:
+    return decode_log_entry(encode_log_entry(**values))
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        entry(),
+        entry(success=False, message="Insufficient privileges"),
+        entry(user_id=None, success=False, message="Invalid API key"),
+        entry(message=None),
+        entry(user_id=0),
+        entry(user_id=2**32 - 1),
+        entry(timestamp=datetime(1969, 12, 31, 23, 59, 59, 999999)),
+    ],
+)
+def test_dictionary_values_round_trip(values):
+    assert round_trip(values) == values
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        entry(endpoint="/users/17/api-key"),
+        entry(action="PROPFIND"),
+        entry(message="Role not found"),
+        entry(endpoint="/prüfung/ü", action="", message="naïve ✓"),
+        entry(endpoint="", message=None),
+    ],
+)
+def test_inline_strings_round_trip(values):
+    assert round_trip(values) == values
+
+
+def test_dictionary_values_are_not_written_inline():
+    assert len(encode_log_entry(**entry())) == RECORD.size
+    inline = encode_log_entry(**entry(endpoint="/users/17/api-key"))
+    assert len(inline) == RECORD.size + 2 + len("/users/17/api-key")
+
+
+def test_long_strings_are_cut_at_a_character_boundary():
+    decoded = round_trip(entry(action="é" * 200))
+    assert decoded["action"] == "é" * 127
+
+
+@pytest.mark.parametrize("raw", [json.dumps, lambda log: json.dumps(log).encode()])
+def test_json_entries_are_still_read(raw):
+    log = {
+        "user_id": None,
+        "endpoint": "/all",
+        "action": "GET",
+        "success": False,
+        "message": "Rate limit exceeded",
+        "timestamp": TIMESTAMP.isoformat(),
+    }
+    assert decode_log_entry(raw(log)) == {**log, "timestamp": TIMESTAMP}
+
+
+def test_dictionaries_have_no_duplicates():
+    for values in (ENDPOINTS, ACTIONS, MESSAGES):
+        assert values[0] is None
+        assert len(set(values)) == len(values)
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        b"",
+        b"\x01\x00",
+        RECORD.pack(RECORD_VERSION + 1, 0, 0, 0, 1, 1, 0),
+        RECORD.pack(RECORD_VERSION, 0, 0, 0, len(ENDPOINTS), 1, 0),
+        RECORD.pack(RECORD_VERSION, 0, 0, 0, 0, 1, 0),
+        RECORD.pack(RECORD_VERSION, 0, 0, 0, 0, 1, 0) + b"\x02\x00\xff\xfe",
+        b"{not json",
+        json.dumps({"endpoint": "/all"}).encode(),
+    ],
+)
+def test_corrupt_entries_are_undecodable(raw):
+    with pytest.raises(UNDECODABLE_ERRORS):
+        decode_log_entry(raw)
+
+
+def test_batches_set_aside_undecodable_entries():
+    good = [encode_log_entry(**entry()), encode_log_entry(**entry(endpoint="/inline"))]
+    junk = [b"junk", b"{}"]
+    rows, decoded, rejected = decode_log_entries([good[0], junk[0], good[1], junk[1]])
+    assert rows == [entry(), entry(endpoint="/inline")]
+    assert decoded == good
+    assert rejected == junk
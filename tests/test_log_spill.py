@@ -0,0 +1,156 @@
+import asyncio
+import os
+
+import pytest
+
+from services.log_spill import RECORD, SEGMENT_HEADER, LogSpill, Segment
+
+SEGMENT_SIZE = 4096
+
+ENTRIES = [f"entry {i}".encode() for i in range(5)]
+
+
+@pytest.fixture
+def spill(tmp_path, monkeypatch):
+    """A LogSpill in a temporary directory whose replays are recorded instead of sent."""
+    spill = LogSpill(str(tmp_path), segment_size=SEGMENT_SIZE, max_bytes=4 * SEGMENT_SIZE)
+    spill.sent = []
+
+    async def send(entries):
+        spill.sent.extend(entries)
+
+    monkeypatch.setattr(spill, "send", send)
+    yield spill
+    spill.close()
+
+
+def crash(spill: LogSpill) -> str:
+    """Leave the current segment behind the way a crashed worker would, and return its path."""
+    path = spill.current.path
+    spill.close()
+    return path
+
+
+def record_offsets(entries) -> list:
+    """Offset of each record in a segment holding `entries`."""
+    offsets = [SEGMENT_HEADER.size]
+    for entry in entries:
+        offsets.append(offsets[-1] + RECORD.size + len(entry))
+    return offsets[:-1]
+
+
+def test_entries_survive_a_crash(spill):
+    assert spill.append([entry.decode() for entry in ENTRIES]) == len(ENTRIES)
+    segment = Segment(crash(spill))
+    try:
+        assert segment.read(100) == (ENTRIES, segment.end)
+    finally:
+        segment.close()
+
+
+@pytest.mark.parametrize(
+    "tear",
+    [
+        # Payload written, length and CRC not yet
+        lambda data, offset: data[:offset] + b"\0" * RECORD.size + data[offset + RECORD.size:],
+        # Length and CRC written, payload not yet
+        lambda data, offset: data[:offset + RECORD.size] + b"\0" * len(ENTRIES[-1]) + data[offset + RECORD.size + len(ENTRIES[-1]):],
+        # Payload torn halfway
+        lambda data, offset: data[:offset + RECORD.size + 2] + b"\xff" + data[offset + RECORD.size + 3:],
+    ],
+)
+def test_a_torn_last_record_is_dropped(spill, tear):
+    spill.append(ENTRIES)
+    path = crash(spill)
+    with open(path, "r+b") as f:
+        data = f.read()
+        f.seek(0)
+        f.write(tear(data, record_offsets(ENTRIES)[-1]))
+
+    segment = Segment(path)
+    try:
+        assert segment.read(100)[0] == ENTRIES[:-1]
+        # Appends resume where the intact records end
+        assert segment.end == record_offsets(ENTRIES)[-1]
+        assert segment.append(b"after")
+        assert segment.read(100)[0] == [*ENTRIES[:-1], b"after"]
+    finally:
+        segment.close()
+
+
+def test_a_corrupt_record_stops_the_scan(spill):
+    spill.append(ENTRIES)
+    path = crash(spill)
+    with open(path, "r+b") as f:
+        f.seek(record_offsets(ENTRIES)[2] + RECORD.size)
+        f.write(b"E")
+
+    segment = Segment(path)
+    try:
+        assert segment.read(100)[0] == ENTRIES[:2]
+    finally:
+        segment.close()
+
+
+def test_segments_left_by_a_crash_are_replayed_and_deleted(spill, tmp_path):
+    spill.append(ENTRIES)
+    crash(spill)
+
+    assert asyncio.run(spill.replay()) == len(ENTRIES)
+    assert spill.sent == ENTRIES
+    assert os.listdir(tmp_path) == []
+
+
+def test_the_current_segment_is_replayed_in_place(spill):
+    spill.append(ENTRIES[:2])
+    assert asyncio.run(spill.replay()) == 2
+    spill.append(ENTRIES[2:])
+    assert asyncio.run(spill.replay()) == 3
+    assert spill.sent == ENTRIES
+    assert spill.current.replayed == spill.current.end
+
+
+def test_full_segments_rotate_in_order(spill, tmp_path):
+    entries = [os.urandom(1000) for _ in range(10)]
+    assert spill.append(entries) == len(entries)
+    assert len(os.listdir(tmp_path)) > 1
+
+    assert asyncio.run(spill.replay()) == len(entries)
+    assert spill.sent == entries
+    assert os.listdir(tmp_path) == [os.path.basename(spill.current.path)]
+
+
+def test_entries_beyond_max_bytes_are_refused(spill):
+    entries = [os.urandom(1000) for _ in range(20)]
+    handled = spill.append(entries)
+    assert 0 < handled < len(entries)
+    assert spill.disk_usage() <= spill.max_bytes
+
+
+def test_a_failed_replay_resumes_after_the_last_batch_sent(spill, monkeypatch):
+    monkeypatch.setattr("services.log_spill.LOG_SPILL_REPLAY_BATCH_SIZE", 2)
+    spill.append(ENTRIES)
+    path = crash(spill)
+    sent = []
+
+    async def fail_after_one_batch(entries):
+        if sent:
+            raise ConnectionError("database is down")
+        sent.extend(entries)
+
+    monkeypatch.setattr(spill, "send", fail_after_one_batch)
+    with pytest.raises(ConnectionError):
+        asyncio.run(spill.replay())
+    assert sent == ENTRIES[:2]
+
+    # The next replayer, possibly in another worker, sends the rest
+    other = LogSpill(spill.directory, segment_size=SEGMENT_SIZE)
+    other.sent = []
+
+    async def send(entries):
+        other.sent.extend(entries)
+
+    monkeypatch.setattr(other, "send", send)
+    assert asyncio.run(other.replay()) == 3
+    assert other.sent == ENTRIES[2:]
+    assert not os.path.exists(path)
@@ -0,0 +1,124 @@
+import asyncio
+import string
+from itertools import combinations
+
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+import services.authz
+from models import Base, Permission, Role, RoleEnum, User, role_parents
+from services.authz import PermissionMatrix
+from services.helpers import API_KEY_PEPPER, generate_api_key, hash_api_key_secret, parse_api_key, required_roles_for
+from services.hierarchy import rebuild_closure
+from services.policy import build_snapshot
+from services.policy_evaluator import PolicyEvaluator, legacy_key_id
+
+ROLES = [role.value for role in RoleEnum]
+PERMISSIONS = ["read", "write", "export", "unassigned"]
+GRANTS = {"Staff": ["read"], "Supervisor": ["write", "export"], "Admin": []}
+HIERARCHIES = {
+    "flat": {},
+    "default": {"Supervisor": ["Staff"], "Admin": ["Supervisor"]},
+    "diamond": {"Supervisor": ["Staff"], "Admin": ["Staff"]},
+}
+
+ALLOWED_ROLES = [None, [], ["*"], ["Unknown"], *([role] for role in ROLES), ["Staff", "Supervisor"]]
+REQUIRED_PERMISSIONS = [
+    None,
+    [],
+    ["missing"],
+    *([permission] for permission in PERMISSIONS),
+    *(list(pair) for pair in combinations(PERMISSIONS, 2)),
+]
+# Legacy keys were 32 characters drawn from letters, digits and punctuation, "." included
+LEGACY_KEYS = {"Staff": "a.Z9" + string.punctuation[:28], "Supervisor": "0123456789aB.cdefghijklmnopqrstu"}
+
+
+@pytest.fixture(params=list(HIERARCHIES))
+def policy(request, tmp_path, monkeypatch):
+    """
+    A PermissionMatrix and a PolicyEvaluator loaded from the same database, the way the
+    API and a gateway load them, and (role, API key) pairs: a key for each role and the
+    migrated legacy keys.
+    """
+    path = tmp_path / "policy.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    keys = []
+    with Session(engine) as db:
+        roles = {name: Role(name=RoleEnum(name)) for name in ROLES}
+        permissions = {name: Permission(name=name) for name in PERMISSIONS}
+        db.add_all([*roles.values(), *permissions.values()])
+        db.flush()
+        for role, granted in GRANTS.items():
+            roles[role].permissions = [permissions[name] for name in granted]
+        parents = [
+            {"role_id": roles[role].id, "parent_id": roles[parent].id}
+            for role, names in HIERARCHIES[request.param].items()
+            for parent in names
+        ]
+        if parents:
+            db.execute(insert(role_parents), parents)
+        rebuild_closure(db)
+        for name, role in roles.items():
+            issued = generate_api_key()
+            db.add(User(username=name, role_id=role.id, key_id=issued.key_id, api_key_hash=issued.digest))
+            keys.append((name, issued.api_key))
+        # Rows as `python db.py` migrates them
+        for name, api_key in LEGACY_KEYS.items():
+            key_id = legacy_key_id(api_key, API_KEY_PEPPER)
+            db.add(User(username=f"legacy-{name}", role_id=roles[name].id, key_id=key_id, api_key_hash=hash_api_key_secret(api_key)))
+            keys.append((name, api_key))
+        db.commit()
+
+        evaluator = PolicyEvaluator(API_KEY_PEPPER)
+        evaluator.apply(build_snapshot(db)[0])
+    engine.dispose()
+
+    async def load_matrix():
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        monkeypatch.setattr(
+            services.authz, "AsyncSessionLocal", sessionmaker(bind=async_engine, class_=AsyncSession)
+        )
+        matrix = PermissionMatrix()
+        await matrix.load()
+        await async_engine.dispose()
+        return matrix
+
+    return asyncio.run(load_matrix()), evaluator, keys
+
+
+def test_evaluator_matches_the_permission_matrix(policy):
+    matrix, evaluator, keys = policy
+    for role, api_key in keys:
+        for allowed_roles in ALLOWED_ROLES:
+            for permissions in REQUIRED_PERMISSIONS:
+                mask = matrix.mask_for(permissions) if permissions else 0
+                expected = matrix.authorizes(role, required_roles_for(allowed_roles, permissions), mask)
+                decision = evaluator.authorize(api_key, allowed_roles, permissions)
+                assert decision.allowed == expected, (role, allowed_roles, permissions)
+                assert decision.role == role
+                assert decision.message == ("" if expected else "Insufficient privileges")
+
+
+def test_admin_holds_everything_that_exists(policy):
+    matrix, evaluator, keys = policy
+    for permissions in REQUIRED_PERMISSIONS:
+        expected = permissions != ["missing"]
+        assert evaluator.authorize(dict(keys)["Admin"], None, permissions).allowed == expected
+        assert matrix.authorizes("Admin", required_roles_for(None, permissions), matrix.mask_for(permissions or [])) == expected
+
+
+@pytest.mark.parametrize("mangle", [lambda key: key + "x", lambda key: key.split(".")[0], lambda key: "0" * 12 + ".secret"])
+def test_invalid_keys_are_denied(policy, mangle):
+    _, evaluator, keys = policy
+    decision = evaluator.authorize(mangle(dict(keys)["Admin"]), ["*"])
+    assert not decision.allowed and decision.message == "Invalid API key"
+
+
+@pytest.mark.parametrize("api_key", LEGACY_KEYS.values())
+def test_legacy_keys_parse_the_same_in_the_api(api_key):
+    assert parse_api_key(api_key) == (legacy_key_id(api_key, API_KEY_PEPPER), api_key)
+    assert parse_api_key(api_key[:-1]) is None
@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+import fakeredis
+import pytest
+
+import services.ratelimit
+import services.redis
+from services.log import ACCESS_LOGS_KEY
+from services.ratelimit import RateLimit, limit_and_log
+
+# Two requests at once, then one every 50ms
+LIMIT = RateLimit(rate=20, burst=2)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """fakeredis with Lua as the shared Redis, with a Staff key limit of LIMIT."""
+    client = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(services.redis, "redis", client)
+    monkeypatch.setattr(services.redis.redis_breaker, "open_until", 0.0)
+    monkeypatch.setattr(services.ratelimit, "_script", None)
+    monkeypatch.setattr(services.ratelimit, "RATE_LIMITING", True)
+    monkeypatch.setattr(services.ratelimit, "LOG_TRANSPORT", "list")
+    monkeypatch.setattr(services.ratelimit, "KEY_LIMITS", {"Staff": LIMIT})
+    monkeypatch.setattr(services.ratelimit, "ROLE_LIMITS", {})
+    return client
+
+
+async def take(key_id: str = "a" * 12, role: str = "Staff"):
+    return await limit_and_log(key_id, role, f"allowed {key_id}", f"limited {key_id}")
+
+
+async def logged(client) -> list:
+    return [entry.decode() for entry in await client.lrange(ACCESS_LOGS_KEY, 0, -1)]
+
+
+def test_the_burst_is_allowed_then_requests_are_limited(redis):
+    async def run():
+        results = [await take() for _ in range(3)]
+        return results, await logged(redis)
+
+    results, entries = asyncio.run(run())
+    assert [result.allowed for result in results] == [True, True, False]
+    assert [result.remaining for result in results] == [1, 0, 0]
+    assert all(result.limit == LIMIT.burst for result in results)
+    assert results[2].retry_after == 1
+    assert results[2].headers()["Retry-After"] == "1"
+    assert "Retry-After" not in results[0].headers()
+    # Limited requests are logged too, with their own entry
+    assert entries == ["allowed " + "a" * 12] * 2 + ["limited " + "a" * 12]
+
+
+def test_tokens_refill_over_time(redis):
+    async def run():
+        for _ in range(LIMIT.burst):
+            await take()
+        limited = await take()
+        await asyncio.sleep(1.2 / LIMIT.rate)
+        return limited, await take(), await take()
+
+    limited, refilled, limited_again = asyncio.run(run())
+    assert not limited.allowed
+    assert refilled.allowed
+    assert not limited_again.allowed
+
+
+def test_keys_have_separate_buckets(redis):
+    async def run():
+        return [await take("a" * 12) for _ in range(3)], await take("b" * 12)
+
+    first, other = asyncio.run(run())
+    assert not first[-1].allowed
+    assert other.allowed
+
+
+def test_role_buckets_are_shared_and_limit_first(redis, monkeypatch):
+    monkeypatch.setattr(services.ratelimit, "ROLE_LIMITS", {"Staff": RateLimit(rate=20, burst=3)})
+
+    async def run():
+        return [await take(key_id * 12) for key_id in "abcd"], await redis.hgetall("rate_limit:key:" + "d" * 12)
+
+    results, limited_bucket = asyncio.run(run())
+    assert [result.allowed for result in results] == [True, True, True, False]
+    # A request refused by one bucket takes no token from the others
+    assert float(limited_bucket[b"tokens"]) == LIMIT.burst
+
+
+def test_roles_without_limits_skip_redis(redis):
+    async def run():
+        return await take(role="Admin"), await logged(redis)
+
+    assert asyncio.run(run()) == (None, [])
+
+
+def test_a_stalled_redis_is_skipped_until_the_breaker_closes(redis, monkeypatch):
+    calls = []
+
+    class Stalled:
+        async def evalsha(self, *args):
+            calls.append(args)
+            await asyncio.sleep(60)
+
+    monkeypatch.setattr(services.redis.redis_breaker, "cooldown", 0.2)
+
+    async def run():
+        # Registered against fakeredis, then run against the stalled client
+        services.ratelimit.token_bucket()
+        monkeypatch.setattr(services.redis, "redis", Stalled())
+        assert await take() is None
+        started = time.perf_counter()
+        assert await take() is None
+        skipped = time.perf_counter() - started
+        await asyncio.sleep(0.2)
+        monkeypatch.setattr(services.redis, "redis", redis)
+        return skipped, await take()
+
+    skipped, result = asyncio.run(run())
+    assert len(calls) == 1
+    assert skipped < services.ratelimit.LOG_PUSH_BUDGET_MS / 1000
+    assert result.allowed